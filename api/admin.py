@@ -1,8 +1,186 @@
-from django.contrib import admin
-from .models import Transfer, Expense, Currency
-# Register your models here.
+"""
+Module providing admin site of api models.
+Changelists load related users and currencies in the same query, do not
+count whole tables and filter only by indexed columns, so they stay fast
+on large databases.
+"""
+
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connections
+from django.db.models import F, Max
+from django.utils.functional import cached_property
+from .models import Transfer, Expense, Currency, RecurringExpense
+from .sharding import ID_SHIFT, enabled, is_sharded, shard_aliases
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator which does not count whole tables.
+    Size of unfiltered table is estimated, on PostgreSQL from planner
+    statistics, on other databases from the largest id with index of
+    shard (bits above ID_SHIFT) masked off. Filtered querysets are counted
+    up to COUNT_LIMIT rows.
+    """
+    COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        if not queryset.query.where:
+            return self.estimate(queryset)
+        return queryset[:self.COUNT_LIMIT].count()
+
+    @staticmethod
+    def estimate(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > 0:
+                return int(row[0])
+        return queryset.aggregate(
+            last=Max(F('pk').bitand((1 << ID_SHIFT) - 1))
+        )['last'] or 0
+
+
+class IndexedBooleanListFilter(admin.BooleanFieldListFilter):
+    """
+    Boolean list filter comparing column with IN, same as
+    api.filters.IndexedBooleanFilter, so the filter can use an index.
+    """
+
+    def queryset(self, request, queryset):
+        if self.lookup_val in ('0', '1'):
+            return queryset.filter(**{
+                f'{self.field_path}__in': [self.lookup_val == '1']
+            })
+        return super().queryset(request, queryset)
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Picks shard whose rows are listed, the first one by default, so
+    changelists and their bulk actions read a shard instead of the
+    'default' database. Change views read the shard given by the id.
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def shard(self):
+        if self.value() in shard_aliases():
+            return self.value()
+        return shard_aliases()[0]
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.shard())
+
+    def choices(self, changelist):
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': alias == self.shard(),
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: alias}
+                ),
+                'display': title,
+            }
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    """
+    Base admin of large tables. Sharded tables are listed shard by
+    shard, see ShardListFilter.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    ordering = ['-id']
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if enabled() and is_sharded(self.model):
+            return [ShardListFilter, *list_filter]
+        return list_filter
+
+
+@admin.register(Expense)
+class ExpenseAdmin(ScalableAdmin):
+    """
+    Admin of expenses, filters use expense_settled_currency_idx.
+    """
+    list_display = ['id', 'owner', 'currency', 'total_amount', 'to_settle',
+                    'vat', 'is_settled']
+    list_select_related = ['owner', 'currency']
+    list_filter = [('is_settled', IndexedBooleanListFilter), 'currency']
+    raw_id_fields = ['owner']
+    readonly_fields = ['settled', 'to_settle', 'is_settled', 'counter_slots',
+                       'updated']
+
+
+@admin.register(Transfer)
+class TransferAdmin(ScalableAdmin):
+    """
+    Admin of transfers, filters use transfer_settled_date_idx.
+    Selected transfers can be settled or unsettled at once, with
+    set-based updates of their expenses. Change form does not change
+    balances, 'brutto' is counted from 'netto' and 'vat', which can not
+    be changed on settled transfers.
+    """
+    list_display = ['id', 'owner', 'expense_id', 'currency', 'brutto',
+                    'sent_date', 'is_settled']
+    list_select_related = ['owner', 'currency']
+    list_filter = [('is_settled', IndexedBooleanListFilter),
+                   ('sent_date', admin.DateFieldListFilter)]
+    raw_id_fields = ['owner', 'expense']
+    readonly_fields = ['brutto', 'is_settled', 'updated']
+    actions = ['settle', 'unsettle']
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is not None and obj.is_settled:
+            return [*self.readonly_fields, 'netto', 'vat', 'expense',
+                    'currency']
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        obj.brutto = obj.netto + obj.vat
+        super().save_model(request, obj, form, change)
+
+    def settle(self, request, queryset):
+        try:
+            count = queryset.settle()
+        except IntegrityError:
+            self.message_user(
+                request,
+                "Selected transfers exceed amount left to settle of their "
+                "expenses, nothing has been settled.",
+                messages.ERROR
+            )
+            return
+        self.message_user(request, f"Settled {count} transfers.")
+    settle.short_description = "Settle selected transfers"
+
+    def unsettle(self, request, queryset):
+        count = queryset.unsettle()
+        self.message_user(request, f"Unsettled {count} transfers.")
+    unsettle.short_description = "Unsettle selected transfers"
+
+
+@admin.register(RecurringExpense)
+class RecurringExpenseAdmin(ScalableAdmin):
+    """
+    Admin of recurring expense schedules.
+    """
+    list_display = ['id', 'owner', 'currency', 'total_amount', 'vat',
+                    'cadence', 'next_run']
+    list_select_related = ['owner', 'currency']
+    raw_id_fields = ['owner']
 
 
-admin.site.register(Transfer)
-admin.site.register(Expense)
 admin.site.register(Currency)
@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from api import sharding
+
+        post_migrate.connect(sharding.prepare_migrated_shard, sender=self)
+        # Lazy sender, api registry of isolate_apps() has no models.
+        for model in (User, 'api.Currency'):
+            post_save.connect(sharding.mirror_saved, sender=model)
+            post_delete.connect(sharding.mirror_deleted, sender=model)
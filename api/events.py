@@ -0,0 +1,229 @@
+"""
+Module providing server-sent events about transfers and expenses.
+
+Events are published from the settle and delete paths to an in-process
+broadcaster and streamed by EventStreamApplication, which is mounted in
+zadanie/asgi.py at /events/. Publishers and the stream have to run in
+the same process, e.g. one ASGI server worker.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+from collections import deque
+from importlib import import_module
+from io import BytesIO
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+
+KEEPALIVE_SECONDS = 15
+HISTORY_SIZE = 1000
+
+
+class Broadcaster:
+    """
+    Delivers events to subscribed streams of given user.
+    Keeps last HISTORY_SIZE events, so reconnecting clients can resume
+    from the last event id they have seen.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.history = deque(maxlen=history_size)
+        self.subscribers = {}
+
+    def publish(self, user_id, event, data):
+        """
+        Sends event to every stream of given user.
+        Safe to call from any thread.
+        """
+
+        with self.lock:
+            message = (next(self.ids), user_id, event, data)
+            self.history.append(message)
+            queues = list(self.subscribers.get(user_id, ()))
+        for loop, queue in queues:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+        return message[0]
+
+    def subscribe(self, user_id, last_event_id=None):
+        """
+        Registers new stream of user. Returns its queue and list of
+        missed events, or None if missed events are no longer kept.
+        """
+
+        queue = asyncio.Queue()
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(
+                (asyncio.get_event_loop(), queue)
+            )
+            missed = self.missed(user_id, last_event_id)
+        return queue, missed
+
+    def unsubscribe(self, user_id, queue):
+        with self.lock:
+            queues = self.subscribers.get(user_id, set())
+            queues.difference_update(
+                [item for item in queues if item[1] is queue]
+            )
+            if not queues:
+                self.subscribers.pop(user_id, None)
+
+    def missed(self, user_id, last_event_id):
+        if last_event_id is None:
+            return []
+        oldest = self.history[0][0] if self.history else None
+        newest = self.history[-1][0] if self.history else 0
+        if last_event_id > newest or (
+                oldest is not None and last_event_id < oldest - 1):
+            return None
+        return [message for message in self.history
+                if message[0] > last_event_id and message[1] == user_id]
+
+
+broadcaster = Broadcaster()
+
+
+def publish(user_id, event, using=None, **data):
+    """
+    Publishes event after current transaction of database 'using' is
+    committed, so streams never see changes that have been rolled back.
+    using- alias of database which made the change, 'default' when not
+        given
+    """
+
+    transaction.on_commit(
+        lambda: broadcaster.publish(user_id, event, data), using=using
+    )
+
+
+def transfer_data(transfer):
+    return {
+        'id': transfer.id,
+        'expense': transfer.expense_id,
+        'brutto': transfer.brutto,
+        'is_settled': transfer.is_settled,
+    }
+
+
+def format_event(message):
+    event_id, _, event, data = message
+    return (f"id: {event_id}\nevent: {event}\n"
+            f"data: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+            ).encode('utf-8')
+
+
+class EventStreamApplication:
+    """
+    ASGI application streaming events of authenticated user.
+    Accepts session or basic authentication, same as the API.
+    Resumes after the id given in Last-Event-ID header or
+    last_event_id query parameter. When missed events are no longer
+    kept, sends 'reset' event and client should fetch its data again.
+
+    GET /events/
+    """
+
+    def __init__(self, broadcaster=broadcaster):
+        self.broadcaster = broadcaster
+
+    async def __call__(self, scope, receive, send):
+        user_id = await sync_to_async(self.authenticate)(scope)
+        if user_id is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 401,
+                'headers': [(b'content-type', b'text/plain')],
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        queue, missed = self.broadcaster.subscribe(
+            user_id, self.last_event_id(scope)
+        )
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                ],
+            })
+            if missed is None:
+                await self.send_body(send, b"event: reset\ndata: {}\n\n")
+            else:
+                for message in missed:
+                    await self.send_body(send, format_event(message))
+            await self.stream(queue, receive, send)
+        finally:
+            self.broadcaster.unsubscribe(user_id, queue)
+
+    async def stream(self, queue, receive, send):
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            while True:
+                message = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    [message, disconnect],
+                    timeout=KEEPALIVE_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnect in done:
+                    message.cancel()
+                    return
+                if message in done:
+                    await self.send_body(send, format_event(message.result()))
+                else:
+                    message.cancel()
+                    await self.send_body(send, b": keepalive\n\n")
+        finally:
+            disconnect.cancel()
+
+    @staticmethod
+    async def send_body(send, body):
+        await send({
+            'type': 'http.response.body',
+            'body': body,
+            'more_body': True,
+        })
+
+    @staticmethod
+    def last_event_id(scope):
+        headers = dict(scope.get('headers', []))
+        value = headers.get(b'last-event-id', b'').decode('latin-1')
+        if not value:
+            query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            value = query.get('last_event_id', [''])[0]
+        return int(value) if value.isdigit() else None
+
+    @staticmethod
+    def authenticate(scope):
+        """
+        Returns id of user authenticated by session cookie or basic
+        authentication header, None for anonymous user.
+        """
+
+        request = ASGIRequest(scope, BytesIO())
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore(
+            request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        )
+        user = get_user(request)
+        if user.is_authenticated:
+            return user.id
+        try:
+            result = BasicAuthentication().authenticate(Request(request))
+        except AuthenticationFailed:
+            return None
+        return result[0].id if result else None
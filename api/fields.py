@@ -0,0 +1,81 @@
+"""
+Module providing custom model fields.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import models
+from django.db.models import Avg
+
+
+class MoneyField(models.DecimalField):
+    """
+    Decimal field stored in database as 64-bit integer amount of minor
+    units (grosze, cents).
+    In Python and in the API it behaves like DecimalField with
+    2 decimal places, while sums and comparisons run on integers in
+    the database.
+    Values passed to the database inside expressions have to be wrapped
+    in Value(amount, output_field=MoneyField()), otherwise they are not
+    converted to minor units. Averages are computed with MoneyAvg.
+    """
+    description = "Decimal number stored as integer amount of minor units"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('decimal_places', 2)
+        kwargs.setdefault('max_digits', 16)
+        super(MoneyField, self).__init__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return 'BigIntegerField'
+
+    def to_minor_units(self, value):
+        """
+        Converts Decimal amount to integer amount of minor units.
+        """
+
+        if value is None:
+            return None
+        return int(Decimal(value).scaleb(self.decimal_places)
+                   .quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    def from_minor_units(self, value):
+        """
+        Converts amount of minor units read from database to Decimal.
+        Aggregates like AVG may return fractions of minor unit,
+        those are rounded.
+        """
+
+        if value is None:
+            return None
+        if isinstance(value, int):
+            return Decimal(value).scaleb(-self.decimal_places)
+        return (Decimal(str(value)).scaleb(-self.decimal_places)
+                .quantize(Decimal(1).scaleb(-self.decimal_places),
+                          rounding=ROUND_HALF_UP))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        return self.to_minor_units(value)
+
+    def get_db_prep_save(self, value, connection):
+        return self.get_db_prep_value(value, connection)
+
+    def from_db_value(self, value, expression, connection):
+        return self.from_minor_units(value)
+
+
+class MoneyAvg(Avg):
+    """
+    Average of MoneyField values.
+    Plain Avg would return float amount of minor units, or truncate it
+    to integer when given MoneyField as output field.
+    """
+
+    def __init__(self, expression, **extra):
+        extra['output_field'] = MoneyField()
+        super(MoneyAvg, self).__init__(expression, **extra)
+
+    @property
+    def convert_value(self):
+        return self._convert_value_noop
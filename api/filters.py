@@ -0,0 +1,63 @@
+"""
+This module provides filter sets for api list views.
+Filters are declared without model, so the same filter set works on hot
+and archive tables. Every combination of filters used together with
+owner of the rows is backed by an index of the hot table.
+"""
+
+from django_filters import rest_framework as filters
+
+
+class IndexedBooleanFilter(filters.BooleanFilter):
+    """
+    Boolean filter comparing column with IN instead of testing bare
+    column value, which SQLite can not answer with an index.
+    """
+
+    def filter(self, qs, value):
+        if value is None:
+            return qs
+        return self.get_method(qs)(**{f'{self.field_name}__in': [value]})
+
+
+class TransferFilter(filters.FilterSet):
+    """
+    Works with TransfersListView.
+    GET /transfers/?expense=1
+    GET /transfers/?currency=PLN&is_vat=true
+    GET /transfers/?is_settled=false&brutto_min=10&brutto_max=100
+    GET /transfers/?sent_date_after=2020-10-01&sent_date_before=2020-11-01
+    """
+    expense = filters.NumberFilter(field_name='expense_id')
+    currency = filters.CharFilter(field_name='currency_id')
+    is_vat = IndexedBooleanFilter()
+    is_settled = IndexedBooleanFilter()
+    brutto = filters.RangeFilter()
+    sent_date = filters.DateTimeFromToRangeFilter()
+
+
+class ExpenseFilter(filters.FilterSet):
+    """
+    Works with ExpensesListView.
+    GET /expenses/?currency=PLN&is_settled=false
+    GET /expenses/?vat=true
+    GET /expenses/?to_settle_min=100&to_settle_max=1000
+    """
+    currency = filters.CharFilter(field_name='currency_id')
+    vat = IndexedBooleanFilter()
+    is_settled = filters.BooleanFilter(method='filter_counted')
+    to_settle = filters.RangeFilter(method='filter_counted')
+
+    def filter_counted(self, queryset, name, value):
+        """
+        Compares balance counted with amounts settled on counters of
+        expenses, see ExpenseQuerySet.filter_counted. Expenses in counter
+        mode are few, so without them filters use indexes as before.
+        """
+        counters = queryset.has_counters()
+        if name == 'is_settled':
+            return queryset.filter_counted(is_settled=value,
+                                           counters=counters)
+        return queryset.filter_counted(to_settle_min=value.start,
+                                       to_settle_max=value.stop,
+                                       counters=counters)
@@ -0,0 +1,139 @@
+"""
+Management command moving old settled expenses to archive tables.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime, time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.db.models import F, Max, Value
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from api.models import (
+    Expense, Transfer, ArchivedExpense, ArchivedTransfer, ArchiveTotal
+)
+from api.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    """
+    Moves settled expenses whose last transfer was sent before given
+    date, together with their transfers, to archive tables.
+    Every batch is moved in its own transaction and its values are
+    added to ArchiveTotal rows. Shards are archived one after another.
+
+    python manage.py archive_settled --before 2020-01-01 --batch-size 500
+    """
+    help = "Moves old settled expenses and their transfers to archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = parse_date(options['before'])
+        if before is None:
+            raise CommandError("--before has to be a date, e.g. 2020-01-01")
+        cutoff = timezone.make_aware(datetime.combine(before, time.min))
+
+        expenses = transfers = 0
+        for alias in shard_aliases():
+            candidates = (Expense.objects.using(alias)
+                          .filter(is_settled=True)
+                          .annotate(last_sent=Max('transfers__sent_date'))
+                          .filter(last_sent__lt=cutoff)
+                          .order_by('id'))
+            last_id = 0
+            while True:
+                with transaction.atomic(using=alias):
+                    batch = list(candidates.filter(
+                        id__gt=last_id
+                    )[:options['batch_size']])
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+                    transfers += self.archive(batch, alias)
+                    expenses += len(batch)
+
+        self.stdout.write(
+            f"Archived {expenses} expenses and {transfers} transfers."
+        )
+
+    def archive(self, expenses, alias):
+        """
+        Copies expenses and their transfers to archive tables, updates
+        archive totals and deletes archived rows.
+        Returns number of archived transfers.
+        """
+
+        ids = [expense.id for expense in expenses]
+        transfers = list(
+            Transfer.objects.using(alias).filter(expense_id__in=ids)
+        )
+        totals = defaultdict(Counter)
+
+        for expense in expenses:
+            key = (expense.owner_id, expense.currency_id,
+                   self.month(expense.last_sent))
+            totals[key]['expenses'] += 1
+            totals[key]['settled'] += expense.settled
+        for transfer in transfers:
+            key = (transfer.owner_id, transfer.currency_id,
+                   self.month(transfer.sent_date))
+            totals[key]['transfers'] += 1
+            totals[key]['brutto'] += transfer.brutto
+            if transfer.is_vat:
+                totals[key]['vat_transfers'] += 1
+                totals[key]['vat_brutto'] += transfer.brutto
+
+        ArchivedExpense.objects.using(alias).bulk_create(
+            self.copy(ArchivedExpense, expense) for expense in expenses
+        )
+        ArchivedTransfer.objects.using(alias).bulk_create(
+            self.copy(ArchivedTransfer, transfer) for transfer in transfers
+        )
+        for (owner_id, currency_id, month), values in totals.items():
+            self.add_to_total(alias, owner_id, currency_id, month, values)
+
+        # Archived rows leave balances as they are and are not deleted
+        # for sync clients, so the plain QuerySet.delete is used instead
+        # of TransferQuerySet.delete and ExpenseQuerySet.delete.
+        models.QuerySet.delete(
+            Transfer.objects.using(alias).filter(expense_id__in=ids)
+        )
+        models.QuerySet.delete(
+            Expense.objects.using(alias).filter(id__in=ids)
+        )
+        return len(transfers)
+
+    @staticmethod
+    def month(date_time):
+        return timezone.localtime(date_time).date().replace(day=1)
+
+    @staticmethod
+    def copy(archive_model, instance):
+        return archive_model(**{
+            field.attname: getattr(instance, field.attname)
+            for field in archive_model._meta.concrete_fields
+        })
+
+    @staticmethod
+    def add_to_total(alias, owner_id, currency_id, month, values):
+        total = ArchiveTotal.objects.using(alias).filter(
+            owner_id=owner_id,
+            currency_id=currency_id,
+            month=month
+        )
+        updated = total.update(**{
+            name: F(name) + Value(
+                value, output_field=ArchiveTotal._meta.get_field(name)
+            )
+            for name, value in values.items()
+        })
+        if not updated:
+            ArchiveTotal.objects.using(alias).create(
+                owner_id=owner_id,
+                currency_id=currency_id,
+                month=month,
+                **values
+            )
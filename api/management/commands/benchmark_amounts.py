@@ -0,0 +1,108 @@
+"""
+Management command comparing decimal and minor-unit amount storage.
+"""
+
+import time
+from decimal import Decimal
+from random import Random
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.db.models import Avg, Sum
+from django.test.utils import isolate_apps
+from rest_framework import serializers
+from api.fields import MoneyField, MoneyAvg
+
+
+class Command(BaseCommand):
+    """
+    Creates two temporary transfer tables, one with DecimalField and one
+    with MoneyField amounts, fills them with the same rows and measures
+    aggregate and list speed on both. Tables are dropped afterwards.
+
+    python manage.py benchmark_amounts --rows 100000 --repeat 5
+    """
+    help = "Benchmarks DecimalField against integer minor-unit amounts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with isolate_apps('api'):
+            class DecimalTransfer(models.Model):
+                brutto = models.DecimalField(decimal_places=2, max_digits=16)
+                is_vat = models.BooleanField()
+
+                class Meta:
+                    app_label = 'api'
+                    db_table = 'benchmark_decimal_transfer'
+
+            class MoneyTransfer(models.Model):
+                brutto = MoneyField(decimal_places=2, max_digits=16)
+                is_vat = models.BooleanField()
+
+                class Meta:
+                    app_label = 'api'
+                    db_table = 'benchmark_money_transfer'
+
+            results = {}
+            for model in (DecimalTransfer, MoneyTransfer):
+                with connection.schema_editor() as editor:
+                    editor.create_model(model)
+                try:
+                    self.fill(model, options['rows'])
+                    results[model.__name__] = self.measure(
+                        model, options['page_size'], options['repeat']
+                    )
+                finally:
+                    with connection.schema_editor() as editor:
+                        editor.delete_model(model)
+
+        self.stdout.write(
+            f"{'storage':<16}{'sum+avg [ms]':>14}{'list page [ms]':>16}"
+        )
+        for name, (aggregate_time, list_time) in results.items():
+            self.stdout.write(
+                f"{name:<16}{aggregate_time * 1000:>14.2f}"
+                f"{list_time * 1000:>16.2f}"
+            )
+
+    @staticmethod
+    def fill(model, rows):
+        random = Random(0)
+        model.objects.bulk_create(
+            (model(
+                brutto=Decimal(random.randint(1, 10 ** 7)).scaleb(-2),
+                is_vat=random.random() < 0.5
+            ) for _ in range(rows)),
+            batch_size=5000
+        )
+
+    @staticmethod
+    def measure(model, page_size, repeat):
+        """
+        Returns best time of aggregate query and of serialized list page.
+        """
+
+        class PageSerializer(serializers.ModelSerializer):
+            class Meta:
+                fields = ['id', 'brutto', 'is_vat']
+
+        PageSerializer.Meta.model = model
+        average = (MoneyAvg if isinstance(model.brutto.field, MoneyField)
+                   else Avg)
+        aggregate_times, list_times = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.objects.filter(is_vat=True).aggregate(
+                Sum('brutto'), average('brutto')
+            )
+            aggregate_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            PageSerializer(
+                model.objects.order_by('id')[:page_size], many=True
+            ).data
+            list_times.append(time.perf_counter() - start)
+        return min(aggregate_times), min(list_times)
@@ -0,0 +1,87 @@
+"""
+Management command comparing response renderers on a transfer page.
+"""
+
+import gzip
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from random import Random
+import pytz
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from api.models import Transfer
+from api.renderers import FastJSONRenderer, MessagePackRenderer
+from api.serializers import TransferSerializer
+
+
+class Command(BaseCommand):
+    """
+    Serializes a page of transfers built in memory and measures encode
+    time and payload size, plain and gzipped, of every renderer.
+
+    python manage.py benchmark_renderers --rows 1000 --repeat 20
+    """
+    help = "Benchmarks JSON and MessagePack renderers on a transfer page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        page = {
+            'count': options['rows'],
+            'next': None,
+            'previous': None,
+            'results': TransferSerializer(
+                self.transfers(options['rows']), many=True
+            ).data,
+        }
+        self.stdout.write(
+            f"{'renderer':<22}{'encode [ms]':>12}{'size [B]':>12}"
+            f"{'gzip [B]':>12}"
+        )
+        for renderer in (JSONRenderer(), FastJSONRenderer(),
+                         MessagePackRenderer()):
+            encode_time, body = self.measure(renderer, page,
+                                             options['repeat'])
+            self.stdout.write(
+                f"{type(renderer).__name__:<22}{encode_time * 1000:>12.2f}"
+                f"{len(body):>12}{len(gzip.compress(body)):>12}"
+            )
+
+    @staticmethod
+    def transfers(rows):
+        random = Random(0)
+        start = datetime(2020, 1, 1, tzinfo=pytz.UTC)
+        transfers = []
+        for number in range(1, rows + 1):
+            netto = Decimal(random.randint(1, 10 ** 6)).scaleb(-2)
+            is_vat = random.random() < 0.5
+            vat = (netto * Decimal('0.23')).quantize(Decimal('0.01'))
+            transfers.append(Transfer(
+                id=number,
+                is_vat=is_vat,
+                netto=netto,
+                vat=vat,
+                brutto=netto + vat,
+                currency_id='PLN',
+                sent_date=start + timedelta(minutes=number),
+                is_settled=random.random() < 0.5,
+                expense_id=random.randint(1, rows // 10 + 1),
+                owner_id=1
+            ))
+        return transfers
+
+    @staticmethod
+    def measure(renderer, data, repeat):
+        """
+        Returns best encode time and rendered body.
+        """
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = renderer.render(data, renderer.media_type)
+            times.append(time.perf_counter() - start)
+        return min(times), body
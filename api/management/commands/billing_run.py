@@ -0,0 +1,55 @@
+"""
+Management command charging many users with the same expense.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from api.serializers import BillingRunSerializer
+
+
+class Command(BaseCommand):
+    """
+    Creates the same expense for given users, members of a group or all
+    active users, with bulk inserts in one transaction. Prints summary of
+    the run instead of created rows.
+
+    python manage.py billing_run --group members --currency PLN \
+        --amount 50.00 --vat
+    """
+    help = "Creates the same expense for many users at once."
+
+    def add_arguments(self, parser):
+        users = parser.add_mutually_exclusive_group(required=True)
+        users.add_argument('--users', type=int, nargs='+')
+        users.add_argument('--group')
+        users.add_argument('--all', action='store_true')
+        parser.add_argument('--currency', required=True)
+        parser.add_argument('--amount', required=True)
+        parser.add_argument('--vat', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        data = {
+            'currency': options['currency'],
+            'total_amount': options['amount'],
+            'vat': options['vat'],
+            'all_users': options['all'],
+        }
+        if options['users']:
+            data['users'] = options['users']
+        if options['group']:
+            data['group'] = options['group']
+        serializer = BillingRunSerializer(data=data)
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+
+        summary = serializer.save(batch_size=options['batch_size'])
+        self.stdout.write(
+            f"Created {summary['created']} expenses of "
+            f"{summary['total_amount']} {summary['currency']}, billed "
+            f"{summary['billed_amount']} {summary['currency']} in total."
+        )
+        if summary.get('skipped'):
+            self.stdout.write(
+                "Skipped missing or inactive users: "
+                + ", ".join(map(str, summary['skipped']))
+            )
@@ -0,0 +1,57 @@
+"""
+Management command folding settlement counters of expenses.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from api.models import Expense, UPDATE_BATCH_SIZE, batches
+from api.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    """
+    Folds amounts settled on counters of expenses in counter mode into
+    'settled', 'to_settle' and 'is_settled' of expense rows and splits
+    what is left to settle into budgets of counters again. Expenses are
+    folded in batches, every batch in its own short transaction. Meant
+    to be run periodically, e.g. every minute from cron.
+    With --enable given expenses are put in counter mode with --slots
+    counters, with --disable they are folded and leave counter mode.
+
+    python manage.py fold_counters
+    python manage.py fold_counters --enable 12 15 --slots 16
+    python manage.py fold_counters --disable 12
+    """
+    help = "Folds settlement counters into their expenses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enable', type=int, nargs='+', default=[])
+        parser.add_argument('--disable', type=int, nargs='+', default=[])
+        parser.add_argument('--slots', type=int, default=8)
+        parser.add_argument('--batch-size', type=int,
+                            default=UPDATE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['enable'] or options['disable']:
+            if not 0 < options['slots'] <= 1000:
+                raise CommandError("--slots has to be from 1 to 1000.")
+            enabled = Expense.objects.filter(
+                id__in=options['enable']
+            ).use_counters(options['slots'])
+            disabled = Expense.objects.filter(
+                id__in=options['disable']
+            ).use_counters(0)
+            self.stdout.write(
+                f"Enabled counters of {enabled} expenses, disabled "
+                f"counters of {disabled} expenses."
+            )
+            return
+
+        folded = 0
+        for alias in shard_aliases():
+            expenses = Expense.objects.using(alias)
+            ids = expenses.filter(counter_slots__gt=0).values_list(
+                'id', flat=True
+            )
+            for batch in batches(ids, options['batch_size']):
+                folded += expenses.filter(id__in=batch).fold()
+        self.stdout.write(f"Folded counters of {folded} expenses.")
@@ -0,0 +1,88 @@
+"""
+Management command creating expenses of due recurring schedules.
+"""
+
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from api.models import (
+    Expense, RecurringExpense, BILLING_BATCH_SIZE, UPDATE_BATCH_SIZE
+)
+from api.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    """
+    Creates expenses of every recurring schedule which next run is due,
+    and moves the schedule to its following run. Schedules missed for
+    more than one period get an expense for every missed run.
+    Due schedules are read in batches with recurring_next_run_idx. In
+    one transaction per batch expenses are created with bulk inserts and
+    schedules are advanced, so schedules already run are not due
+    anymore and running the command again creates nothing. Schedules
+    locked by another run are skipped.
+    Meant to be run daily, e.g. from cron:
+
+    python manage.py generate_recurring --batch-size 1000
+    """
+    help = "Creates expenses of due recurring schedules."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if options['date'] is not None:
+            today = parse_date(options['date'])
+            if today is None:
+                raise CommandError("--date has to be a date, e.g. 2020-01-01")
+
+        schedules = expenses = 0
+        for alias in shard_aliases():
+            while True:
+                with transaction.atomic(using=alias):
+                    batch = list(
+                        RecurringExpense.objects.using(alias)
+                        .due(today)
+                        .select_for_update(skip_locked=True)
+                        [:options['batch_size']]
+                    )
+                    if not batch:
+                        break
+                    expenses += self.run(batch, today, alias)
+                    schedules += len(batch)
+
+        self.stdout.write(
+            f"Created {expenses} expenses from {schedules} schedules."
+        )
+
+    @staticmethod
+    def run(schedules, today, alias):
+        """
+        Creates expenses of given schedules due on today or earlier and
+        advances the schedules, returns number of created expenses.
+        """
+
+        expenses = []
+        for schedule in schedules:
+            while schedule.next_run <= today:
+                expenses.append(Expense(
+                    currency_id=schedule.currency_id,
+                    total_amount=schedule.total_amount,
+                    to_settle=schedule.total_amount,
+                    settled=Decimal('0.00'),
+                    vat=schedule.vat,
+                    is_settled=False,
+                    owner_id=schedule.owner_id
+                ))
+                schedule.next_run = schedule.run_after(schedule.next_run)
+        Expense.objects.using(alias).bulk_create(
+            expenses, batch_size=BILLING_BATCH_SIZE
+        )
+        RecurringExpense.objects.using(alias).bulk_update(
+            schedules, ['next_run'], batch_size=UPDATE_BATCH_SIZE
+        )
+        return len(expenses)
@@ -0,0 +1,525 @@
+"""
+Management command measuring throughput and latency of the API under
+load.
+"""
+
+import http.client
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO
+from random import Random
+from urllib.parse import urlsplit
+import pytz
+import django
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.middleware.csrf import _get_new_csrf_token
+from django.utils import timezone
+from api.models import Currency, Expense, Transfer
+
+USER_PREFIX = 'loadtest-'
+ADMIN_USERNAME = 'loadtest-admin'
+DEFAULT_MIX = ('list_expenses=30,list_transfers=25,transfer_detail=15,'
+               'create_transfer=15,settle=10,statistics=5')
+
+
+def parse_mix(mix):
+    """
+    Returns dict of operation and weight from 'name=weight,...' string.
+    """
+
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise CommandError(f"Unknown operation '{name.strip()}'.")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(values, fraction):
+    """
+    Returns nearest-rank percentile of sorted values.
+    """
+
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class WSGITarget:
+    """
+    Calls WSGI application of zadanie.wsgi in this process.
+    """
+
+    def __init__(self, host):
+        from zadanie.wsgi import application
+        self.application = application
+        self.host = host
+
+    def request(self, method, path, body, headers):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key != 'CONTENT_TYPE':
+                key = f'HTTP_{key}'
+            environ[key] = value
+
+        status = []
+        result = self.application(
+            environ, lambda code, headers, exc_info=None: status.append(code)
+        )
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(status[0].split()[0]), content
+
+    def close(self):
+        connections.close_all()
+
+
+class HTTPTarget:
+    """
+    Sends requests to a running server over one keep-alive connection.
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.prefix = parts.path.rstrip('/')
+        connection_class = (http.client.HTTPSConnection
+                            if parts.scheme == 'https'
+                            else http.client.HTTPConnection)
+        self.connection = connection_class(parts.netloc, timeout=30)
+
+    def request(self, method, path, body, headers):
+        try:
+            self.connection.request(method, self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+class Session:
+    """
+    One simulated client, a user with their expenses and transfers and
+    the admin settling their transfers. Transfers to settle are given
+    only to this client, so every transfer is settled once.
+    """
+
+    def __init__(self, target, user, admin, random):
+        self.target = target
+        self.user = user
+        self.admin = admin
+        self.random = random
+        self.to_settle = list(user['to_settle'])
+
+    def call(self, client, method, path, data=None):
+        headers = {
+            'Accept': 'application/json',
+            'Cookie': (f"{settings.SESSION_COOKIE_NAME}={client['session']};"
+                       f" {settings.CSRF_COOKIE_NAME}={client['csrf']}"),
+            'X-CSRFToken': client['csrf'],
+        }
+        body = b''
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        return self.target.request(method, path, body, headers)
+
+    def list_expenses(self):
+        return self.call(self.user, 'GET', '/expenses/?is_settled=false')
+
+    def list_transfers(self):
+        pages = math.ceil(len(self.user['transfers'])
+                          / settings.REST_FRAMEWORK['PAGE_SIZE'])
+        return self.call(
+            self.user, 'GET',
+            f"/transfers/?page={self.random.randint(1, pages)}"
+        )
+
+    def transfer_detail(self):
+        return self.call(
+            self.user, 'GET',
+            f"/transfer/{self.random.choice(self.user['transfers'])}"
+        )
+
+    def create_transfer(self):
+        expense = self.random.choice(self.user['expenses'])
+        return self.call(self.user, 'POST', '/transfers/', {
+            'currency': expense['currency'],
+            'is_vat': expense['vat'],
+            'netto': '1.00',
+            'vat': '0.23',
+            'expense': expense['id'],
+            'owner': self.user['id'],
+        })
+
+    def settle(self):
+        if not self.to_settle:
+            return None
+        return self.call(self.admin, 'PUT',
+                         f"/transfer/{self.to_settle.pop()}",
+                         {'is_settled': True})
+
+    def statistics(self):
+        return self.call(self.user, 'GET', '/statystyki/')
+
+
+OPERATIONS = ['list_expenses', 'list_transfers', 'transfer_detail',
+              'create_transfer', 'settle', 'statistics']
+
+
+def run_client(target, user, admin, mix, deadline, requests, seed):
+    """
+    Sends requests of given mix until deadline or number of requests.
+    Returns dict of operation and its latencies in milliseconds and
+    response statuses, errors are counted as status 0.
+    """
+
+    random = Random(seed)
+    session = Session(target, user, admin, random)
+    names, weights = zip(*mix.items())
+    results = defaultdict(lambda: {'latencies': [], 'statuses': Counter()})
+    sent = 0
+    try:
+        while time.monotonic() < deadline and (requests is None
+                                               or sent < requests):
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                response = getattr(session, name)()
+            except Exception:
+                response = (0, b'')
+            if response is None:
+                continue
+            results[name]['latencies'].append(
+                (time.perf_counter() - start) * 1000
+            )
+            results[name]['statuses'][response[0]] += 1
+            sent += 1
+    finally:
+        target.close()
+    return dict(results)
+
+
+def run_worker(url, host, users, admin, mix, threads, duration, requests,
+               seed):
+    """
+    Runs threads clients, every one with its own target. Returns merged
+    results of the clients.
+    """
+
+    deadline = time.monotonic() + duration
+    results = [None] * threads
+
+    def client(index):
+        target = HTTPTarget(url) if url else WSGITarget(host)
+        results[index] = run_client(
+            target, users[index % len(users)], admin, mix, deadline,
+            requests, seed + index
+        )
+
+    if threads == 1:
+        client(0)
+    else:
+        workers = [threading.Thread(target=client, args=[index])
+                   for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return merge(results)
+
+
+def merge(results):
+    merged = defaultdict(lambda: {'latencies': [], 'statuses': Counter()})
+    for result in results:
+        for name, values in (result or {}).items():
+            merged[name]['latencies'].extend(values['latencies'])
+            merged[name]['statuses'].update(values['statuses'])
+    return dict(merged)
+
+
+def start_worker():
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    """
+    Replays a weighted mix of API calls of seeded users and reports
+    throughput, p50/p95/p99 latency and error rate of every operation.
+    Requests are sent by --threads clients in each of --processes
+    processes, to the WSGI application of zadanie.wsgi in the same
+    process, or with --url to a running server. Clients authenticate
+    with sessions created by the command, which are deleted afterwards.
+    --seed creates users named loadtest-*, with expenses and unsettled
+    transfers, every run reuses them. Results are written as JSON to
+    --output, so runs can be compared.
+
+    python manage.py load_test --seed --users 20
+    python manage.py load_test --threads 8 --processes 2 --duration 30 \
+        --mix list_expenses=50,create_transfer=30,settle=20 \
+        --output results.json
+    python manage.py load_test --url http://127.0.0.1:8000 --threads 16
+    """
+    help = "Measures throughput and latency of the API under load."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url')
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--duration', type=float, default=10)
+        parser.add_argument('--requests', type=int,
+                            help="Stop every client after this many requests.")
+        parser.add_argument('--mix', default=DEFAULT_MIX)
+        parser.add_argument('--seed', action='store_true')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--expenses', type=int, default=5)
+        parser.add_argument('--transfers', type=int, default=20)
+        parser.add_argument('--output')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        if options['seed']:
+            self.seed(options['users'], options['expenses'],
+                      options['transfers'])
+        clients = options['threads'] * options['processes']
+        admin, users = self.scenario(clients)
+        if admin is None:
+            raise CommandError("No load test users, run with --seed first.")
+
+        started = time.perf_counter()
+        try:
+            if options['processes'] > 1:
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options['processes'],
+                                         initializer=start_worker) as pool:
+                    results = merge(pool.map(run_worker, *zip(*[
+                        (options['url'], self.host(),
+                         users[index::options['processes']], admin, mix,
+                         options['threads'], options['duration'],
+                         options['requests'], index * options['threads'])
+                        for index in range(options['processes'])
+                    ])))
+            else:
+                results = run_worker(
+                    options['url'], self.host(), users, admin, mix,
+                    options['threads'], options['duration'],
+                    options['requests'], 0
+                )
+        finally:
+            self.end_sessions([admin] + users)
+        elapsed = time.perf_counter() - started
+
+        report = self.report(results, elapsed)
+        report['run'] = {
+            'time': timezone.now().isoformat(),
+            'target': options['url'] or 'wsgi',
+            'threads': options['threads'],
+            'processes': options['processes'],
+            'duration_s': round(elapsed, 3),
+            'mix': mix,
+        }
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+    @staticmethod
+    def host():
+        """
+        Returns host name accepted by ALLOWED_HOSTS, for WSGI target.
+        """
+
+        for host in settings.ALLOWED_HOSTS:
+            if host not in ('*', '') and not host.startswith('.'):
+                return host
+        return 'localhost'
+
+    @staticmethod
+    def seed(users, expenses, transfers):
+        """
+        Creates missing load test users and adds expenses with unsettled
+        transfers to every one of them.
+        """
+
+        currency, _ = Currency.objects.get_or_create(currency_name='PLN')
+        admin, created = User.objects.get_or_create(
+            username=ADMIN_USERNAME,
+            defaults={'is_staff': True, 'is_superuser': True}
+        )
+        if created:
+            admin.set_unusable_password()
+            admin.save()
+        owners = []
+        for number in range(users):
+            user, created = User.objects.get_or_create(
+                username=f'{USER_PREFIX}{number}'
+            )
+            if created:
+                user.set_unusable_password()
+                user.save()
+            owners.append(user.id)
+
+        for _ in range(expenses):
+            Expense.objects.bill(owners, currency, Decimal('1000000'), False)
+        sent_date = datetime.now(pytz.utc)
+        for owner in owners:
+            owned = Expense.objects.for_owner(User(id=owner))
+            Transfer.objects.bulk_create(
+                Transfer(
+                    is_vat=False,
+                    netto=Decimal('10'),
+                    vat=Decimal('0'),
+                    brutto=Decimal('10'),
+                    currency=currency,
+                    sent_date=sent_date,
+                    expense_id=expense_id,
+                    owner_id=owner
+                )
+                for expense_id in owned.values_list('id', flat=True)
+                .order_by('-id')[:expenses]
+                for _ in range(transfers)
+            )
+
+    def scenario(self, clients):
+        """
+        Returns admin client and clients of load test users, with ids of
+        their unsettled expenses and transfers. Unsettled transfers are
+        split between clients.
+        """
+
+        admin = User.objects.filter(username=ADMIN_USERNAME).first()
+        if admin is None:
+            return None, []
+        users = []
+        for user in (User.objects.filter(username__startswith=USER_PREFIX)
+                     .exclude(id=admin.id).order_by('id')):
+            expenses = [
+                {'id': id, 'currency': currency, 'vat': vat}
+                for id, currency, vat in Expense.objects.for_owner(user)
+                .filter(is_settled__in=[False])
+                .values_list('id', 'currency', 'vat')
+            ]
+            transfers = list(Transfer.objects.for_owner(user)
+                             .filter(is_settled__in=[False])
+                             .values_list('id', flat=True))
+            if expenses and transfers:
+                users.append(dict(self.start_session(user), id=user.id,
+                                  expenses=expenses, transfers=transfers))
+
+        if not users:
+            return None, []
+        clients_of_users = []
+        for index in range(clients):
+            user = users[index % len(users)]
+            shared = math.ceil((clients - index % len(users)) / len(users))
+            clients_of_users.append(dict(
+                user,
+                to_settle=user['transfers'][index // len(users)::shared]
+            ))
+        return self.start_session(admin), clients_of_users
+
+    @staticmethod
+    def start_session(user):
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = str(user.pk)
+        store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.create()
+        return {'session': store.session_key, 'csrf': _get_new_csrf_token()}
+
+    @staticmethod
+    def end_sessions(clients):
+        engine = import_module(settings.SESSION_ENGINE)
+        for key in {client['session'] for client in clients}:
+            engine.SessionStore(key).delete()
+
+    @staticmethod
+    def report(results, elapsed):
+        """
+        Returns throughput, latency percentiles and error rate of every
+        operation and of all of them. Responses with status 400 or
+        higher and failed requests are errors.
+        """
+
+        def summary(latencies, statuses):
+            latencies = sorted(latencies)
+            count = len(latencies)
+            errors = sum(number for code, number in statuses.items()
+                         if code == 0 or code >= 400)
+            return {
+                'requests': count,
+                'throughput_rps': round(count / elapsed, 2) if elapsed else 0,
+                'p50_ms': round(percentile(latencies, 0.50) or 0, 3),
+                'p95_ms': round(percentile(latencies, 0.95) or 0, 3),
+                'p99_ms': round(percentile(latencies, 0.99) or 0, 3),
+                'errors': errors,
+                'error_rate': round(errors / count, 4) if count else 0,
+                'statuses': {str(code): number
+                             for code, number in sorted(statuses.items())},
+            }
+
+        operations = {name: summary(values['latencies'], values['statuses'])
+                      for name, values in sorted(results.items())}
+        total = merge([results])
+        return {
+            'operations': operations,
+            'total': summary(
+                [latency for values in total.values()
+                 for latency in values['latencies']],
+                sum((values['statuses'] for values in total.values()),
+                    Counter())
+            ),
+        }
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{'operation':<18}{'requests':>10}{'req/s':>10}{'p50 [ms]':>10}"
+            f"{'p95 [ms]':>10}{'p99 [ms]':>10}{'errors':>10}"
+        )
+        rows = list(report['operations'].items())
+        rows.append(('total', report['total']))
+        for name, values in rows:
+            self.stdout.write(
+                f"{name:<18}{values['requests']:>10}"
+                f"{values['throughput_rps']:>10.1f}{values['p50_ms']:>10.2f}"
+                f"{values['p95_ms']:>10.2f}{values['p99_ms']:>10.2f}"
+                f"{values['error_rate']:>10.2%}"
+            )
@@ -0,0 +1,46 @@
+"""
+Management command summarizing request profiles.
+"""
+
+from collections import Counter
+from pathlib import Path
+import pstats
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """
+    Merges profiles saved by ProfilingMiddleware and prints number of
+    profiles per view and functions taking most of the time.
+
+    python manage.py profile_summary --view api.views.TransfersListView
+    python manage.py profile_summary --sort tottime --limit 50
+    """
+    help = "Summarizes top functions of collected request profiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None)
+        parser.add_argument('--view', default='')
+        parser.add_argument('--sort', default='cumulative',
+                            choices=['cumulative', 'tottime', 'ncalls'])
+        parser.add_argument('--limit', type=int, default=30)
+
+    def handle(self, *args, **options):
+        directory = Path(options['dir'] or settings.PROFILE_DIR)
+        prefix = options['view']
+        files = sorted(
+            path for path in directory.glob('*.prof')
+            if path.name.startswith(prefix)
+        )
+        if not files:
+            raise CommandError(f"No profiles found in {directory}.")
+
+        views = Counter(path.name.rsplit('-', 1)[0] for path in files)
+        for view, count in views.most_common():
+            self.stdout.write(f"{count:>6}  {view}")
+        self.stdout.write("")
+
+        stats = pstats.Stats(*map(str, files), stream=self.stdout)
+        stats.strip_dirs().sort_stats(options['sort'])
+        stats.print_stats(options['limit'])
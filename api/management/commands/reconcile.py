@@ -0,0 +1,203 @@
+"""
+Management command checking expense balances against their transfers.
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+from api.models import (
+    Expense, Transfer, SettlementEvent, SettlementCounter
+)
+from api.sharding import shard_aliases
+
+
+def expected_balance(total_amount, settled):
+    """
+    Returns 'to_settle' and 'is_settled' values, which Expense.save
+    counts for given 'settled' value.
+    """
+
+    to_settle = min(max(total_amount - settled, Decimal(0)), total_amount)
+    return to_settle, to_settle == 0
+
+
+def check_chunk(alias, start, stop, repair):
+    """
+    Compares expenses with ids from start to stop with one grouped
+    aggregate of their settled transfers. Amounts settled on counters
+    of expenses in counter mode are counted into their balance.
+    Mismatched expenses are repaired by repair_chunk when repair is
+    true.
+    Returns number of checked expenses and list of mismatches as
+    (id, settled, expected settled, to_settle, expected to_settle).
+    """
+
+    expenses = (Expense.objects.using(alias)
+                .filter(id__gte=start, id__lt=stop)
+                .values_list('id', 'total_amount', 'settled', 'to_settle',
+                             'is_settled'))
+    sums = dict(Transfer.objects.using(alias)
+                .filter(expense_id__gte=start, expense_id__lt=stop,
+                        is_settled=True)
+                .order_by()
+                .values('expense_id')
+                .annotate(brutto=Sum('brutto'))
+                .values_list('expense_id', 'brutto'))
+    counters = dict(SettlementCounter.objects.using(alias)
+                    .filter(expense_id__gte=start, expense_id__lt=stop)
+                    .order_by()
+                    .values('expense_id')
+                    .annotate(settled=Sum('settled'))
+                    .values_list('expense_id', 'settled'))
+
+    checked = 0
+    mismatches = []
+    for id, total_amount, settled, to_settle, is_settled in expenses:
+        checked += 1
+        if id in counters:
+            settled += counters[id]
+            to_settle -= counters[id]
+            is_settled = to_settle == 0
+        expected = sums.get(id, Decimal('0.00'))
+        expected_to_settle, expected_is_settled = expected_balance(
+            total_amount, expected
+        )
+        if (settled, to_settle, is_settled) != (
+                expected, expected_to_settle, expected_is_settled):
+            mismatches.append(
+                (id, settled, expected, to_settle, expected_to_settle)
+            )
+
+    if repair and mismatches:
+        repair_chunk(alias, [mismatch[0] for mismatch in mismatches])
+    return checked, mismatches
+
+
+def repair_chunk(alias, ids):
+    """
+    Repairs balances of given expenses in one transaction. Expenses and
+    their transfers are locked and compared again, so settlements
+    committed since the check are not counted twice, and 'settled',
+    'to_settle' and 'is_settled' are written as absolute values.
+    Counters of expenses in counter mode are folded before the repair
+    and split again after it.
+    Returns number of repaired expenses.
+    """
+
+    expenses = Expense.objects.using(alias).filter(id__in=ids)
+    transfers = Transfer.objects.using(alias).filter(expense_id__in=ids)
+    with transaction.atomic(using=alias):
+        expenses.fold()
+        rows = list(expenses.select_for_update().order_by('id'))
+        list(transfers.select_for_update().values_list('id', flat=True))
+        sums = dict(transfers.filter(is_settled=True)
+                    .order_by()
+                    .values('expense_id')
+                    .annotate(brutto=Sum('brutto'))
+                    .values_list('expense_id', 'brutto'))
+        repaired, events = [], []
+        for expense in rows:
+            expected = sums.get(expense.id, Decimal('0.00'))
+            to_settle, is_settled = expected_balance(expense.total_amount,
+                                                     expected)
+            if (expense.settled, expense.to_settle, expense.is_settled) == (
+                    expected, to_settle, is_settled):
+                continue
+            if expense.settled != expected:
+                events.append(SettlementEvent(
+                    expense_id=expense.id,
+                    kind=SettlementEvent.REPAIR,
+                    amount=expected - expense.settled
+                ))
+            expense.settled = expected
+            expense.to_settle = to_settle
+            expense.is_settled = is_settled
+            expense.updated = timezone.now()
+            repaired.append(expense)
+        Expense.objects.using(alias).bulk_update(
+            repaired, ['settled', 'to_settle', 'is_settled', 'updated']
+        )
+        SettlementEvent.objects.using(alias).bulk_create(events)
+        expenses.fold()
+    return len(repaired)
+
+
+def start_worker():
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    """
+    Checks that 'settled', 'to_settle' and 'is_settled' of every expense
+    match the sum of 'brutto' of its settled transfers.
+    Expenses are read in chunks of ids, every chunk is compared with one
+    grouped aggregate of transfers. Chunks are split across a pool of
+    processes, --workers 1 checks them in this process. With --repair
+    mismatched expenses are corrected and the corrections are recorded
+    in the settlement ledger.
+
+    python manage.py reconcile --chunk-size 10000 --workers 4 --repair
+    """
+    help = "Checks expense balances against sums of settled transfers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--repair', action='store_true')
+        parser.add_argument('--show', type=int, default=20)
+
+    def handle(self, *args, **options):
+        chunks = list(self.chunks(options['chunk_size']))
+        started = time.perf_counter()
+        if options['workers'] > 1 and len(chunks) > 1:
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'],
+                                     initializer=start_worker) as executor:
+                results = list(executor.map(
+                    check_chunk, *zip(*chunks),
+                    [options['repair']] * len(chunks)
+                ))
+        else:
+            results = [check_chunk(*chunk, options['repair'])
+                       for chunk in chunks]
+        elapsed = time.perf_counter() - started
+
+        checked = sum(result[0] for result in results)
+        mismatches = [mismatch for result in results
+                      for mismatch in result[1]]
+        self.stdout.write(
+            f"Checked {checked} expenses in {len(chunks)} chunks in "
+            f"{elapsed:.2f} s ({checked / elapsed if elapsed else 0:.0f} "
+            f"expenses/s)."
+        )
+        self.stdout.write(
+            f"Found {len(mismatches)} mismatched expenses"
+            + (", repaired." if options['repair'] and mismatches else ".")
+        )
+        for id, settled, expected, to_settle, expected_to_settle in sorted(
+                mismatches)[:options['show']]:
+            self.stdout.write(
+                f"  expense {id}: settled {settled}, expected {expected}; "
+                f"to_settle {to_settle}, expected {expected_to_settle}"
+            )
+
+    @staticmethod
+    def chunks(size):
+        """
+        Yields (database, first id, id after last) of every chunk.
+        """
+
+        for alias in shard_aliases():
+            bounds = Expense.objects.using(alias).aggregate(
+                first=Min('id'), last=Max('id')
+            )
+            if bounds['first'] is None:
+                continue
+            for start in range(bounds['first'], bounds['last'] + 1, size):
+                yield alias, start, start + size
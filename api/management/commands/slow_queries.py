@@ -0,0 +1,67 @@
+"""
+Management command grouping entries of slow query log.
+"""
+
+import json
+from collections import defaultdict
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.querylog import normalize
+
+
+class Command(BaseCommand):
+    """
+    Reads slow query log with its rotated files, groups entries by
+    normalized SQL and prints groups with the largest total time first,
+    with views and api code lines which made the queries and the last
+    captured EXPLAIN.
+
+    python manage.py slow_queries --limit 10
+    """
+    help = "Groups logged slow queries by normalized SQL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None)
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        path = Path(options['file'] or settings.SLOW_QUERY_LOG)
+        files = [file for file in path.parent.glob(f'{path.name}*')
+                 if file.name == path.name
+                 or file.suffix[1:].isdigit()]
+        if not files:
+            raise CommandError(f"No slow query log found at {path}.")
+
+        groups = defaultdict(lambda: {
+            'count': 0, 'total': 0.0, 'max': 0.0,
+            'views': set(), 'callers': set(), 'explain': None,
+        })
+        for file in files:
+            with open(file, encoding='utf-8') as lines:
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    group = groups[normalize(entry['sql'])]
+                    group['count'] += 1
+                    group['total'] += entry['duration_ms']
+                    group['max'] = max(group['max'], entry['duration_ms'])
+                    group['views'].add(entry.get('view') or '-')
+                    group['callers'].add(entry.get('caller') or '-')
+                    group['explain'] = entry.get('explain') or group['explain']
+
+        ordered = sorted(groups.items(), key=lambda item: -item[1]['total'])
+        for shape, group in ordered[:options['limit']]:
+            self.stdout.write(
+                f"{group['count']} queries, total {group['total']:.1f} ms, "
+                f"max {group['max']:.1f} ms"
+            )
+            self.stdout.write(f"  {shape}")
+            self.stdout.write(f"  views: {', '.join(sorted(group['views']))}")
+            for code in sorted(group['callers']):
+                self.stdout.write(f"  at {code}")
+            for row in group['explain'] or []:
+                self.stdout.write(f"  plan: {row}")
+            self.stdout.write("")
@@ -0,0 +1,74 @@
+"""
+Management command taking balance snapshots of expenses.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from api.models import Expense, SettlementEvent, BalanceSnapshot
+from api.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    """
+    Saves current 'settled' value of every expense which ledger has
+    changed since its last snapshot. Expenses without any snapshot get
+    their opening balance saved as well.
+    Meant to be run periodically, e.g. from cron:
+
+    python manage.py snapshot_balances --batch-size 1000
+    """
+    help = "Takes balance snapshots of expenses changed since last snapshot."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created = 0
+        for alias in shard_aliases():
+            created += self.snapshot(alias, options['batch_size'])
+        self.stdout.write(f"Saved {created} balance snapshots.")
+
+    @staticmethod
+    def snapshot(alias, batch_size):
+        """
+        Takes snapshots of expenses of given database, returns their
+        number.
+        """
+
+        last_event = (SettlementEvent.objects.using(alias)
+                      .filter(expense=OuterRef('pk'))
+                      .order_by('-id')
+                      .values('id')[:1])
+        last_snapshot = (BalanceSnapshot.objects.using(alias)
+                         .filter(expense=OuterRef('pk'))
+                         .order_by('-created', '-id'))
+        expenses = (Expense.objects.using(alias)
+                    .annotate(
+                        last_event=Subquery(last_event),
+                        has_snapshot=Subquery(last_snapshot.values('id')[:1]),
+                        snapshot_event=Subquery(
+                            last_snapshot.values('event')[:1]
+                        ))
+                    .filter(
+                        Q(has_snapshot__isnull=True, settled__gt=0)
+                        | Q(snapshot_event__isnull=True,
+                            last_event__isnull=False)
+                        | Q(snapshot_event__lt=F('last_event')))
+                    .values_list('id', 'settled', 'last_event'))
+
+        created = 0
+        snapshots = BalanceSnapshot.objects.using(alias)
+        with transaction.atomic(using=alias):
+            batch = []
+            for expense_id, settled, event_id in expenses.iterator():
+                batch.append(BalanceSnapshot(
+                    expense_id=expense_id,
+                    event_id=event_id,
+                    settled=settled
+                ))
+                if len(batch) >= batch_size:
+                    created += len(snapshots.bulk_create(batch))
+                    batch = []
+            created += len(snapshots.bulk_create(batch))
+        return created
@@ -0,0 +1,94 @@
+"""
+Module providing middleware of the project.
+"""
+
+import cProfile
+import random
+import re
+from pathlib import Path
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+
+class ThresholdGZipMiddleware(GZipMiddleware):
+    """
+    Compresses responses of at least GZIP_MIN_LENGTH bytes, when client
+    accepts gzip. Smaller responses are sent as they are, compressing
+    them costs more time than it saves on the wire.
+    """
+
+    def process_response(self, request, response):
+        if (not response.streaming and len(response.content) <
+                getattr(settings, 'GZIP_MIN_LENGTH', 1024)):
+            return response
+        return super().process_response(request, response)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests with cProfile and saves profiles to PROFILE_DIR
+    as <view name>-<timestamp>.prof files.
+    A PROFILE_SAMPLE_RATE fraction of all requests is profiled, and any
+    request of an admin user sending X-Profile: 1 header. Requests
+    with the header are authenticated the way api views do it before
+    the profiler is turned on, so other users do not pay its overhead.
+    Saved profiles are summarized by profile_summary command.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.random = random.Random()
+
+    def __call__(self, request):
+        sampled = self.random.random() < getattr(
+            settings, 'PROFILE_SAMPLE_RATE', 0
+        )
+        requested = (request.headers.get('X-Profile') == '1'
+                     and self.is_staff(request))
+        if not (sampled or requested):
+            return self.get_response(request)
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.disable()
+        response['X-Profile-Id'] = self.save(request, profile)
+        return response
+
+    @staticmethod
+    def is_staff(request):
+        """
+        Checks if request is sent by an admin user, authenticated with
+        authentication classes of api views.
+        """
+
+        authenticators = [authentication() for authentication
+                          in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+        try:
+            user = Request(request, authenticators=authenticators).user
+        except APIException:
+            return False
+        return user.is_staff
+
+    @staticmethod
+    def save(request, profile):
+        """
+        Writes profile to PROFILE_DIR, returns name of its file.
+        """
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        name = "{}-{}.prof".format(
+            re.sub(r'[^\w.]+', '_', view).strip('_'),
+            timezone.now().strftime('%Y%m%dT%H%M%S%f')
+        )
+        directory = Path(settings.PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(directory / name)
+        return name
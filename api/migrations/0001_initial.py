@@ -0,0 +1,62 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:08
+
+from decimal import Decimal
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Currency',
+            fields=[
+                ('currency_name', models.CharField(db_column='Nazwa', max_length=15, primary_key=True, serialize=False)),
+            ],
+            options={
+                'db_table': 'Waluta',
+            },
+        ),
+        migrations.CreateModel(
+            name='Expense',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', models.DecimalField(db_column='Cała kwota wydatku', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('to_settle', models.DecimalField(db_column='Do rozliczenia', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('settled', models.DecimalField(db_column='Rozliczono', decimal_places=2, default=Decimal('0'), max_digits=16, validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('vat', models.BooleanField(db_column='Czy VAT?')),
+                ('is_settled', models.BooleanField(db_column='Czy spłacony?', default=False)),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Wydatek',
+            },
+        ),
+        migrations.CreateModel(
+            name='Transfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_vat', models.BooleanField(db_column='Przelew VAT?', default=False)),
+                ('netto', models.DecimalField(db_column='Netto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('vat', models.DecimalField(db_column='VAT', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('brutto', models.DecimalField(db_column='Brutto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('sent_date', models.DateTimeField(db_column='Data przelewu')),
+                ('is_settled', models.BooleanField(db_column='Czy rozliczony?', default=False)),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('expense', models.ForeignKey(db_column='Wydatek', on_delete=django.db.models.deletion.CASCADE, to='api.expense')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Przelew',
+            },
+        ),
+    ]
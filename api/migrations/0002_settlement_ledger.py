@@ -0,0 +1,50 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SettlementEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('settle', 'Rozliczenie'), ('unsettle', 'Cofnięcie rozliczenia')], db_column='Rodzaj', max_length=8)),
+                ('amount', models.DecimalField(db_column='Kwota', decimal_places=2, max_digits=16)),
+                ('created', models.DateTimeField(db_column='Data', default=django.utils.timezone.now)),
+                ('expense', models.ForeignKey(db_column='Wydatek', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='settlement_events', to='api.expense')),
+                ('transfer', models.ForeignKey(db_column='Przelew', db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.transfer')),
+            ],
+            options={
+                'db_table': 'Zdarzenie rozliczenia',
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('settled', models.DecimalField(db_column='Rozliczono', decimal_places=2, max_digits=16)),
+                ('created', models.DateTimeField(db_column='Data', default=django.utils.timezone.now)),
+                ('event', models.ForeignKey(db_column='Zdarzenie', db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.settlementevent')),
+                ('expense', models.ForeignKey(db_column='Wydatek', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='balance_snapshots', to='api.expense')),
+            ],
+            options={
+                'db_table': 'Stan rozliczenia',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='settlementevent',
+            index=models.Index(fields=['expense', 'created'], name='ledger_expense_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['expense', 'created'], name='snapshot_expense_created_idx'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:14
+
+import api.fields
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations
+from django.db.models import F
+from django.db.models.functions import Round
+
+
+AMOUNT_FIELDS = {
+    'Expense': ['total_amount', 'to_settle', 'settled'],
+    'Transfer': ['netto', 'vat', 'brutto'],
+    'SettlementEvent': ['amount'],
+    'BalanceSnapshot': ['settled'],
+}
+
+
+def to_minor_units(apps, schema_editor):
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        model.objects.update(**{
+            field: Round(F(field) * 100) for field in fields
+        })
+
+
+def to_major_units(apps, schema_editor):
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        model.objects.update(**{
+            field: F(field) / 100.0 for field in fields
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_settlement_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_minor_units, to_major_units),
+        migrations.AlterField(
+            model_name='balancesnapshot',
+            name='settled',
+            field=api.fields.MoneyField(db_column='Rozliczono', decimal_places=2, max_digits=16),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='settled',
+            field=api.fields.MoneyField(db_column='Rozliczono', decimal_places=2, default=Decimal('0'), max_digits=16, validators=[django.core.validators.MinValueValidator(0.0)]),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='to_settle',
+            field=api.fields.MoneyField(db_column='Do rozliczenia', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='total_amount',
+            field=api.fields.MoneyField(db_column='Cała kwota wydatku', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+        migrations.AlterField(
+            model_name='settlementevent',
+            name='amount',
+            field=api.fields.MoneyField(db_column='Kwota', decimal_places=2, max_digits=16),
+        ),
+        migrations.AlterField(
+            model_name='transfer',
+            name='brutto',
+            field=api.fields.MoneyField(db_column='Brutto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+        migrations.AlterField(
+            model_name='transfer',
+            name='netto',
+            field=api.fields.MoneyField(db_column='Netto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+        migrations.AlterField(
+            model_name='transfer',
+            name='vat',
+            field=api.fields.MoneyField(db_column='VAT', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+    ]
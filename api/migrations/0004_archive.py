@@ -0,0 +1,75 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:17
+
+import api.fields
+from decimal import Decimal
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0003_minor_unit_amounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedExpense',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', api.fields.MoneyField(db_column='Cała kwota wydatku', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('to_settle', api.fields.MoneyField(db_column='Do rozliczenia', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('settled', api.fields.MoneyField(db_column='Rozliczono', decimal_places=2, default=Decimal('0'), max_digits=16, validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('vat', models.BooleanField(db_column='Czy VAT?')),
+                ('is_settled', models.BooleanField(db_column='Czy spłacony?', default=False)),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Wydatek archiwum',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchiveTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(db_column='Miesiąc')),
+                ('expenses', models.PositiveIntegerField(db_column='Wydatki', default=0)),
+                ('settled', api.fields.MoneyField(db_column='Rozliczono', decimal_places=2, default=Decimal('0'), max_digits=16)),
+                ('transfers', models.PositiveIntegerField(db_column='Przelewy', default=0)),
+                ('brutto', api.fields.MoneyField(db_column='Brutto', decimal_places=2, default=Decimal('0'), max_digits=16)),
+                ('vat_transfers', models.PositiveIntegerField(db_column='Przelewy VAT', default=0)),
+                ('vat_brutto', api.fields.MoneyField(db_column='Brutto VAT', decimal_places=2, default=Decimal('0'), max_digits=16)),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Podsumowanie archiwum',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_vat', models.BooleanField(db_column='Przelew VAT?', default=False)),
+                ('netto', api.fields.MoneyField(db_column='Netto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('vat', api.fields.MoneyField(db_column='VAT', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('brutto', api.fields.MoneyField(db_column='Brutto', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('sent_date', models.DateTimeField(db_column='Data przelewu')),
+                ('is_settled', models.BooleanField(db_column='Czy rozliczony?', default=False)),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('expense', models.ForeignKey(db_column='Wydatek', on_delete=django.db.models.deletion.CASCADE, to='api.archivedexpense')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Przelew archiwum',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivetotal',
+            constraint=models.UniqueConstraint(fields=('owner', 'currency', 'month'), name='archive_total_unique_month'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedtransfer',
+            name='expense',
+            field=models.ForeignKey(db_column='Wydatek', on_delete=django.db.models.deletion.CASCADE, related_name='transfers', to='api.archivedexpense'),
+        ),
+        migrations.AlterField(
+            model_name='transfer',
+            name='expense',
+            field=models.ForeignKey(db_column='Wydatek', on_delete=django.db.models.deletion.CASCADE, related_name='transfers', to='api.expense'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_transfer_related_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'currency', 'is_settled'], name='expense_owner_currency_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'vat', 'is_settled'], name='expense_owner_vat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'is_settled', 'to_settle'], name='expense_owner_settled_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'to_settle'], name='expense_owner_to_settle_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'expense', 'is_settled'], name='transfer_owner_expense_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'currency', 'sent_date'], name='transfer_owner_currency_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'is_vat', 'sent_date'], name='transfer_owner_vat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'is_settled', 'sent_date'], name='transfer_owner_settled_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'sent_date'], name='transfer_owner_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'brutto'], name='transfer_owner_brutto_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['sent_date'], name='transfer_date_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['is_settled', 'currency'], name='expense_settled_currency_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['is_settled', 'sent_date'], name='transfer_settled_date_idx'),
+        ),
+    ]
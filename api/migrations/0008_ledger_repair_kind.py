@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='settlementevent',
+            name='kind',
+            field=models.CharField(choices=[('settle', 'Rozliczenie'), ('unsettle', 'Cofnięcie rozliczenia'), ('repair', 'Korekta')], db_column='Rodzaj', max_length=8),
+        ),
+    ]
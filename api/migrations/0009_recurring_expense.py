@@ -0,0 +1,38 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:41
+
+import api.fields
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0008_ledger_repair_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringExpense',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', api.fields.MoneyField(db_column='Kwota', decimal_places=2, max_digits=16, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('vat', models.BooleanField(db_column='Czy VAT?')),
+                ('cadence', models.CharField(choices=[('weekly', 'Co tydzień'), ('monthly', 'Co miesiąc'), ('yearly', 'Co rok')], db_column='Okres', max_length=7)),
+                ('start_date', models.DateField(db_column='Data rozpoczęcia')),
+                ('next_run', models.DateField(db_column='Następny wydatek')),
+                ('currency', models.ForeignKey(db_column='Waluta', on_delete=django.db.models.deletion.CASCADE, to='api.currency')),
+                ('owner', models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'Wydatek cykliczny',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='recurringexpense',
+            index=models.Index(fields=['next_run', 'id'], name='recurring_next_run_idx'),
+        ),
+    ]
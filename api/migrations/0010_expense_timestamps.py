@@ -0,0 +1,70 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:47
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def first_and_last(model, field, using):
+    rows = (model.objects.using(using)
+            .filter(expense=OuterRef('pk'))
+            .order_by()
+            .values('expense'))
+    return (
+        Subquery(rows.annotate(first=models.Min(field)).values('first')),
+        Subquery(rows.annotate(last=models.Max(field)).values('last')),
+    )
+
+
+def backfill_timestamps(apps, schema_editor):
+    """
+    Sets 'created' of existing expenses to date of their first transfer
+    or ledger event and 'updated' to date of their last one. Expenses
+    without any keep date of the migration.
+    """
+
+    using = schema_editor.connection.alias
+    first_event, last_event = first_and_last(
+        apps.get_model('api', 'SettlementEvent'), 'created', using
+    )
+    for expense, transfer in (('Expense', 'Transfer'),
+                              ('ArchivedExpense', 'ArchivedTransfer')):
+        first_sent, last_sent = first_and_last(
+            apps.get_model('api', transfer), 'sent_date', using
+        )
+        apps.get_model('api', expense).objects.using(using).update(
+            created=Coalesce(first_sent, first_event, 'created'),
+            updated=Coalesce(last_event, last_sent, 'updated')
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_recurring_expense'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='created',
+            field=models.DateTimeField(db_column='Data utworzenia', default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='updated',
+            field=models.DateTimeField(db_column='Data modyfikacji', default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='expense',
+            name='created',
+            field=models.DateTimeField(db_column='Data utworzenia', default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='expense',
+            name='updated',
+            field=models.DateTimeField(db_column='Data modyfikacji', default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_timestamps, migrations.RunPython.noop),
+    ]
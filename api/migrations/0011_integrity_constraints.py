@@ -0,0 +1,151 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:50
+
+from django.db import migrations, models
+from django.db.models import Case, F, Q, Value, When
+import django.db.models.expressions
+
+CURRENCY_MISMATCH = 'transfer_currency_matches_expense'
+
+SQLITE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER {CURRENCY_MISMATCH}_insert BEFORE INSERT ON "Przelew"
+    WHEN NEW."Waluta" IS NOT
+        (SELECT "Waluta" FROM "Wydatek" WHERE "id" = NEW."Wydatek")
+    BEGIN SELECT RAISE(ABORT, '{CURRENCY_MISMATCH}'); END
+    """,
+    f"""
+    CREATE TRIGGER {CURRENCY_MISMATCH}_update
+    BEFORE UPDATE OF "Waluta", "Wydatek" ON "Przelew"
+    WHEN NEW."Waluta" IS NOT
+        (SELECT "Waluta" FROM "Wydatek" WHERE "id" = NEW."Wydatek")
+    BEGIN SELECT RAISE(ABORT, '{CURRENCY_MISMATCH}'); END
+    """,
+    f"""
+    CREATE TRIGGER {CURRENCY_MISMATCH}_expense
+    BEFORE UPDATE OF "Waluta" ON "Wydatek"
+    WHEN EXISTS (SELECT 1 FROM "Przelew" WHERE "Wydatek" = NEW."id"
+                 AND "Waluta" IS NOT NEW."Waluta")
+    BEGIN SELECT RAISE(ABORT, '{CURRENCY_MISMATCH}'); END
+    """,
+]
+
+POSTGRESQL_TRIGGERS = [
+    f"""
+    CREATE FUNCTION {CURRENCY_MISMATCH}() RETURNS trigger AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'Przelew' AND NEW."Waluta" IS DISTINCT FROM
+                (SELECT "Waluta" FROM "Wydatek" WHERE "id" = NEW."Wydatek")
+           OR TG_TABLE_NAME = 'Wydatek' AND EXISTS (
+                SELECT 1 FROM "Przelew" WHERE "Wydatek" = NEW."id"
+                AND "Waluta" IS DISTINCT FROM NEW."Waluta") THEN
+            RAISE EXCEPTION '{CURRENCY_MISMATCH}'
+                USING ERRCODE = 'check_violation';
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE TRIGGER {CURRENCY_MISMATCH}
+    BEFORE INSERT OR UPDATE OF "Waluta", "Wydatek" ON "Przelew"
+    FOR EACH ROW EXECUTE PROCEDURE {CURRENCY_MISMATCH}()
+    """,
+    f"""
+    CREATE TRIGGER {CURRENCY_MISMATCH}
+    BEFORE UPDATE OF "Waluta" ON "Wydatek"
+    FOR EACH ROW EXECUTE PROCEDURE {CURRENCY_MISMATCH}()
+    """,
+]
+
+DROP_TRIGGERS = {
+    'sqlite': [
+        f'DROP TRIGGER IF EXISTS {CURRENCY_MISMATCH}_{name}'
+        for name in ('insert', 'update', 'expense')
+    ],
+    'postgresql': [
+        f'DROP TRIGGER IF EXISTS {CURRENCY_MISMATCH} ON "Przelew"',
+        f'DROP TRIGGER IF EXISTS {CURRENCY_MISMATCH} ON "Wydatek"',
+        f'DROP FUNCTION IF EXISTS {CURRENCY_MISMATCH}()',
+    ],
+}
+
+
+def check_rows(apps, schema_editor):
+    """
+    Recounts 'to_settle' and 'is_settled' of expenses from 'settled',
+    the same way Expense.save does. Stops the migration when rows break
+    rules which can not be fixed automatically.
+    """
+
+    using = schema_editor.connection.alias
+    Expense = apps.get_model('api', 'Expense')
+    Transfer = apps.get_model('api', 'Transfer')
+    overpaid = list(Expense.objects.using(using).filter(
+        Q(settled__lt=0) | Q(settled__gt=F('total_amount'))
+    ).values_list('id', flat=True)[:20])
+    unbalanced = list(Transfer.objects.using(using).exclude(
+        brutto=F('netto') + F('vat')
+    ).values_list('id', flat=True)[:20])
+    mismatched = list(Transfer.objects.using(using).exclude(
+        currency=F('expense__currency')
+    ).values_list('id', flat=True)[:20])
+    if overpaid or unbalanced or mismatched:
+        raise RuntimeError(
+            f"Fix rows before adding integrity constraints, expenses with "
+            f"'settled' out of range: {overpaid}, transfers with wrong "
+            f"'brutto': {unbalanced}, transfers in other currency than "
+            f"their expense: {mismatched}."
+        )
+    Expense.objects.using(using).update(
+        to_settle=F('total_amount') - F('settled'),
+        is_settled=Case(
+            When(settled=F('total_amount'), then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField()
+        )
+    )
+
+
+def create_triggers(apps, schema_editor):
+    # Rows of Przelew have to be in currency of their Wydatek, which check
+    # constraints can not compare. SQLite drops triggers of rebuilt
+    # tables, migrations altering these tables have to create them again.
+    triggers = {
+        'sqlite': SQLITE_TRIGGERS,
+        'postgresql': POSTGRESQL_TRIGGERS,
+    }.get(schema_editor.connection.vendor, [])
+    for sql in triggers:
+        schema_editor.execute(sql, params=None)
+
+
+def drop_triggers(apps, schema_editor):
+    for sql in DROP_TRIGGERS.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_expense_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='expense',
+            constraint=models.CheckConstraint(check=models.Q(('settled__gte', 0), ('settled__lte', django.db.models.expressions.F('total_amount'))), name='expense_settled_within_total'),
+        ),
+        migrations.AddConstraint(
+            model_name='expense',
+            constraint=models.CheckConstraint(check=models.Q(to_settle=django.db.models.expressions.CombinedExpression(django.db.models.expressions.F('total_amount'), '-', django.db.models.expressions.F('settled'))), name='expense_to_settle_balance'),
+        ),
+        migrations.AddConstraint(
+            model_name='expense',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('is_settled', True), ('to_settle', 0)), models.Q(('is_settled', False), ('to_settle__gt', 0)), _connector='OR'), name='expense_is_settled_flag'),
+        ),
+        migrations.AddConstraint(
+            model_name='transfer',
+            constraint=models.CheckConstraint(check=models.Q(brutto=django.db.models.expressions.CombinedExpression(django.db.models.expressions.F('netto'), '+', django.db.models.expressions.F('vat'))), name='transfer_brutto_sum'),
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 3.1.2 on 2026-10-19 09:56
+
+from importlib import import_module
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+import django.utils.timezone
+
+integrity = import_module('api.migrations.0011_integrity_constraints')
+
+
+def backfill_updated(apps, schema_editor):
+    """
+    Sets 'updated' of existing transfers to date of their last ledger
+    event, or to 'sent_date' when they have none.
+    """
+
+    using = schema_editor.connection.alias
+    last_event = Subquery(
+        apps.get_model('api', 'SettlementEvent').objects.using(using)
+        .filter(transfer=OuterRef('pk'))
+        .order_by()
+        .values('transfer')
+        .annotate(last=models.Max('created'))
+        .values('last')
+    )
+    apps.get_model('api', 'Transfer').objects.using(using).update(
+        updated=Coalesce(last_event, 'sent_date')
+    )
+    apps.get_model('api', 'ArchivedTransfer').objects.using(using).update(
+        updated=F('sent_date')
+    )
+
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0011_integrity_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expense', 'Wydatek'), ('transfer', 'Przelew')], db_column='Rodzaj', max_length=8)),
+                ('object_id', models.BigIntegerField(db_column='Obiekt')),
+                ('deleted', models.DateTimeField(db_column='Data usunięcia', default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'Usunięty obiekt',
+            },
+        ),
+        migrations.AddField(
+            model_name='archivedtransfer',
+            name='updated',
+            field=models.DateTimeField(db_column='Data modyfikacji', default=django.utils.timezone.now),
+        ),
+        # SQLite rebuilds "Przelew" to add a field, currency triggers
+        # referring to it are dropped for the rebuild.
+        migrations.RunPython(integrity.drop_triggers,
+                             integrity.create_triggers),
+        migrations.AddField(
+            model_name='transfer',
+            name='updated',
+            field=models.DateTimeField(db_column='Data modyfikacji', default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(integrity.create_triggers,
+                             integrity.drop_triggers),
+        migrations.RunPython(backfill_updated, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['owner', 'updated', 'id'], name='expense_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['owner', 'updated', 'id'], name='transfer_owner_updated_idx'),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='owner',
+            field=models.ForeignKey(db_column='Użytkownik', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['owner', 'deleted', 'id'], name='tombstone_owner_deleted_idx'),
+        ),
+    ]
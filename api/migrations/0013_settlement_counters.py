@@ -0,0 +1,57 @@
+# Generated by Django 3.1.2 on 2026-10-19 10:00
+
+import api.fields
+from decimal import Decimal
+from importlib import import_module
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+integrity = import_module('api.migrations.0011_integrity_constraints')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_sync_tombstones'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedexpense',
+            name='counter_slots',
+            field=models.PositiveSmallIntegerField(db_column='Liczniki', default=0),
+        ),
+        # SQLite rebuilds "Wydatek" to add a field, currency triggers
+        # referring to it are dropped for the rebuild.
+        migrations.RunPython(integrity.drop_triggers,
+                             integrity.create_triggers),
+        migrations.AddField(
+            model_name='expense',
+            name='counter_slots',
+            field=models.PositiveSmallIntegerField(db_column='Liczniki', default=0),
+        ),
+        migrations.RunPython(integrity.create_triggers,
+                             integrity.drop_triggers),
+        migrations.CreateModel(
+            name='SettlementCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField(db_column='Numer')),
+                ('settled', api.fields.MoneyField(db_column='Rozliczono', decimal_places=2, default=Decimal('0'), max_digits=16)),
+                ('budget', api.fields.MoneyField(db_column='Limit', decimal_places=2, max_digits=16)),
+                ('expense', models.ForeignKey(db_column='Wydatek', on_delete=django.db.models.deletion.CASCADE, related_name='counters', to='api.expense')),
+            ],
+            options={
+                'db_table': 'Licznik rozliczenia',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='settlementcounter',
+            constraint=models.UniqueConstraint(fields=('expense', 'slot'), name='counter_expense_slot_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='settlementcounter',
+            constraint=models.CheckConstraint(check=models.Q(('settled__gte', 0), ('settled__lte', django.db.models.expressions.F('budget'))), name='counter_settled_within_budget'),
+        ),
+    ]
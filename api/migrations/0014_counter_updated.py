@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_settlement_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settlementcounter',
+            name='updated',
+            field=models.DateTimeField(db_column='Data modyfikacji', default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='settlementcounter',
+            index=models.Index(fields=['updated', 'id'], name='counter_updated_idx'),
+        ),
+    ]
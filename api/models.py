@@ -2,13 +2,56 @@
 Module providing model classes.
 """
 
+import random
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, timedelta
 from django.db import models
 from django.db import transaction, DatabaseError
+from django.db.models import (
+    Case, Count, F, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+)
+from django.db.models.functions import Coalesce, Now
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 from decimal import Decimal
+from api.fields import MoneyField
+from api import events
+from api import sharding
+from api.sharding import ShardedQuerySet
 
 # Create your models here.
 
+# Number of rows changed by one set-based UPDATE, keeps queries within
+# the limit of query parameters of SQLite.
+UPDATE_BATCH_SIZE = 400
+# Number of expenses created by one bulk INSERT of a billing run.
+BILLING_BATCH_SIZE = 500
+# Buckets of aging report, name and first and last day of age of
+# expenses, the last bucket has no upper limit.
+AGING_BUCKETS = [
+    ('days_0_30', 0, 30),
+    ('days_31_60', 31, 60),
+    ('days_61_90', 61, 90),
+    ('days_over_90', 91, None),
+]
+
+
+def batches(items, size=UPDATE_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def split_amount(amount, parts):
+    """
+    Splits amount into given number of parts differing by at most one
+    cent, larger parts first.
+    """
+
+    cents, rest = divmod(int(amount * 100), parts)
+    return [Decimal(cents + (part < rest)) / 100 for part in range(parts)]
+
 class Currency(models.Model):
     """
     Currency model class.
@@ -28,9 +71,425 @@ class Currency(models.Model):
         return self.currency_name
 
 
-class Expense(models.Model):
+class ExpenseQuerySet(ShardedQuerySet):
     """
-    Expense model class.
+    QuerySet of Expense and ArchivedExpense objects.
+    """
+    TRANSFER_TOTALS = (
+        'transfer_count',
+        'pending_brutto',
+        'settled_brutto',
+        'last_payment_date',
+    )
+    OLDEST = 'oldest'
+    SMALLEST = 'smallest'
+    LARGEST = 'largest'
+    ALLOCATION_ORDER = {
+        OLDEST: ['id'],
+        SMALLEST: ['to_settle', 'id'],
+        LARGEST: ['-to_settle', 'id'],
+    }
+
+    def with_transfer_totals(self):
+        """
+        Annotates every expense with values of its transfers:
+        transfer_count- number of transfers
+        pending_brutto- sum of 'brutto' of transfers not settled yet
+        settled_brutto- sum of 'brutto' of settled transfers
+        last_payment_date- 'sent_date' of the latest transfer
+        Values are aggregated in the same query as expenses.
+        """
+
+        zero = Value(0, output_field=MoneyField())
+        return self.annotate(
+            transfer_count=Count('transfers'),
+            pending_brutto=Coalesce(
+                Sum('transfers__brutto',
+                    filter=Q(transfers__is_settled=False)),
+                zero
+            ),
+            settled_brutto=Coalesce(
+                Sum('transfers__brutto',
+                    filter=Q(transfers__is_settled=True)),
+                zero
+            ),
+            last_payment_date=Max('transfers__sent_date')
+        )
+
+    def counter_sum(self):
+        """
+        Expression of sum of 'settled' of counters of expense, 0 for
+        expenses not in counter mode.
+        """
+
+        field = self.model._meta.get_field('settled')
+        counters = (SettlementCounter.objects
+                    .filter(expense=OuterRef('pk'))
+                    .order_by()
+                    .values('expense')
+                    .annotate(settled=Sum('settled'))
+                    .values('settled'))
+        return Coalesce(Subquery(counters, output_field=field),
+                        Value(0, output_field=field))
+
+    def with_counters(self):
+        """
+        Annotates every expense with 'counter_settled', amount settled
+        on its counters and not folded into the expense yet. Archived
+        expenses have no counters and get 0.
+        """
+
+        if self.model is not Expense:
+            field = self.model._meta.get_field('settled')
+            return self.annotate(
+                counter_settled=Value(0, output_field=field)
+            )
+        return self.annotate(counter_settled=self.counter_sum())
+
+    def counted(self, name):
+        """
+        Expression of 'settled' or 'to_settle' of expense with amounts
+        settled on its counters and not folded yet, the values expense
+        gets from the next fold.
+        """
+
+        if self.model is not Expense:
+            return F(name)
+        if name == 'settled':
+            return F('settled') + self.counter_sum()
+        return F('to_settle') - self.counter_sum()
+
+    def has_counters(self):
+        """
+        Checks if database of the queryset has any expense in counter
+        mode.
+        """
+
+        return (self.model is Expense
+                and SettlementCounter.objects.using(self.db).exists())
+
+    def filter_counted(self, is_settled=None, to_settle_min=None,
+                       to_settle_max=None, counters=True):
+        """
+        Filters expenses by 'is_settled' and range of 'to_settle' counted
+        with amounts settled on counters, see counted. Expenses not in
+        counter mode are compared on their columns, so indexes can be
+        used, expenses in counter mode are found through their counters.
+        With counters false only the columns are compared, which lets
+        database use the best index, e.g. when has_counters is false.
+        """
+
+        field = self.model._meta.get_field('to_settle')
+        rows = Q()
+        in_counters = Q(id__in=SettlementCounter.objects.values('expense'))
+        if is_settled is not None:
+            rows &= Q(is_settled__in=[is_settled])
+            settled = Q(to_settle=self.counter_sum())
+            in_counters &= settled if is_settled else ~settled
+        if to_settle_min is not None:
+            rows &= Q(to_settle__gte=to_settle_min)
+            in_counters &= Q(to_settle__gte=Value(
+                to_settle_min, output_field=field
+            ) + self.counter_sum())
+        if to_settle_max is not None:
+            rows &= Q(to_settle__lte=to_settle_max)
+            in_counters &= Q(to_settle__lte=Value(
+                to_settle_max, output_field=field
+            ) + self.counter_sum())
+        if self.model is not Expense or not counters:
+            return self.filter(rows)
+        return self.filter((Q(counter_slots=0) & rows) | in_counters)
+
+    def allocation_candidates(self, currency, is_vat, strategy=OLDEST):
+        """
+        Unsettled expenses in given currency, which can be paid with VAT
+        transfer when is_vat is true or with any transfer otherwise,
+        ordered by strategy:
+        'oldest'- oldest expenses first
+        'smallest'- expenses with least 'to_settle' first
+        'largest'- expenses with most 'to_settle' first
+        Expenses are annotated with 'pending_brutto', sum of 'brutto' of
+        their transfers not settled yet and of 'settled' of their
+        counters not folded yet, and are locked for update.
+        """
+
+        field = self.model._meta.get_field('to_settle')
+        pending = (Transfer.objects
+                   .filter(expense=OuterRef('pk'), is_settled__in=[False])
+                   .order_by()
+                   .values('expense')
+                   .annotate(brutto=Sum('brutto'))
+                   .values('brutto'))
+        expenses = self.filter(currency=currency, is_settled__in=[False])
+        if is_vat:
+            expenses = expenses.filter(vat__in=[True])
+        return (expenses
+                .annotate(pending_brutto=Coalesce(
+                    Subquery(pending, output_field=field),
+                    Value(0, output_field=field)
+                ) + self.counter_sum())
+                .select_for_update()
+                .order_by(*self.ALLOCATION_ORDER[strategy]))
+
+    def aging(self, by_owner=False, now=None):
+        """
+        Outstanding 'to_settle' of unsettled expenses per currency, or
+        per owner and currency, split by age of expenses into buckets
+        of AGING_BUCKETS. All buckets are summed by one query with
+        conditional aggregation. Amounts settled on counters are
+        counted in, see counted. Rows have values:
+        owner- id of owner, only when by_owner is true
+        currency- name of currency
+        expenses- number of unsettled expenses
+        total- sum of 'to_settle'
+        days_0_30, days_31_60, days_61_90, days_over_90- sums of
+            'to_settle' of expenses created that many days ago
+        oldest- 'created' of the oldest unsettled expense
+        """
+
+        now = now or timezone.now()
+        field = self.model._meta.get_field('to_settle')
+        zero = Value(0, output_field=field)
+        to_settle = self.counted('to_settle')
+        buckets = {}
+        for name, first_day, last_day in AGING_BUCKETS:
+            age = Q(created__lte=now - timedelta(days=first_day))
+            if last_day is not None:
+                age &= Q(created__gt=now - timedelta(days=last_day + 1))
+            buckets[name] = Coalesce(Sum(to_settle, filter=age), zero)
+        keys = ['owner', 'currency'] if by_owner else ['currency']
+        return (self.filter_counted(is_settled=False)
+                .order_by()
+                .values(*keys)
+                .annotate(
+                    expenses=Count('id'),
+                    total=Sum(to_settle),
+                    oldest=Min('created'),
+                    **buckets
+                ))
+
+    def bill(self, owner_ids, currency, total_amount, vat,
+             batch_size=BILLING_BATCH_SIZE):
+        """
+        Creates the same expense for every given owner with bulk
+        inserts of batch_size rows, in one transaction per database.
+        Returns number of created expenses.
+        owner_ids- iterable of ids of users charged with the expense
+        """
+
+        shards = defaultdict(list)
+        for owner_id in owner_ids:
+            alias = (self._db or sharding.shard_for_owner(owner_id)
+                     if sharding.enabled() else self.db)
+            shards[alias].append(owner_id)
+
+        created = 0
+        for alias, ids in shards.items():
+            with transaction.atomic(using=alias):
+                for batch in batches(ids, batch_size):
+                    created += len(self.using(alias).bulk_create(
+                        [self.model(
+                            currency_id=getattr(currency, 'pk', currency),
+                            total_amount=total_amount,
+                            to_settle=total_amount,
+                            settled=Decimal('0.00'),
+                            vat=vat,
+                            is_settled=False,
+                            owner_id=owner_id
+                        ) for owner_id in batch],
+                        batch_size=batch_size
+                    ))
+        return created
+
+    def delete(self):
+        """
+        Deletes expenses of the queryset together with their transfers
+        and saves tombstones of both in the same transaction. Archived
+        expenses are deleted without tombstones.
+        Returns the same as QuerySet.delete.
+        """
+
+        if self.model is not Expense:
+            return super().delete()
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with delete.")
+        if self._db is None and sharding.enabled():
+            return sharding.fan_out(self).delete()
+        with transaction.atomic(using=self.db):
+            Tombstone.record_expenses(
+                list(self.values_list('id', flat=True)), using=self.db
+            )
+            return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def add_to_settled(self, amounts):
+        """
+        Adds amounts to 'settled' values of expenses and counts their
+        'to_settle' and 'is_settled' values the same way Expense.save
+        does, with one UPDATE query per batch of expenses. 'updated' is
+        set to current date-time of the database.
+        Expenses in counter mode get amounts added to their counters
+        instead, see add_to_counter.
+        Returns number of updated expenses, database raises
+        IntegrityError when 'settled' would get out of range.
+        amounts- dict of expense id and amount to add, negative amounts
+            are subtracted
+        """
+
+        updated = 0
+        for ids in batches(amounts):
+            batch = {id: amounts[id] for id in ids}
+            rows = self.filter(counter_slots=0).add_to_rows(batch)
+            if rows < len(ids):
+                for id, slots in self.filter(
+                        id__in=ids, counter_slots__gt=0
+                ).values_list('id', 'counter_slots'):
+                    rows += self.add_to_counter(id, slots, amounts[id])
+            updated += rows
+        return updated
+
+    def add_to_rows(self, amounts):
+        """
+        Adds amounts to 'settled' values of expense rows with one UPDATE
+        query per batch, without counters, see add_to_settled.
+        """
+
+        field = self.model._meta.get_field('settled')
+        zero = Value(0, output_field=field)
+        updated = 0
+        for ids in batches(amounts):
+            amount = Case(
+                *[When(id=id, then=Value(amounts[id], output_field=field))
+                  for id in ids],
+                default=zero,
+                output_field=field
+            )
+            updated += self.filter(id__in=ids).update(
+                settled=F('settled') + amount,
+                to_settle=F('to_settle') - amount,
+                is_settled=Case(
+                    When(to_settle=amount, then=Value(True)),
+                    default=Value(False),
+                    output_field=models.BooleanField()
+                ),
+                updated=Now()
+            )
+        return updated
+
+    def add_to_counter(self, id, slots, amount):
+        """
+        Adds amount to one of counters of expense in counter mode,
+        chosen at random, so concurrent settlements do not wait for each
+        other. 'updated' of the counter is set, the expense row is not
+        touched. When amount does not fit in budget of the counter, the
+        expense is folded together with the amount, when the expense is
+        not in counter mode any more, the amount is added to its row.
+        Returns 1 when amount has been added, 0 when the expense does
+        not match the queryset.
+        """
+
+        field = SettlementCounter._meta.get_field('settled')
+        value = Value(amount, output_field=field)
+        if SettlementCounter.objects.using(self.db).filter(
+                expense_id=id,
+                slot=random.randrange(slots),
+                settled__gte=-amount,
+                settled__lte=F('budget') - value
+        ).update(settled=F('settled') + value, updated=Now()):
+            return 1
+        if self.fold({id: amount}):
+            return 1
+        # The expense left counter mode since 'counter_slots' was read.
+        return self.filter(counter_slots=0).add_to_rows({id: amount})
+
+    def fold(self, amounts=None):
+        """
+        Moves 'settled' of counters of expenses in counter mode into the
+        expense rows, adds given amounts to the rows the same way
+        add_to_settled does, and splits new 'to_settle' of every
+        expense into budgets of its counters again. Expenses and their
+        counters are locked for the time of the fold.
+        Returns number of expenses which got their amounts, or number
+        of folded expenses when amounts are not given.
+        amounts- dict of expense id and amount to add, when empty every
+            expense of the queryset is folded
+        """
+
+        if self._db is None and sharding.enabled():
+            return sum(self.using(alias).fold(amounts)
+                       for alias in sharding.shard_aliases())
+        expenses = self.model.objects.using(self.db)
+        with transaction.atomic(using=self.db):
+            locked = (expenses.filter(id__in=list(amounts)) if amounts
+                      else self)
+            ids = list(locked.filter(counter_slots__gt=0)
+                       .select_for_update()
+                       .order_by('id')
+                       .values_list('id', flat=True))
+            counters = SettlementCounter.objects.using(self.db).filter(
+                expense_id__in=ids
+            )
+            folded = defaultdict(Decimal)
+            for expense_id, settled in (counters.select_for_update()
+                                        .values_list('expense_id',
+                                                     'settled')):
+                folded[expense_id] += settled
+            expenses.add_to_rows(folded)
+            updated = len(ids)
+            if amounts:
+                updated = self.add_to_rows({
+                    id: amounts[id] for id in ids
+                })
+
+            counters.delete()
+            SettlementCounter.objects.using(self.db).bulk_create(
+                SettlementCounter(expense_id=id, slot=slot, budget=budget)
+                for id, to_settle, slots in (expenses.filter(id__in=ids)
+                                             .values_list('id', 'to_settle',
+                                                          'counter_slots'))
+                for slot, budget in enumerate(split_amount(to_settle, slots))
+            )
+            if amounts:
+                return updated
+            for expense in (expenses.filter(
+                    id__in=[id for id in ids if folded[id]],
+                    is_settled=True
+            ).only('id', 'owner_id', 'settled')):
+                events.publish(
+                    expense.owner_id, 'expense.settled', using=self.db,
+                    id=expense.id, settled=expense.settled
+                )
+        return updated
+
+    def use_counters(self, slots):
+        """
+        Turns counter mode of expenses on, with given number of
+        counters, or off, with 0 slots. Counters are folded into
+        expenses first.
+        Returns number of changed expenses.
+        """
+
+        if self._db is None and sharding.enabled():
+            return sum(self.using(alias).use_counters(slots)
+                       for alias in sharding.shard_aliases())
+        with transaction.atomic(using=self.db):
+            self.fold()
+            ids = list(self.values_list('id', flat=True))
+            expenses = self.model.objects.using(self.db).filter(id__in=ids)
+            SettlementCounter.objects.using(self.db).filter(
+                expense_id__in=ids
+            ).delete()
+            changed = expenses.update(counter_slots=slots)
+            if slots:
+                expenses.fold()
+        return changed
+
+
+class BaseExpense(models.Model):
+    """
+    Abstract expense model class, shared by Expense and ArchivedExpense.
     Every expense object has fields:
     curreny- foreign key of Currency model object, its the currency in
         which expense has to be paid
@@ -43,25 +502,32 @@ class Expense(models.Model):
         has been paid off.
     owner- foreign key of User, provides user that the expense
         is imposed on.
+    created- date-time of creating the expense
+    updated- date-time of the last change of the expense
+    counter_slots- number of SettlementCounter rows of the expense, 0
+        when it's not in counter mode. In counter mode 'settled',
+        'to_settle' and 'is_settled' of the row do not include amounts
+        settled on counters until they are folded, see
+        ExpenseQuerySet.fold and with_counters.
     """
     currency = models.ForeignKey(
         Currency,
         db_column='Waluta',
         on_delete=models.CASCADE
     )
-    total_amount = models.DecimalField(
+    total_amount = MoneyField(
         db_column='Cała kwota wydatku',
         decimal_places=2,
         max_digits=16,
         validators=[MinValueValidator(0.01)]
     )
-    to_settle = models.DecimalField(
+    to_settle = MoneyField(
         db_column='Do rozliczenia',
         decimal_places=2,
         max_digits=16,
         validators=[MinValueValidator(0.01)]
     )
-    settled = models.DecimalField(
+    settled = MoneyField(
         db_column='Rozliczono',
         decimal_places=2,
         max_digits=16,
@@ -75,9 +541,75 @@ class Expense(models.Model):
         db_column='Użytkownik',
         on_delete=models.CASCADE
     )
+    created = models.DateTimeField(
+        db_column='Data utworzenia',
+        default=timezone.now
+    )
+    updated = models.DateTimeField(
+        db_column='Data modyfikacji',
+        default=timezone.now
+    )
+    counter_slots = models.PositiveSmallIntegerField(
+        db_column='Liczniki',
+        default=0
+    )
+
+    objects = ExpenseQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class Expense(BaseExpense):
+    """
+    Expense model class.
+    Holds expenses that are still in use, fully settled old expenses
+    are moved to ArchivedExpense.
+    """
 
     class Meta:
         db_table = "Wydatek"
+        indexes = [
+            models.Index(
+                fields=['owner', 'currency', 'is_settled'],
+                name='expense_owner_currency_idx'
+            ),
+            models.Index(
+                fields=['owner', 'vat', 'is_settled'],
+                name='expense_owner_vat_idx'
+            ),
+            models.Index(
+                fields=['owner', 'is_settled', 'to_settle'],
+                name='expense_owner_settled_idx'
+            ),
+            models.Index(
+                fields=['owner', 'to_settle'],
+                name='expense_owner_to_settle_idx'
+            ),
+            models.Index(
+                fields=['owner', 'updated', 'id'],
+                name='expense_owner_updated_idx'
+            ),
+            models.Index(
+                fields=['is_settled', 'currency'],
+                name='expense_settled_currency_idx'
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=Q(settled__gte=0, settled__lte=F('total_amount')),
+                name='expense_settled_within_total'
+            ),
+            models.CheckConstraint(
+                check=Q(to_settle=F('total_amount') - F('settled')),
+                name='expense_to_settle_balance'
+            ),
+            models.CheckConstraint(
+                check=(Q(is_settled=True, to_settle=0)
+                       | Q(is_settled=False, to_settle__gt=0)),
+                name='expense_is_settled_flag'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         """
@@ -87,8 +619,20 @@ class Expense(models.Model):
 
         self.count_to_settle()
         self.manage_is_settled()
+        self.updated = timezone.now()
         super(Expense, self).save(*args, **kwargs)
 
+    def delete(self, *args, **kwargs):
+        """
+        Overrides delete method, saves tombstones of the expense and its
+        transfers, which are deleted with it, in the same transaction.
+        """
+
+        using = self._state.db
+        with transaction.atomic(using=using):
+            Tombstone.record_expenses([self.id], using=using)
+            return super(Expense, self).delete(*args, **kwargs)
+
     def count_to_settle(self):
         """
         Counts new 'to_settle' value.
@@ -116,6 +660,29 @@ class Expense(models.Model):
         else:
             self.is_settled = False
 
+    def settled_at(self, at=None):
+        """
+        Rebuilds 'settled' value from the settlement ledger.
+        Starts from the latest balance snapshot taken not later than
+        'at' and adds every ledger event recorded after it.
+        Without 'at' returns the current balance.
+        """
+
+        snapshots = self.balance_snapshots.all()
+        events = self.settlement_events.all()
+        if at is not None:
+            snapshots = snapshots.filter(created__lte=at)
+            events = events.filter(created__lte=at)
+
+        snapshot = snapshots.order_by('-created', '-id').first()
+        settled = Decimal('0.00')
+        if snapshot is not None:
+            settled = snapshot.settled
+            events = events.filter(id__gt=snapshot.event_id or 0)
+
+        return settled + (events.aggregate(Sum('amount'))['amount__sum']
+                          or Decimal('0.00'))
+
     def __str__(self):
         """
         Returns string represenatation of Expense objest.
@@ -130,40 +697,39 @@ class Expense(models.Model):
                 + str(self.owner))
 
 
-class Transfer(models.Model):
+class BaseTransfer(models.Model):
     """
-    Transfer model class.
-    Every Transfer object has fields:
+    Abstract transfer model class, shared by Transfer and
+    ArchivedTransfer.
+    Every transfer object has fields:
     is_vat- boolean field, indicates if its VAT transfer
     netto- netto value of transfer
     vat- VAT value of transfer
     brutto- Sum of netto and vat
     currency- foreign key of Currency object, indicates currency of
         paid amount
-    expense- foreign key of Expense object, indicates for which expense
-        the transfer has been sent
     settled_date- date-time field, its the date and time of transfer
         being settled.
     is_settled- boolean field, True value means that transfer has
         been settled
     owner- foreign key of user object, provides user that made the
         transfer
-
+    updated- date-time of the last change of the transfer
     """
     is_vat = models.BooleanField(db_column='Przelew VAT?', default=False)
-    netto = models.DecimalField(
+    netto = MoneyField(
         db_column='Netto',
         decimal_places=2,
         max_digits=16,
         validators=[MinValueValidator(0.01)]
     )
-    vat = models.DecimalField(
+    vat = MoneyField(
         db_column='VAT',
         decimal_places=2,
         max_digits=16,
         validators=[MinValueValidator(0.01)]
     )
-    brutto = models.DecimalField(
+    brutto = MoneyField(
         db_column='Brutto',
         decimal_places=2,
         max_digits=16,
@@ -173,11 +739,6 @@ class Transfer(models.Model):
         Currency,
         db_column='Waluta',
         on_delete=models.CASCADE)
-    expense = models.ForeignKey(
-        Expense,
-        db_column='Wydatek',
-        on_delete=models.CASCADE
-    )
     sent_date = models.DateTimeField(db_column='Data przelewu')
     is_settled = models.BooleanField(
         db_column='Czy rozliczony?',
@@ -188,32 +749,244 @@ class Transfer(models.Model):
         db_column='Użytkownik',
         on_delete=models.CASCADE
     )
+    updated = models.DateTimeField(
+        db_column='Data modyfikacji',
+        default=timezone.now
+    )
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class TransferQuerySet(ShardedQuerySet):
+    """
+    QuerySet of Transfer objects.
+    """
+
+    def settle(self):
+        """
+        Settles every not settled transfer of the queryset.
+        Returns number of settled transfers.
+        """
+
+        return self.change_settled(True)
+
+    def unsettle(self):
+        """
+        Reverts settlement of every settled transfer of the queryset.
+        Returns number of unsettled transfers.
+        """
+
+        return self.change_settled(False)
+
+    def delete(self):
+        """
+        Deletes transfers of the queryset. 'brutto' of settled ones is
+        subtracted from 'settled' of their expenses with set-based
+        updates, in the same transaction as the deletion, and recorded
+        in the settlement ledger. Deleted transfers get tombstones.
+        Returns the same as QuerySet.delete.
+        """
+
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with delete.")
+        if self._db is None and sharding.enabled():
+            return sharding.fan_out(self).delete()
+        with transaction.atomic(using=self.db):
+            transfers = list(
+                self.select_for_update()
+                .select_related(None)
+                .only('id', 'expense_id', 'brutto', 'owner_id', 'is_settled')
+            )
+            settled = [transfer for transfer in transfers
+                       if transfer.is_settled]
+            amounts = defaultdict(Decimal)
+            for transfer in settled:
+                amounts[transfer.expense_id] -= transfer.brutto
+            if (Expense.objects.using(self.db).add_to_settled(amounts)
+                    < len(amounts)):
+                raise DatabaseError(
+                    "Settled amounts of expenses have not been updated."
+                )
+            SettlementEvent.record_many(
+                settled, SettlementEvent.UNSETTLE, using=self.db
+            )
+            Tombstone.record_many(transfers, Tombstone.TRANSFER,
+                                  using=self.db)
+
+            deleted = 0
+            for ids in batches(transfer.id for transfer in transfers):
+                deleted += models.QuerySet.delete(
+                    self.model.objects.using(self.db).filter(id__in=ids)
+                )[0]
+            for transfer in transfers:
+                events.publish(
+                    transfer.owner_id, 'transfer.deleted', using=self.db,
+                    **events.transfer_data(transfer)
+                )
+        return deleted, {self.model._meta.label: deleted}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def change_settled(self, is_settled):
+        """
+        Changes 'is_settled' of transfers and 'settled' of their
+        expenses with set-based updates in one transaction, records
+        ledger events and publishes events of changed transfers.
+        Raises DatabaseError, and rolls back, when an expense has not
+        been updated.
+        """
+
+        if self._db is None and sharding.enabled():
+            return sum(self.using(alias).change_settled(is_settled)
+                       for alias in sharding.shard_aliases())
+        kind = (SettlementEvent.SETTLE if is_settled
+                else SettlementEvent.UNSETTLE)
+        with transaction.atomic(using=self.db):
+            transfers = list(
+                self.select_for_update()
+                .select_related(None)
+                .filter(is_settled=not is_settled)
+                .only('id', 'expense_id', 'brutto', 'owner_id', 'is_settled')
+            )
+            amounts = defaultdict(Decimal)
+            for transfer in transfers:
+                amounts[transfer.expense_id] += (
+                    transfer.brutto if is_settled else -transfer.brutto
+                )
+            if (Expense.objects.using(self.db).add_to_settled(amounts)
+                    < len(amounts)):
+                raise DatabaseError(
+                    "Settled amounts of expenses have not been updated."
+                )
+            for ids in batches(transfer.id for transfer in transfers):
+                self.model.objects.using(self.db).filter(
+                    id__in=ids
+                ).update(is_settled=is_settled, updated=Now())
+            SettlementEvent.record_many(transfers, kind, using=self.db)
+
+            for transfer in transfers:
+                transfer.is_settled = is_settled
+                events.publish(
+                    transfer.owner_id,
+                    'transfer.settled' if is_settled else 'transfer.unsettled',
+                    using=self.db,
+                    **events.transfer_data(transfer)
+                )
+            if is_settled:
+                for ids in batches(amounts):
+                    for expense in (Expense.objects.using(self.db)
+                                    .filter(id__in=ids, is_settled=True)
+                                    .only('id', 'owner_id', 'settled')):
+                        events.publish(
+                            expense.owner_id, 'expense.settled',
+                            using=self.db,
+                            id=expense.id, settled=expense.settled
+                        )
+        return len(transfers)
+
+
+class Transfer(BaseTransfer):
+    """
+    Transfer model class.
+    Holds transfers of expenses that are still in use.
+    expense- foreign key of Expense object, indicates for which expense
+        the transfer has been sent
+    """
+    expense = models.ForeignKey(
+        Expense,
+        db_column='Wydatek',
+        on_delete=models.CASCADE,
+        related_name='transfers'
+    )
+
+    objects = TransferQuerySet.as_manager()
+
     class Meta:
         db_table = "Przelew"
+        indexes = [
+            models.Index(
+                fields=['owner', 'expense', 'is_settled'],
+                name='transfer_owner_expense_idx'
+            ),
+            models.Index(
+                fields=['owner', 'currency', 'sent_date'],
+                name='transfer_owner_currency_idx'
+            ),
+            models.Index(
+                fields=['owner', 'is_vat', 'sent_date'],
+                name='transfer_owner_vat_idx'
+            ),
+            models.Index(
+                fields=['owner', 'is_settled', 'sent_date'],
+                name='transfer_owner_settled_idx'
+            ),
+            models.Index(
+                fields=['owner', 'sent_date'],
+                name='transfer_owner_date_idx'
+            ),
+            models.Index(
+                fields=['owner', 'brutto'],
+                name='transfer_owner_brutto_idx'
+            ),
+            models.Index(fields=['sent_date'], name='transfer_date_idx'),
+            models.Index(
+                fields=['is_settled', 'sent_date'],
+                name='transfer_settled_date_idx'
+            ),
+            models.Index(
+                fields=['owner', 'updated', 'id'],
+                name='transfer_owner_updated_idx'
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=Q(brutto=F('netto') + F('vat')),
+                name='transfer_brutto_sum'
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Overrides save method, sets 'updated' to current date-time.
+        """
+
+        self.updated = timezone.now()
+        super(Transfer, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         """
         Overrides delete method.
         If deleted transfer has "is_settled" on true:
-            Gets Expense object, that deleted transfer was for and
-            decreases its "settled" value by the amount of "brutto"
-            from that transfer.
-            Performes update on Expense object and deletes transfer object.
-
+            Decreases "settled" value of Expense object, that deleted
+            transfer was for, by the amount of "brutto" from that
+            transfer, with one UPDATE query, and deletes transfer object.
         else:
             Deletes transfer object.
+        Tombstone of the transfer is saved in the same transaction,
+        database errors are raised after it is rolled back.
         """
-        if self.is_settled:
-            expense = Expense.objects.get(id=self.expense.id)
-            expense.settled -= self.brutto
-            try:
-                with transaction.atomic():
-                    expense.save()
-                    super(Transfer, self).delete(*args, **kwargs)
-            except DatabaseError as de:
-                raise str(de)
-        else:
-            super(Transfer, self).delete(*args, **kwargs)
+        using = self._state.db
+        with transaction.atomic(using=using):
+            if self.is_settled:
+                if not Expense.objects.using(using).add_to_settled(
+                        {self.expense_id: -self.brutto}
+                ):
+                    raise DatabaseError(
+                        "Settled amount of expense has not been updated."
+                    )
+                SettlementEvent.record_many(
+                    [self], SettlementEvent.UNSETTLE, using=using
+                )
+            Tombstone.record_many([self], Tombstone.TRANSFER, using=using)
+            events.publish(
+                self.owner_id, 'transfer.deleted', using=using,
+                **events.transfer_data(self)
+            )
+            return super(Transfer, self).delete(*args, **kwargs)
 
     def __str__(self):
         """
@@ -227,3 +1000,490 @@ class Transfer(models.Model):
                 + " przelew "
                 + ("VAT " if self.is_vat else "") + "użytkownika "
                 + str(self.owner))
+
+
+class SettlementEvent(models.Model):
+    """
+    SettlementEvent model class.
+    Append-only ledger of changes of Expense 'settled' value.
+    Every SettlementEvent object has fields:
+    expense- Expense object which 'settled' value has changed
+    transfer- Transfer object that caused the change, empty for repairs
+    kind- 'settle' when transfer has been settled, 'unsettle' when
+        settled transfer has been unsettled or deleted, 'repair' when
+        'settled' value has been corrected by reconcile command
+    amount- signed change of expense 'settled' value
+    created- date-time of the change
+
+    Ledger rows are kept after their expense or transfer is deleted,
+    so foreign keys are not enforced by the database.
+    """
+    SETTLE = 'settle'
+    UNSETTLE = 'unsettle'
+    REPAIR = 'repair'
+    KIND_CHOICES = [
+        (SETTLE, 'Rozliczenie'),
+        (UNSETTLE, 'Cofnięcie rozliczenia'),
+        (REPAIR, 'Korekta'),
+    ]
+
+    expense = models.ForeignKey(
+        Expense,
+        db_column='Wydatek',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name='settlement_events'
+    )
+    transfer = models.ForeignKey(
+        Transfer,
+        db_column='Przelew',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name='+'
+    )
+    kind = models.CharField(
+        db_column='Rodzaj',
+        max_length=8,
+        choices=KIND_CHOICES
+    )
+    amount = MoneyField(
+        db_column='Kwota',
+        decimal_places=2,
+        max_digits=16
+    )
+    created = models.DateTimeField(db_column='Data', default=timezone.now)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Zdarzenie rozliczenia"
+        indexes = [
+            models.Index(
+                fields=['expense', 'created'],
+                name='ledger_expense_created_idx'
+            ),
+        ]
+
+    @classmethod
+    def record_many(cls, transfers, kind, using=None):
+        """
+        Appends ledger events for settling or unsettling many transfers
+        with one bulk insert.
+        """
+
+        return cls.objects.using(using).bulk_create(
+            cls(
+                expense_id=transfer.expense_id,
+                transfer=transfer,
+                kind=kind,
+                amount=(transfer.brutto if kind == cls.SETTLE
+                        else -transfer.brutto)
+            )
+            for transfer in transfers
+        )
+
+    @classmethod
+    def record(cls, expense, transfer, kind):
+        """
+        Appends ledger event for settling or unsettling transfer
+        on given expense.
+        """
+
+        amount = transfer.brutto if kind == cls.SETTLE else -transfer.brutto
+        return cls.objects.create(
+            expense=expense,
+            transfer=transfer,
+            kind=kind,
+            amount=amount
+        )
+
+    def save(self, *args, **kwargs):
+        """
+        Overrides save method, ledger events can not be changed.
+        """
+
+        if self.pk is not None:
+            raise DatabaseError("Settlement ledger is append-only.")
+        super(SettlementEvent, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """
+        Overrides delete method, ledger events can not be deleted.
+        """
+
+        raise DatabaseError("Settlement ledger is append-only.")
+
+
+class BalanceSnapshot(models.Model):
+    """
+    BalanceSnapshot model class.
+    Every BalanceSnapshot object has fields:
+    expense- Expense object which balance has been saved
+    event- last SettlementEvent included in the snapshot, empty if
+        there were no events yet
+    settled- Expense 'settled' value at the time of snapshot
+    created- date-time of the snapshot
+    """
+    expense = models.ForeignKey(
+        Expense,
+        db_column='Wydatek',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name='balance_snapshots'
+    )
+    event = models.ForeignKey(
+        SettlementEvent,
+        db_column='Zdarzenie',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name='+'
+    )
+    settled = MoneyField(
+        db_column='Rozliczono',
+        decimal_places=2,
+        max_digits=16
+    )
+    created = models.DateTimeField(db_column='Data', default=timezone.now)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Stan rozliczenia"
+        indexes = [
+            models.Index(
+                fields=['expense', 'created'],
+                name='snapshot_expense_created_idx'
+            ),
+        ]
+
+
+class Tombstone(models.Model):
+    """
+    Tombstone model class.
+    Record of deleted expense or transfer, read by sync endpoint, so
+    offline clients can remove their copies of deleted rows.
+    Every Tombstone object has fields:
+    kind- 'expense' or 'transfer', model of the deleted row
+    object_id- id of the deleted row
+    owner- foreign key of User, owner of the deleted row
+    deleted- date-time of the deletion
+    """
+    EXPENSE = 'expense'
+    TRANSFER = 'transfer'
+    KIND_CHOICES = [
+        (EXPENSE, 'Wydatek'),
+        (TRANSFER, 'Przelew'),
+    ]
+
+    kind = models.CharField(
+        db_column='Rodzaj',
+        max_length=8,
+        choices=KIND_CHOICES
+    )
+    object_id = models.BigIntegerField(db_column='Obiekt')
+    owner = models.ForeignKey(
+        'auth.User',
+        db_column='Użytkownik',
+        on_delete=models.CASCADE
+    )
+    deleted = models.DateTimeField(
+        db_column='Data usunięcia',
+        default=timezone.now
+    )
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Usunięty obiekt"
+        indexes = [
+            models.Index(
+                fields=['owner', 'deleted', 'id'],
+                name='tombstone_owner_deleted_idx'
+            ),
+        ]
+
+    @classmethod
+    def record_many(cls, rows, kind, using=None):
+        """
+        Saves tombstones of many deleted rows with one bulk insert.
+        """
+
+        deleted = timezone.now()
+        return cls.objects.using(using).bulk_create(
+            cls(kind=kind, object_id=row.id, owner_id=row.owner_id,
+                deleted=deleted)
+            for row in rows
+        )
+
+    @classmethod
+    def record_expenses(cls, ids, using=None):
+        """
+        Saves tombstones of expenses with given ids and of their
+        transfers, before they are deleted.
+        """
+
+        for batch in batches(ids):
+            cls.record_many(
+                Transfer.objects.using(using)
+                .filter(expense_id__in=batch).only('id', 'owner_id'),
+                cls.TRANSFER, using=using
+            )
+            cls.record_many(
+                Expense.objects.using(using)
+                .filter(id__in=batch).only('id', 'owner_id'),
+                cls.EXPENSE, using=using
+            )
+
+
+class SettlementCounter(models.Model):
+    """
+    SettlementCounter model class.
+    One of several rows collecting settlements of expense in counter
+    mode, so transfers of a heavily used expense are settled without
+    updating the same row. Sum of budgets of counters is 'to_settle' of
+    the expense row, so counters can not overpay the expense.
+    Every SettlementCounter object has fields:
+    expense- Expense object of the counter
+    slot- number of the counter, from 0 to 'counter_slots' - 1
+    settled- amount settled on the counter since the last fold
+    budget- amount which can be settled on the counter
+    updated- date-time of the last change of the counter, read by sync
+        instead of 'updated' of the expense, which counters do not touch
+    """
+    expense = models.ForeignKey(
+        Expense,
+        db_column='Wydatek',
+        on_delete=models.CASCADE,
+        related_name='counters'
+    )
+    slot = models.PositiveSmallIntegerField(db_column='Numer')
+    settled = MoneyField(
+        db_column='Rozliczono',
+        decimal_places=2,
+        max_digits=16,
+        default=Decimal(0.00)
+    )
+    budget = MoneyField(
+        db_column='Limit',
+        decimal_places=2,
+        max_digits=16
+    )
+    updated = models.DateTimeField(
+        db_column='Data modyfikacji',
+        default=timezone.now
+    )
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Licznik rozliczenia"
+        indexes = [
+            models.Index(
+                fields=['updated', 'id'],
+                name='counter_updated_idx'
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['expense', 'slot'],
+                name='counter_expense_slot_unique'
+            ),
+            models.CheckConstraint(
+                check=Q(settled__gte=0, settled__lte=F('budget')),
+                name='counter_settled_within_budget'
+            ),
+        ]
+
+
+class ArchivedExpense(BaseExpense):
+    """
+    ArchivedExpense model class.
+    Fully settled expense moved out of "Wydatek" table by
+    archive_settled command. Keeps id of the original expense.
+    """
+
+    class Meta:
+        db_table = "Wydatek archiwum"
+
+
+class ArchivedTransfer(BaseTransfer):
+    """
+    ArchivedTransfer model class.
+    Transfer of archived expense. Keeps id of the original transfer.
+    expense- foreign key of ArchivedExpense object
+    """
+    expense = models.ForeignKey(
+        ArchivedExpense,
+        db_column='Wydatek',
+        on_delete=models.CASCADE,
+        related_name='transfers'
+    )
+
+    class Meta:
+        db_table = "Przelew archiwum"
+
+
+class ArchiveTotal(models.Model):
+    """
+    ArchiveTotal model class.
+    Pre-summed values of archived expenses and transfers, so statistics
+    do not have to scan archive tables.
+    Every ArchiveTotal object has fields:
+    owner- foreign key of User, owner of archived rows
+    currency- foreign key of Currency object
+    month- first day of month of the archived rows, for expense it's the
+        month of its last transfer
+    expenses- number of archived expenses
+    settled- sum of 'settled' values of archived expenses
+    transfers- number of archived transfers
+    brutto- sum of 'brutto' values of archived transfers
+    vat_transfers- number of archived VAT transfers
+    vat_brutto- sum of 'brutto' values of archived VAT transfers
+    """
+    owner = models.ForeignKey(
+        'auth.User',
+        db_column='Użytkownik',
+        on_delete=models.CASCADE
+    )
+    currency = models.ForeignKey(
+        Currency,
+        db_column='Waluta',
+        on_delete=models.CASCADE
+    )
+    month = models.DateField(db_column='Miesiąc')
+    expenses = models.PositiveIntegerField(db_column='Wydatki', default=0)
+    settled = MoneyField(
+        db_column='Rozliczono',
+        decimal_places=2,
+        max_digits=16,
+        default=Decimal(0.00)
+    )
+    transfers = models.PositiveIntegerField(db_column='Przelewy', default=0)
+    brutto = MoneyField(
+        db_column='Brutto',
+        decimal_places=2,
+        max_digits=16,
+        default=Decimal(0.00)
+    )
+    vat_transfers = models.PositiveIntegerField(
+        db_column='Przelewy VAT',
+        default=0
+    )
+    vat_brutto = MoneyField(
+        db_column='Brutto VAT',
+        decimal_places=2,
+        max_digits=16,
+        default=Decimal(0.00)
+    )
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Podsumowanie archiwum"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'currency', 'month'],
+                name='archive_total_unique_month'
+            ),
+        ]
+
+
+class RecurringExpenseQuerySet(ShardedQuerySet):
+    """
+    QuerySet of RecurringExpense objects.
+    """
+
+    def due(self, on=None):
+        """
+        Schedules which next expense should be created on given date or
+        earlier, oldest first. Read with recurring_next_run_idx.
+        """
+
+        on = on or timezone.localdate()
+        return self.filter(next_run__lte=on).order_by('next_run', 'id')
+
+
+class RecurringExpense(models.Model):
+    """
+    RecurringExpense model class.
+    Schedule of expense created again every week, month or year by
+    generate_recurring command.
+    Every RecurringExpense object has fields:
+    owner- foreign key of User, the user charged with created expenses
+    currency- foreign key of Currency object
+    total_amount- 'total_amount' of created expenses
+    vat- 'vat' of created expenses
+    cadence- 'weekly', 'monthly' or 'yearly'
+    start_date- date of the first expense, monthly and yearly expenses
+        are created on its day of month, or on the last day of shorter
+        months
+    next_run- date of the next expense to create
+    """
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    YEARLY = 'yearly'
+    CADENCE_CHOICES = [
+        (WEEKLY, 'Co tydzień'),
+        (MONTHLY, 'Co miesiąc'),
+        (YEARLY, 'Co rok'),
+    ]
+
+    owner = models.ForeignKey(
+        'auth.User',
+        db_column='Użytkownik',
+        on_delete=models.CASCADE
+    )
+    currency = models.ForeignKey(
+        Currency,
+        db_column='Waluta',
+        on_delete=models.CASCADE
+    )
+    total_amount = MoneyField(
+        db_column='Kwota',
+        decimal_places=2,
+        max_digits=16,
+        validators=[MinValueValidator(0.01)]
+    )
+    vat = models.BooleanField(db_column='Czy VAT?')
+    cadence = models.CharField(
+        db_column='Okres',
+        max_length=7,
+        choices=CADENCE_CHOICES
+    )
+    start_date = models.DateField(db_column='Data rozpoczęcia')
+    next_run = models.DateField(db_column='Następny wydatek')
+
+    objects = RecurringExpenseQuerySet.as_manager()
+
+    class Meta:
+        db_table = "Wydatek cykliczny"
+        indexes = [
+            models.Index(
+                fields=['next_run', 'id'],
+                name='recurring_next_run_idx'
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.next_run is None:
+            self.next_run = self.start_date
+        super(RecurringExpense, self).save(*args, **kwargs)
+
+    def run_after(self, day):
+        """
+        Returns date of the run following run on given day.
+        """
+
+        if self.cadence == self.WEEKLY:
+            return day + timedelta(weeks=1)
+        months = 1 if self.cadence == self.MONTHLY else 12
+        month = day.month - 1 + months
+        year, month = day.year + month // 12, month % 12 + 1
+        return date(year, month,
+                    min(self.start_date.day, monthrange(year, month)[1]))
+
+    def __str__(self):
+        return (f"{self.owner} {self.total_amount} {self.currency} "
+                f"{self.get_cadence_display()}")
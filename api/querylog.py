@@ -0,0 +1,144 @@
+"""
+Module providing slow query log.
+
+SlowQueryLogMiddleware wraps execution of queries made during a request.
+Queries running longer than SLOW_QUERY_THRESHOLD_MS are logged to
+'api.slow_queries' logger as JSON lines, together with their EXPLAIN
+output, which settings send to a rotating file. Entries are grouped by
+slow_queries command.
+"""
+
+import json
+import logging
+import re
+import time
+import traceback
+from contextlib import ExitStack
+from pathlib import Path
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.utils import timezone
+
+logger = logging.getLogger('api.slow_queries')
+
+API_DIR = Path(__file__).resolve().parent
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')
+NOT_CALLERS = ('querylog.py', 'middleware.py', 'tests.py')
+
+
+def redact(params):
+    """
+    Replaces query parameters with names of their types.
+    """
+
+    if params is None:
+        return None
+    return [f'<{type(param).__name__}>' for param in params]
+
+
+def normalize(sql):
+    """
+    Returns shape of query, with literals and lists of placeholders
+    collapsed, so the same ORM call always gives the same shape.
+    """
+
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = sql.replace('%s', '?')
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def caller():
+    """
+    Returns innermost frame of api code, other than middleware and
+    tests, which made the query. None when query was made by DRF code, e.g. a list
+    page evaluated by paginator.
+    """
+
+    for frame in reversed(traceback.extract_stack()):
+        path = Path(frame.filename)
+        if API_DIR in path.parents and path.name not in NOT_CALLERS:
+            return (f"{path.relative_to(API_DIR.parent)}:{frame.lineno} "
+                    f"in {frame.name}")
+    return None
+
+
+class SlowQueryLogger:
+    """
+    Execute wrapper logging queries slower than threshold.
+    """
+
+    def __init__(self, request, threshold):
+        self.request = request
+        self.threshold = threshold
+        self.explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.explaining:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = (time.perf_counter() - start) * 1000
+        if duration >= self.threshold:
+            self.log(sql, params, many, context, duration)
+        return result
+
+    def log(self, sql, params, many, context, duration):
+        match = self.request.resolver_match
+        logger.warning(json.dumps({
+            'time': timezone.now().isoformat(),
+            'duration_ms': round(duration, 3),
+            'database': context['connection'].alias,
+            'view': match.view_name if match else None,
+            'method': self.request.method,
+            'path': self.request.path,
+            'caller': caller(),
+            'sql': sql,
+            'params': None if many else redact(params),
+            'explain': None if many else self.explain(
+                context['connection'], sql, params
+            ),
+        }))
+
+    def explain(self, connection, sql, params):
+        """
+        Returns rows of database's plan of the query, or None when it
+        can not be explained. Runs in a savepoint, so failed EXPLAIN does
+        not break transaction of the request.
+        """
+
+        if not sql.lstrip().upper().startswith(EXPLAINED):
+            return None
+        self.explaining = True
+        try:
+            with transaction.atomic(using=connection.alias), \
+                    connection.cursor() as cursor:
+                cursor.execute(
+                    f'{connection.ops.explain_query_prefix()} {sql}', params
+                )
+                return [' '.join(map(str, row)) for row in cursor.fetchall()]
+        except DatabaseError as error:
+            return [f'EXPLAIN failed: {error}']
+        finally:
+            self.explaining = False
+
+
+class SlowQueryLogMiddleware:
+    """
+    Logs slow queries of every database made during request.
+    Disabled when SLOW_QUERY_THRESHOLD_MS is None.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        threshold = getattr(settings, 'SLOW_QUERY_THRESHOLD_MS', None)
+        if threshold is None:
+            return self.get_response(request)
+        wrapper = SlowQueryLogger(request, threshold)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(wrapper))
+            return self.get_response(request)
@@ -0,0 +1,73 @@
+"""
+Module providing renderers and parsers of api responses and requests.
+"""
+
+from decimal import Decimal
+import msgpack
+import orjson
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+fallback_encoder = JSONEncoder()
+
+
+def encode_default(value):
+    """
+    Encodes values the fast encoders do not know. Decimal is checked
+    first and encoded as float, same as the DRF encoder does, other
+    types go to the DRF encoder.
+    """
+
+    if isinstance(value, Decimal):
+        return float(value)
+    return fallback_encoder.default(value)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer encoding with orjson. Dicts, lists, strings, numbers
+    and datetimes are encoded in C, only Decimal and rare types go
+    through encode_default.
+    Indented output, e.g. Accept: application/json; indent=4, is left
+    to JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        return orjson.dumps(data, default=encode_default,
+                            option=orjson.OPT_UTC_Z)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders responses as MessagePack, chosen by
+    Accept: application/msgpack header or ?format=msgpack.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default)
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parses request bodies sent with Content-Type: application/msgpack.
+    """
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.UnpackException) as error:
+            raise ParseError(f"MessagePack parse error - {error}")
@@ -3,13 +3,95 @@ Module providing Serializers
 """
 import pytz
 from datetime import datetime
+from decimal import Decimal
 from django.contrib.auth.models import User, Group
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from rest_framework import serializers, status
-from api.models import Expense, Transfer, Currency
+from api import events
+from api.models import (
+    Expense, Transfer, Currency, SettlementEvent, ExpenseQuerySet,
+    BILLING_BATCH_SIZE
+)
 
 
 
+def requested_fields(request):
+    """
+    Returns set of field names given in ?fields= parameter of GET
+    request, None when all fields should be returned.
+    """
+    if request is None or request.method != 'GET':
+        return None
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(',') if name.strip()}
+
+
+class SparseFieldsetMixin:
+    """
+    Serializer mixin returning only fields given in ?fields= parameter,
+    e.g. GET /transfers/?fields=id,brutto,is_settled
+    Unknown field names are ignored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+def requested_expansions(request):
+    """
+    Returns set of related field names given in ?expand= parameter of
+    GET request.
+    """
+    if request is None or request.method != 'GET':
+        return set()
+    expand = request.query_params.get('expand', '')
+    return {name.strip() for name in expand.split(',') if name.strip()}
+
+
+class ExpandableMixin:
+    """
+    Serializer mixin embedding related objects given in ?expand=
+    parameter in place of their ids, e.g.
+    GET /transfers/?expand=expense,owner
+    expandable_fields maps field names to functions returning serializer
+    of related object. Unknown names and fields left out by ?fields= are
+    ignored.
+    """
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in self.expanded_fields(self.context.get('request')):
+            if name in self.fields:
+                self.fields[name] = self.expandable_fields[name]()
+
+    @classmethod
+    def expanded_fields(cls, request):
+        """
+        Returns names of fields expanded for given request.
+        """
+        expanded = requested_expansions(request) & set(cls.expandable_fields)
+        requested = requested_fields(request)
+        if requested is not None:
+            expanded &= requested
+        return expanded
+
+
+class OwnerSerializer(serializers.ModelSerializer):
+    """
+    Serializer for owners embedded in expenses and transfers.
+    """
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'email']
+
+
 class UserSerializer(serializers.HyperlinkedModelSerializer):
     """
     Serializer for User model objects.
@@ -47,10 +129,31 @@ class GroupSerializer(serializers.ModelSerializer):
 
 
 
-class ExpenseSerializer(serializers.ModelSerializer):
+class ExpenseSerializer(ExpandableMixin, SparseFieldsetMixin,
+                        serializers.ModelSerializer):
     """
     Serializer for Expense model objects.
+    Transfer totals are present only for expenses fetched with
+    ExpenseQuerySet.with_transfer_totals().
+    Currency and owner can be expanded with ?expand=currency,owner
     """
+    expandable_fields = {
+        'currency': lambda: CurrencySerializer(read_only=True),
+        'owner': lambda: OwnerSerializer(read_only=True),
+    }
+    transfer_count = serializers.IntegerField(read_only=True)
+    pending_brutto = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        read_only=True
+    )
+    settled_brutto = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        read_only=True
+    )
+    last_payment_date = serializers.DateTimeField(read_only=True)
+
     class Meta:
         model = Expense
         fields = [
@@ -61,18 +164,57 @@ class ExpenseSerializer(serializers.ModelSerializer):
             'settled',
             'vat',
             'is_settled',
-            'owner'
+            'owner',
+            'created',
+            'updated',
+            'transfer_count',
+            'pending_brutto',
+            'settled_brutto',
+            'last_payment_date'
         ]
-        read_only_fields = ['id', 'to_settle', 'settled', 'is_settled']
+        read_only_fields = ['id', 'to_settle', 'settled', 'is_settled',
+                            'created', 'updated']
 
     def create(self, validated_data):
         validated_data['to_settle'] = validated_data['total_amount']
         return Expense.objects.create(**validated_data)
 
-class TransferSerializer(serializers.ModelSerializer):
+    def to_representation(self, instance):
+        """
+        Adds amounts settled on counters, for expenses fetched with
+        ExpenseQuerySet.with_counters(), to balance of the expense.
+        """
+        data = super().to_representation(instance)
+        pending = getattr(instance, 'counter_settled', None)
+        if pending:
+            settled = instance.settled + pending
+            balance = {
+                'settled': settled,
+                'to_settle': instance.total_amount - settled,
+                'is_settled': settled == instance.total_amount,
+            }
+            for name, value in balance.items():
+                if name in data:
+                    data[name] = self.fields[name].to_representation(value)
+        return data
+
+class TransferSerializer(ExpandableMixin, SparseFieldsetMixin,
+                         serializers.ModelSerializer):
     """
     Serializer for Transfer model objects.
+    Expense of transfer is read together with its currency, in one
+    query. Expense, currency and owner can be expanded with
+    ?expand=expense,currency,owner
     """
+    expandable_fields = {
+        'expense': lambda: ExpenseSerializer(read_only=True),
+        'currency': lambda: CurrencySerializer(read_only=True),
+        'owner': lambda: OwnerSerializer(read_only=True),
+    }
+    expense = serializers.PrimaryKeyRelatedField(
+        queryset=Expense.objects.select_related('currency')
+    )
+
     class Meta:
         model = Transfer
         fields = [
@@ -85,9 +227,11 @@ class TransferSerializer(serializers.ModelSerializer):
             'is_vat',
             'sent_date',
             'is_settled',
-            'owner'
+            'owner',
+            'updated'
         ]
-        read_only_fields = ['id', 'is_settled', 'brutto', 'sent_date','owner']
+        read_only_fields = ['id', 'is_settled', 'brutto', 'sent_date','owner',
+                            'updated']
 
     def create(self, validated_data):
         """
@@ -100,24 +244,34 @@ class TransferSerializer(serializers.ModelSerializer):
         )
         validated_data['sent_date'] = datetime.now(pytz.utc)
         self.check_expense(validated_data)
-        return Transfer.objects.create(**validated_data)
+        try:
+            with transaction.atomic(
+                    using=validated_data['expense']._state.db):
+                transfer = Transfer.objects.create(**validated_data)
+        except IntegrityError:
+            res = serializers.ValidationError(
+                "Transfer does not match its expense."
+            )
+            res.status_code = status.HTTP_409_CONFLICT
+            raise res
+        events.publish(
+            transfer.owner_id, 'transfer.created', using=transfer._state.db,
+            **events.transfer_data(transfer)
+        )
+        return transfer
 
     def check_expense(self, data):
         """
         Checks provides functions for checking if expense matches the
         transfer.
-        Raises error if there is no expense for transfer.
-        """
-        expense = Expense.objects.get(id = data['expense'].id)
-        if expense:
-            self.check_if_user_is_owner(expense.owner_id, data['owner'].id)
-            self.check_if_expense_vat(expense.vat, data['is_vat'])
-            self.check_if_is_settled(expense.is_settled)
-            self.check_if_same_currency(expense.currency, data['currency'])
-        else:
-            raise serializers.ValidationError(
-                "There is no expense for this transfer."
-            )
+        Rules kept by the database, 'brutto' of transfer and currency
+        of transfer and its expense, are checked again by the insert.
+        """
+        expense = data['expense']
+        self.check_if_user_is_owner(expense.owner_id, data['owner'].id)
+        self.check_if_expense_vat(expense.vat, data['is_vat'])
+        self.check_if_is_settled(expense.is_settled)
+        self.check_if_same_currency(expense.currency, data['currency'])
 
     @staticmethod
     def check_if_user_is_owner(expense_owner, transfer_owner):
@@ -166,11 +320,13 @@ class TransferSerializer(serializers.ModelSerializer):
             res.status_code = status.HTTP_409_CONFLICT
             raise res
 
-class SettleTransferSerializer(serializers.ModelSerializer):
+class SettleTransferSerializer(ExpandableMixin, SparseFieldsetMixin,
+                               serializers.ModelSerializer):
     """
     Serializer for Transfer model objects.
     Used for admin settle transfer functionality.
     """
+    expandable_fields = TransferSerializer.expandable_fields
     class Meta:
         model = Transfer
         fields = [
@@ -198,18 +354,42 @@ class SettleTransferSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         """
         Overrides update method.
-        If transfers 'is_settled' is true:
-        updates expenses 'settled' value with 'brutto' from transfer.
-        Updates expense and transfer objects.
-        If false,
-        """
-        if validated_data['is_settled']:
-            expense = Expense.objects.get(id = instance.expense.id)
-            expense.settled += instance.brutto
-            with transaction.atomic():
-                expense.save()
-                return (super(SettleTransferSerializer,self)
-                            .update(instance, validated_data))
+        If not settled transfer gets 'is_settled' true:
+        adds 'brutto' from transfer to expenses 'settled' value with one
+        UPDATE query, which changes expense only when 'brutto' does not
+        exceed its 'to_settle', else raises error with 409 status.
+        Updates expense and transfer objects in one transaction.
+        """
+        if validated_data['is_settled'] and not instance.is_settled:
+            using = instance._state.db
+            with transaction.atomic(using=using):
+                expenses = Expense.objects.using(using)
+                if not expenses.filter(
+                        to_settle__gte=instance.brutto
+                ).add_to_settled({instance.expense_id: instance.brutto}):
+                    res = serializers.ValidationError(
+                        "Transfer exceeds amount left to settle."
+                    )
+                    res.status_code = status.HTTP_409_CONFLICT
+                    raise res
+                SettlementEvent.record_many(
+                    [instance], SettlementEvent.SETTLE, using=using
+                )
+                transfer = (super(SettleTransferSerializer,self)
+                                .update(instance, validated_data))
+                events.publish(
+                    transfer.owner_id, 'transfer.settled', using=using,
+                    **events.transfer_data(transfer)
+                )
+                expense = expenses.filter(
+                    id=instance.expense_id, is_settled=True
+                ).only('id', 'owner_id', 'settled').first()
+                if expense is not None:
+                    events.publish(
+                        expense.owner_id, 'expense.settled', using=using,
+                        id=expense.id, settled=expense.settled
+                    )
+                return transfer
 
         return (super(SettleTransferSerializer,self)
                     .update(instance, validated_data))
@@ -222,3 +402,235 @@ class CurrencySerializer(serializers.ModelSerializer):
     class Meta:
         model = Currency
         fields = '__all__'
+
+
+class BillingRunSerializer(serializers.Serializer):
+    """
+    Serializer for billing run, charging many users with the same
+    expense. Users are given by exactly one of:
+    users- list of user ids
+    group- name of group of users
+    all_users- true charges every active user
+    Only active users are charged.
+    """
+    users = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        min_length=1
+    )
+    group = serializers.SlugRelatedField(
+        slug_field='name',
+        queryset=Group.objects.all(),
+        required=False
+    )
+    all_users = serializers.BooleanField(default=False)
+    currency = serializers.PrimaryKeyRelatedField(
+        queryset=Currency.objects.all()
+    )
+    total_amount = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        min_value=Decimal('0.01')
+    )
+    vat = serializers.BooleanField()
+
+    def validate(self, data):
+        targets = [name for name in ('users', 'group') if name in data]
+        if data['all_users']:
+            targets.append('all_users')
+        if len(targets) != 1:
+            raise serializers.ValidationError(
+                "Give exactly one of 'users', 'group' or 'all_users'."
+            )
+        return data
+
+    def owner_ids(self):
+        """
+        Returns queryset of ids of users to charge.
+        """
+
+        data = self.validated_data
+        users = User.objects.filter(is_active=True)
+        if 'users' in data:
+            users = users.filter(id__in=data['users'])
+        elif 'group' in data:
+            users = users.filter(groups=data['group'])
+        return users.order_by('id').values_list('id', flat=True)
+
+    def save(self, batch_size=BILLING_BATCH_SIZE):
+        """
+        Creates expenses of the billing run, returns its summary.
+        """
+
+        data = self.validated_data
+        owner_ids = list(self.owner_ids())
+        created = Expense.objects.bill(
+            owner_ids, data['currency'], data['total_amount'], data['vat'],
+            batch_size=batch_size
+        )
+        summary = {
+            'created': created,
+            'currency': data['currency'].pk,
+            'total_amount': data['total_amount'],
+            'vat': data['vat'],
+            'billed_amount': data['total_amount'] * created,
+        }
+        if 'users' in data:
+            summary['skipped'] = sorted(set(data['users']) - set(owner_ids))
+        return summary
+
+
+class AllocationSerializer(serializers.Serializer):
+    """
+    Serializer for payment allocated across unsettled expenses of user.
+    amount- 'brutto' of the whole payment
+    currency- currency of the payment
+    is_vat- true for VAT payment, which can be allocated only to VAT
+        expenses
+    vat_rate- rate of VAT included in VAT payment
+    strategy- order of allocation, see
+        ExpenseQuerySet.allocation_candidates
+    """
+    amount = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2,
+        min_value=Decimal('0.01')
+    )
+    currency = serializers.PrimaryKeyRelatedField(
+        queryset=Currency.objects.all()
+    )
+    is_vat = serializers.BooleanField(default=False)
+    vat_rate = serializers.DecimalField(
+        max_digits=4,
+        decimal_places=2,
+        min_value=Decimal('0.01'),
+        default=Decimal('0.23')
+    )
+    strategy = serializers.ChoiceField(
+        choices=list(ExpenseQuerySet.ALLOCATION_ORDER),
+        default=ExpenseQuerySet.OLDEST
+    )
+
+    def save(self, owner):
+        """
+        Allocates payment to expenses of owner, each expense gets at most
+        its 'to_settle' reduced by its pending transfers. All transfers
+        are created with one bulk insert in one transaction.
+        Returns created transfers and unallocated rest of the payment.
+        Raises 409 error when no expense can take any part of payment.
+        """
+
+        data = self.validated_data
+        expenses = Expense.objects.for_owner(owner).allocation_candidates(
+            data['currency'], data['is_vat'], data['strategy']
+        )
+        sent_date = datetime.now(pytz.utc)
+        with transaction.atomic(using=expenses.db):
+            rest = data['amount']
+            transfers = []
+            for expense in expenses.iterator():
+                if not rest:
+                    break
+                brutto = min(rest, expense.to_settle - expense.pending_brutto)
+                if brutto <= 0:
+                    continue
+                rest -= brutto
+                vat = Decimal(0)
+                if data['is_vat']:
+                    vat = (brutto * data['vat_rate'] / (1 + data['vat_rate'])
+                           ).quantize(Decimal('0.01'))
+                transfers.append(Transfer(
+                    is_vat=data['is_vat'],
+                    netto=brutto - vat,
+                    vat=vat,
+                    brutto=brutto,
+                    currency=data['currency'],
+                    sent_date=sent_date,
+                    expense=expense,
+                    owner=owner
+                ))
+            if not transfers:
+                error = serializers.ValidationError(
+                    "There are no unsettled expenses for this payment."
+                )
+                error.status_code = status.HTTP_409_CONFLICT
+                raise error
+
+            Transfer.objects.using(expenses.db).bulk_create(transfers)
+            if transfers[0].pk is None:
+                transfers = list(
+                    Transfer.objects.using(expenses.db)
+                    .filter(owner=owner, sent_date=sent_date)
+                    .order_by('id')
+                )
+            for transfer in transfers:
+                events.publish(
+                    transfer.owner_id, 'transfer.created',
+                    using=expenses.db, **events.transfer_data(transfer)
+                )
+        return transfers, rest
+
+
+class AgingSerializer(serializers.Serializer):
+    """
+    Serializer for rows of aging report, see ExpenseQuerySet.aging.
+    """
+    owner = serializers.IntegerField(required=False)
+    currency = serializers.CharField()
+    expenses = serializers.IntegerField()
+    total = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2
+    )
+    days_0_30 = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2
+    )
+    days_31_60 = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2
+    )
+    days_61_90 = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2
+    )
+    days_over_90 = serializers.DecimalField(
+        max_digits=16,
+        decimal_places=2
+    )
+    oldest = serializers.DateTimeField()
+
+
+class TransferDeleteSerializer(serializers.Serializer):
+    """
+    Serializer for request body of bulk delete of transfers.
+    """
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        min_length=1,
+        max_length=1000
+    )
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    """
+    Serializer for single sub-request of batch request.
+    """
+    method = serializers.ChoiceField(
+        choices=['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
+    )
+    path = serializers.CharField()
+    body = serializers.JSONField(required=False, default=None)
+
+
+class BatchSerializer(serializers.Serializer):
+    """
+    Serializer for batch request body.
+    """
+    atomic = serializers.BooleanField(default=False)
+    requests = serializers.ListField(
+        child=BatchRequestSerializer(),
+        min_length=1,
+        max_length=50
+    )
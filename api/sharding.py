@@ -0,0 +1,372 @@
+"""
+Module providing owner-based sharding of expenses and transfers.
+
+When settings.SHARDS lists database aliases, expenses and transfers of
+every user, together with their ledger, snapshots, archive, recurring
+schedules, tombstones and settlement counters, are kept in one of those
+databases, chosen by shard_for_owner. Users and currencies are copied
+to every shard, so foreign keys keep working.
+Ids of sharded rows start at index of their shard shifted by ID_SHIFT
+bits, so they are unique across shards and the shard of a row is known
+from its id.
+With empty SHARDS everything stays in the 'default' database.
+"""
+
+import heapq
+import inspect
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, models, router
+from django.db.models import Count, Max, Min, Sum
+
+ID_SHIFT = 40
+SHARDED_MODELS = {
+    'expense', 'transfer', 'settlementevent', 'balancesnapshot',
+    'archivedexpense', 'archivedtransfer', 'archivetotal',
+    'recurringexpense', 'tombstone', 'settlementcounter',
+}
+MIRRORED_MODELS = {'auth.user', 'api.currency'}
+
+
+def enabled():
+    return bool(settings.SHARDS)
+
+
+def shard_aliases():
+    return list(settings.SHARDS) or [DEFAULT_DB_ALIAS]
+
+
+def shard_for_owner(owner_id):
+    shards = shard_aliases()
+    return shards[int(owner_id) % len(shards)]
+
+
+def shard_for_id(pk):
+    shards = shard_aliases()
+    return shards[min(int(pk) >> ID_SHIFT, len(shards) - 1)]
+
+
+def is_sharded(model):
+    return (model._meta.app_label == 'api'
+            and model._meta.model_name in SHARDED_MODELS)
+
+
+def is_mirrored(model):
+    return model._meta.label_lower in MIRRORED_MODELS
+
+
+def run_parallel(function, items, max_workers=None):
+    """
+    Calls function with every item in its own thread, at most
+    max_workers at once, returns results in order of items. Connections
+    opened by threads are closed. With one item or max_workers 1 items
+    are run one by one in the calling thread.
+    """
+
+    def call(item):
+        try:
+            return function(item)
+        finally:
+            connections.close_all()
+
+    items = list(items)
+    if len(items) == 1 or max_workers == 1:
+        return [function(item) for item in items]
+    workers = max_workers or len(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, items))
+
+
+class ShardRouter:
+    """
+    Routes rows of sharded models to the shard of their owner. Rows
+    without owner, like ledger events, follow the row they are created
+    for. Queries without instance go to 'default', views choose shards
+    with ShardedQuerySet.for_owner and fan_out.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if not enabled() or instance is None or not is_sharded(instance):
+            return None
+        owner_id = getattr(instance, 'owner_id', None)
+        if owner_id is not None:
+            return shard_for_owner(owner_id)
+        return instance._state.db
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and all(is_sharded(obj) or is_mirrored(obj)
+                             for obj in (obj1, obj2)):
+            return True
+        return None
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet of sharded models. Without database chosen with using(),
+    created rows go to the shard of their owner and get() by id reads
+    the shard given by the id.
+    """
+
+    def for_owner(self, user):
+        """
+        Rows of given user, read from the user's shard.
+        """
+
+        if enabled():
+            return self.using(shard_for_owner(user.pk)).filter(owner=user)
+        return self.filter(owner=user)
+
+    def across_shards(self):
+        """
+        Rows of every shard, see fan_out.
+        """
+
+        return fan_out(self)
+
+    def create(self, **kwargs):
+        if self._db is not None or not enabled():
+            return super().create(**kwargs)
+        instance = self.model(**kwargs)
+        instance.save(
+            force_insert=True,
+            using=router.db_for_write(self.model, instance=instance)
+        )
+        return instance
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None or not enabled():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        shards = defaultdict(list)
+        for obj in objs:
+            shards[router.db_for_write(self.model, instance=obj)].append(obj)
+        for alias, shard_objs in shards.items():
+            super(ShardedQuerySet, self.using(alias)).bulk_create(
+                shard_objs, *args, **kwargs
+            )
+        return objs
+
+    def get(self, *args, **kwargs):
+        pk = kwargs.get('pk', kwargs.get('id'))
+        if self._db is not None or not enabled() or pk is None:
+            return super().get(*args, **kwargs)
+        try:
+            alias = shard_for_id(pk)
+        except (TypeError, ValueError):
+            return super().get(*args, **kwargs)
+        return super(ShardedQuerySet, self.using(alias)).get(*args, **kwargs)
+
+
+class FanOut:
+    """
+    Queryset-like union of querysets of every shard, used by superuser
+    views.
+    Queryset methods are applied to querysets of every shard, FanOut
+    arguments are matched shard by shard. Counts and aggregates run on
+    all shards in parallel and are merged. Pages are merged by id, for
+    page ending at row N every shard reads its first N rows.
+    """
+    MERGE = {
+        Sum: lambda values: sum(values) if values else None,
+        Count: lambda values: sum(values) if values else 0,
+        Max: lambda values: max(values) if values else None,
+        Min: lambda values: min(values) if values else None,
+    }
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'querysets':
+            raise AttributeError(name)
+        attribute = getattr(self.querysets[0], name)
+        if not inspect.ismethod(attribute):
+            return attribute
+
+        def apply(*args, **kwargs):
+            results = []
+            for index, queryset in enumerate(self.querysets):
+                results.append(getattr(queryset, name)(*[
+                    arg.querysets[index] if isinstance(arg, FanOut) else arg
+                    for arg in args
+                ], **kwargs))
+            if not all(isinstance(result, models.QuerySet)
+                       for result in results):
+                raise TypeError(f"{name}() is not supported across shards.")
+            return FanOut(results)
+        return apply
+
+    def count(self):
+        return sum(run_parallel(lambda queryset: queryset.count(),
+                                self.querysets))
+
+    def exists(self):
+        return any(run_parallel(lambda queryset: queryset.exists(),
+                                self.querysets))
+
+    def delete(self):
+        deleted, rows = 0, Counter()
+        for queryset in self.querysets:
+            count, per_model = queryset.delete()
+            deleted += count
+            rows.update(per_model)
+        return deleted, dict(rows)
+
+    def aggregate(self, *args, **kwargs):
+        aggregates = dict(kwargs)
+        for arg in args:
+            aggregates[arg.default_alias] = arg
+        for alias, aggregate in aggregates.items():
+            if type(aggregate) not in self.MERGE:
+                raise TypeError(
+                    f"{type(aggregate).__name__} can not be merged "
+                    f"across shards."
+                )
+        results = run_parallel(
+            lambda queryset: queryset.aggregate(**aggregates), self.querysets
+        )
+        return {
+            alias: self.MERGE[type(aggregate)]([
+                result[alias] for result in results
+                if result[alias] is not None
+            ])
+            for alias, aggregate in aggregates.items()
+        }
+
+    def get(self, *args, **kwargs):
+        pk = kwargs.get('pk', kwargs.get('id'))
+        if pk is not None:
+            alias = shard_for_id(pk)
+            for queryset in self.querysets:
+                if queryset.db == alias:
+                    return queryset.get(*args, **kwargs)
+        found = sum(run_parallel(
+            lambda queryset: list(queryset.filter(*args, **kwargs)[:2]),
+            self.querysets
+        ), [])
+        if not found:
+            raise self.model.DoesNotExist(
+                f"{self.model._meta.object_name} matching query does "
+                f"not exist."
+            )
+        if len(found) > 1:
+            raise self.model.MultipleObjectsReturned(
+                f"get() returned more than one {self.model.__name__}."
+            )
+        return found[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        pk = self.model._meta.pk.attname
+        stop = key.stop
+        rows = run_parallel(
+            lambda queryset: list(queryset.order_by(pk)[:stop]),
+            self.querysets
+        )
+        return list(islice(
+            heapq.merge(*rows, key=lambda row: row.pk),
+            key.start, stop
+        ))
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __len__(self):
+        return self.count()
+
+
+def fan_out(queryset):
+    """
+    Runs queryset on every shard, returns FanOut when sharding is
+    enabled and queryset itself otherwise.
+    """
+
+    if enabled():
+        return FanOut([queryset.using(alias) for alias in shard_aliases()])
+    return queryset
+
+
+def mirror_saved(sender, instance, using, raw=False, **kwargs):
+    """
+    Copies users and currencies saved in 'default' to every shard.
+    """
+
+    if raw or not enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    values = {
+        field.attname: getattr(instance, field.attname)
+        for field in sender._meta.concrete_fields if not field.primary_key
+    }
+    for alias in shard_aliases():
+        if alias != DEFAULT_DB_ALIAS:
+            sender._base_manager.using(alias).update_or_create(
+                pk=instance.pk, defaults=values
+            )
+
+
+def mirror_deleted(sender, instance, using, **kwargs):
+    """
+    Deletes copies of users and currencies deleted from 'default'.
+    """
+
+    if not enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    for alias in shard_aliases():
+        if alias != DEFAULT_DB_ALIAS:
+            sender._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def prepare_shard(alias):
+    """
+    Moves id sequences of sharded tables of given shard to the start of
+    its id range. Called after every migration of a shard.
+    """
+
+    from django.apps import apps
+
+    base = shard_aliases().index(alias) << ID_SHIFT
+    connection = connections[alias]
+    if base == 0:
+        return
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        raise ImproperlyConfigured(
+            f"Sharding does not support {connection.vendor} databases."
+        )
+    with connection.cursor() as cursor:
+        for model in apps.get_app_config('api').get_models():
+            if not is_sharded(model):
+                continue
+            table = connection.ops.quote_name(model._meta.db_table)
+            column = model._meta.pk.column
+            cursor.execute(
+                f"SELECT COALESCE(MAX({connection.ops.quote_name(column)}), 0)"
+                f" FROM {table}"
+            )
+            if cursor.fetchone()[0] >= base:
+                continue
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence(%s, %s), %s)",
+                    [table, column, base]
+                )
+            else:
+                cursor.execute(
+                    "DELETE FROM sqlite_sequence WHERE name = %s",
+                    [model._meta.db_table]
+                )
+                cursor.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)",
+                    [model._meta.db_table, base]
+                )
+
+
+def prepare_migrated_shard(using, **kwargs):
+    if using in settings.SHARDS:
+        prepare_shard(using)
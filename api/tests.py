@@ -1,13 +1,37 @@
-import time, pytz
+import asyncio, gzip, json, os, shutil, tempfile, threading, time, pytz
+import msgpack
+from decimal import Decimal
+from io import StringIO
 from datetime import datetime
-from django.test import TestCase
-from django.contrib.auth.models import User
+from datetime import date, timedelta
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from django.db.models import Sum
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import (
     APITestCase, URLPatternsTestCase, APIRequestFactory, APIClient,
     force_authenticate
 )
 from rest_framework import status
-from api.models import Transfer, Expense, Currency
+from rest_framework.renderers import JSONRenderer
+from api.models import (
+    Transfer, Expense, Currency, SettlementEvent, BalanceSnapshot,
+    ArchivedExpense, ArchivedTransfer, ArchiveTotal, RecurringExpense,
+    Tombstone, SettlementCounter, ExpenseQuerySet
+)
+from .admin import EstimatedCountPaginator
+from .management.commands import reconcile
+from .events import Broadcaster, EventStreamApplication, broadcaster
+from .filters import ExpenseFilter, TransferFilter
+from .renderers import FastJSONRenderer
+from .views import DashboardView
+from . import sharding
 from .serializers import CurrencySerializer, ExpenseSerializer
 
 # Create your tests here.
@@ -58,8 +82,10 @@ class ExpenseModelTestCase(TestCase):
         self.assertEqual(updated_expense3.is_settled, True)
 
         updated_expense3.settled = 150
-        updated_expense3.save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            updated_expense3.save()
         updated_expense4 = Expense.objects.get(id=1)
+        self.assertEqual(updated_expense4.settled,100)
         self.assertEqual(updated_expense4.to_settle,0)
         self.assertEqual(updated_expense4.is_settled, True)
 
@@ -115,7 +141,7 @@ class TransferModelTestCase(TestCase):
             expense=self.expense,
             currency=self.currency,
             sent_date=datetime.now(pytz.utc),
-            is_settled=False,
+            is_settled=True,
             owner=self.user
         )
 
@@ -318,3 +344,2095 @@ class ExpenseListViewTestCase(APITestCase):
         self.client.force_login(self.user)
         response=self.client.get('/expenses/')
         self.assertEqual(response.status_code,status.HTTP_200_OK)
+
+
+class SettlementLedgerTestCase(APITestCase):
+    """
+    Tests settlement ledger and balance snapshots.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.expense = Expense.objects.create(
+            currency=self.currency,
+            total_amount=100,
+            to_settle=100,
+            vat=False,
+            owner=self.user
+        )
+        self.transfers = [
+            Transfer.objects.create(
+                netto=20,
+                vat=10,
+                brutto=30,
+                expense=self.expense,
+                currency=self.currency,
+                sent_date=datetime.now(pytz.utc),
+                owner=self.user
+            ) for _ in range(2)
+        ]
+
+    def settle(self, transfer):
+        self.client.force_login(self.superuser)
+        response = self.client.put(
+            f"/transfer/{transfer.id}", {"is_settled": True}
+        )
+        self.client.logout()
+        return response
+
+    def test_settle_and_delete_are_recorded(self):
+        self.settle(self.transfers[0])
+        self.settle(self.transfers[1])
+        self.client.force_login(self.user)
+        self.client.delete(f"/transfer/{self.transfers[0].id}")
+
+        events = SettlementEvent.objects.order_by('id')
+        self.assertEqual(
+            [(e.kind, e.amount) for e in events],
+            [('settle', 30), ('settle', 30), ('unsettle', -30)]
+        )
+        self.assertEqual(Expense.objects.get(id=self.expense.id).settled, 30)
+        self.assertEqual(self.expense.settled_at(), 30)
+
+    def test_rebuild_from_snapshot(self):
+        self.settle(self.transfers[0])
+        call_command('snapshot_balances', stdout=StringIO())
+        snapshot = BalanceSnapshot.objects.get()
+        self.assertEqual(snapshot.settled, 30)
+
+        self.settle(self.transfers[1])
+        self.assertEqual(self.expense.settled_at(), 60)
+        self.assertEqual(
+            self.expense.settled_at(snapshot.created + timedelta(microseconds=1)),
+            30
+        )
+        self.assertEqual(
+            self.expense.settled_at(snapshot.created - timedelta(days=1)),
+            0
+        )
+
+    def test_ledger_is_append_only(self):
+        self.settle(self.transfers[0])
+        event = SettlementEvent.objects.get()
+        with self.assertRaises(DatabaseError):
+            event.delete()
+
+    def test_balance_view(self):
+        self.settle(self.transfers[0])
+        self.client.force_login(self.superuser)
+        response = self.client.get(f"/expense/{self.expense.id}/balance")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['settled'], 30)
+        response = self.client.get(
+            f"/expense/{self.expense.id}/balance?at=yesterday"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(
+            f"/expense/{self.expense.id}/balance?at=2020-13-45T00:00:00"
+        )
+        self.assertEqual(response.data, {'at': 'Invalid date-time.'})
+
+
+class MoneyFieldTestCase(APITestCase):
+    """
+    Tests amounts stored as integer minor units.
+    """
+    def setUp(self):
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.expense = Expense.objects.create(
+            currency=self.currency,
+            total_amount=Decimal('100.10'),
+            to_settle=Decimal('100.10'),
+            vat=True,
+            owner=self.user
+        )
+        for netto in ('10.05', '20.10'):
+            Transfer.objects.create(
+                is_vat=True,
+                netto=netto,
+                vat='0.01',
+                brutto=Decimal(netto) + Decimal('0.01'),
+                expense=self.expense,
+                currency=self.currency,
+                sent_date=datetime(2020, 10, 5, tzinfo=pytz.utc),
+                owner=self.user
+            )
+
+    def test_stored_as_integer(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT "Cała kwota wydatku", "Do rozliczenia" FROM "Wydatek"'
+            )
+            self.assertEqual(cursor.fetchone(), (10010, 10010))
+        self.assertEqual(
+            Expense.objects.get(id=self.expense.id).total_amount,
+            Decimal('100.10')
+        )
+
+    def test_aggregates_and_lookups(self):
+        self.assertEqual(
+            Transfer.objects.aggregate(Sum('brutto'))['brutto__sum'],
+            Decimal('30.17')
+        )
+        self.assertEqual(
+            Transfer.objects.filter(brutto__gt=Decimal('10.06')).count(), 1
+        )
+
+    def test_api_exposes_two_decimal_places(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/transfers/')
+        self.assertEqual(
+            [row['brutto'] for row in response.data['results']],
+            ['10.06', '20.11']
+        )
+        response = self.client.get('/statystyki/')
+        self.assertEqual(
+            response.data[2],
+            {'Średnia wartość przelewu VAT w miesiącu Wrzesień 2020':
+                Decimal('15.09')}
+        )
+
+
+class BenchmarkAmountsTestCase(TransactionTestCase):
+    """
+    Tests benchmark_amounts command.
+    """
+    def test_command_runs(self):
+        out = StringIO()
+        call_command('benchmark_amounts', rows=10, page_size=5, repeat=1,
+                     stdout=out)
+        self.assertIn('DecimalTransfer', out.getvalue())
+        self.assertIn('MoneyTransfer', out.getvalue())
+
+
+class ArchiveTestCase(APITestCase):
+    """
+    Tests archive_settled command and reading archived rows.
+    """
+    def setUp(self):
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.old = self.create_expense(datetime(2020, 10, 2, tzinfo=pytz.utc))
+        self.new = self.create_expense(datetime.now(pytz.utc))
+        self.client.force_login(self.user)
+
+    def create_expense(self, sent_date):
+        expense = Expense.objects.create(
+            currency=self.currency,
+            total_amount=Decimal('30.00'),
+            to_settle=Decimal('30.00'),
+            settled=Decimal('30.00'),
+            vat=True,
+            owner=self.user
+        )
+        Transfer.objects.create(
+            is_vat=True,
+            netto=20,
+            vat=10,
+            brutto=30,
+            expense=expense,
+            currency=self.currency,
+            sent_date=sent_date,
+            is_settled=True,
+            owner=self.user
+        )
+        return expense
+
+    def archive(self):
+        call_command(
+            'archive_settled', before='2021-01-01', batch_size=1,
+            stdout=StringIO()
+        )
+
+    def test_archive_moves_old_settled_rows(self):
+        self.archive()
+        self.assertEqual(
+            list(Expense.objects.values_list('id', flat=True)), [self.new.id]
+        )
+        self.assertEqual(ArchivedExpense.objects.get().id, self.old.id)
+        self.assertEqual(ArchivedTransfer.objects.get().expense_id, self.old.id)
+        total = ArchiveTotal.objects.get()
+        self.assertEqual(
+            (total.month, total.expenses, total.settled, total.vat_transfers),
+            (date(2020, 10, 1), 1, 30, 1)
+        )
+
+    def test_lists_read_archive_only_on_request(self):
+        self.archive()
+        response = self.client.get('/expenses/')
+        self.assertEqual(response.data['count'], 1)
+        response = self.client.get('/expenses/?include_archived=true')
+        self.assertEqual(
+            [row['id'] for row in response.data['results']],
+            [self.old.id, self.new.id]
+        )
+        response = self.client.get(
+            '/transfers/?include_archived=true&is_settled=true'
+        )
+        self.assertEqual(response.data['count'], 2)
+
+    def test_statistics_include_archive_totals(self):
+        before = self.client.get('/statystyki/').data
+        self.archive()
+        self.assertEqual(self.client.get('/statystyki/').data, before)
+
+
+class ExpenseTransferTotalsTestCase(APITestCase):
+    """
+    Tests transfer totals annotated on expense listings.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.expenses = [
+            Expense.objects.create(
+                currency=self.currency,
+                total_amount=100,
+                to_settle=100,
+                vat=False,
+                owner=self.user
+            ) for _ in range(3)
+        ]
+        for is_settled, brutto, day in ((True, 30, 1), (False, 20, 2)):
+            Transfer.objects.create(
+                netto=brutto - 10,
+                vat=10,
+                brutto=brutto,
+                expense=self.expenses[0],
+                currency=self.currency,
+                sent_date=datetime(2020, 10, day, tzinfo=pytz.utc),
+                is_settled=is_settled,
+                owner=self.user
+            )
+
+    def test_list_contains_totals(self):
+        self.client.force_login(self.user)
+        # session, user, count and page
+        with self.assertNumQueries(4):
+            response = self.client.get('/expenses/')
+        first, second = response.data['results'][:2]
+        self.assertEqual(
+            (first['transfer_count'], first['pending_brutto'],
+             first['settled_brutto'], first['last_payment_date']),
+            (2, '20.00', '30.00', '2020-10-02T00:00:00Z')
+        )
+        self.assertEqual(
+            (second['transfer_count'], second['pending_brutto'],
+             second['last_payment_date']),
+            (0, '0.00', None)
+        )
+
+    def test_detail_contains_totals(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(f'/expense/{self.expenses[0].id}')
+        self.assertEqual(response.data['settled_brutto'], '30.00')
+
+
+class FilterIndexTestCase(TestCase):
+    """
+    Tests that every shipped combination of list filters is answered
+    with an index, not by scanning the table.
+    """
+    transfer_filters = [
+        ({'expense': '1'}, 'transfer_owner_expense_idx'),
+        ({'expense': '1', 'is_settled': 'true'}, 'transfer_owner_expense_idx'),
+        ({'currency': 'PLN'}, 'transfer_owner_currency_idx'),
+        ({'currency': 'PLN', 'sent_date_after': '2020-10-01'},
+            'transfer_owner_currency_idx'),
+        ({'is_vat': 'true'}, 'transfer_owner_vat_idx'),
+        ({'is_vat': 'true', 'sent_date_before': '2020-11-01'},
+            'transfer_owner_vat_idx'),
+        ({'is_settled': 'false'}, 'transfer_owner_settled_idx'),
+        ({'is_settled': 'false', 'sent_date_after': '2020-10-01'},
+            'transfer_owner_settled_idx'),
+        ({'sent_date_after': '2020-10-01', 'sent_date_before': '2020-11-01'},
+            'transfer_owner_date_idx'),
+        ({'brutto_min': '10', 'brutto_max': '100'},
+            'transfer_owner_brutto_idx'),
+    ]
+    expense_filters = [
+        ({'currency': 'PLN'}, 'expense_owner_currency_idx'),
+        ({'currency': 'PLN', 'is_settled': 'false'},
+            'expense_owner_currency_idx'),
+        ({'vat': 'true'}, 'expense_owner_vat_idx'),
+        ({'vat': 'true', 'is_settled': 'false'}, 'expense_owner_vat_idx'),
+        ({'is_settled': 'false'}, 'expense_owner_settled_idx'),
+        ({'is_settled': 'false', 'to_settle_min': '100'},
+            'expense_owner_settled_idx'),
+        ({'to_settle_min': '100', 'to_settle_max': '1000'},
+            'expense_owner_to_settle_idx'),
+    ]
+
+    def setUp(self):
+        self.user = User.objects.create(username='adam')
+
+    def assertUsesIndex(self, filterset, index):
+        self.assertTrue(filterset.is_valid(), filterset.errors)
+        plan = filterset.qs.explain()
+        self.assertIn(f'USING INDEX {index}', plan.replace('COVERING ', ''))
+
+    def test_transfer_filters(self):
+        for params, index in self.transfer_filters:
+            with self.subTest(params=params):
+                self.assertUsesIndex(TransferFilter(
+                    params, queryset=Transfer.objects.filter(owner=self.user)
+                ), index)
+
+    def test_expense_filters(self):
+        for params, index in self.expense_filters:
+            with self.subTest(params=params):
+                self.assertUsesIndex(ExpenseFilter(
+                    params, queryset=Expense.objects.filter(owner=self.user)
+                ), index)
+
+    def test_filtered_list(self):
+        currency = Currency.objects.create(currency_name='PLN')
+        for total_amount in (50, 500):
+            Expense.objects.create(
+                currency=currency,
+                total_amount=total_amount,
+                to_settle=total_amount,
+                vat=False,
+                owner=self.user
+            )
+        self.client.force_login(self.user)
+        response = self.client.get(
+            '/expenses/?currency=PLN&is_settled=false&to_settle_min=100'
+        )
+        self.assertEqual(
+            [row['to_settle'] for row in response.data['results']],
+            ['500.00']
+        )
+
+
+class EventStreamTestCase(TransactionTestCase):
+    """
+    Tests server-sent events about transfers and expenses.
+    """
+    client_class = APIClient
+
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.expense = Expense.objects.create(
+            currency=self.currency,
+            total_amount=30,
+            to_settle=30,
+            vat=True,
+            owner=self.user
+        )
+
+    def published_since(self, event_id):
+        return [(message[1], message[2]) for message in broadcaster.history
+                if message[0] > event_id]
+
+    def test_transfer_changes_are_published(self):
+        last_id = broadcaster.publish(0, 'test', {})
+        self.client.force_login(self.user)
+        response = self.client.post('/transfers/', {
+            'currency': 'PLN',
+            'is_vat': True,
+            'netto': '20',
+            'vat': '10',
+            'expense': self.expense.id,
+        })
+        transfer_id = response.data['id']
+        self.client.force_login(self.superuser)
+        self.client.put(f'/transfer/{transfer_id}', {'is_settled': True})
+        self.client.force_login(self.user)
+        self.client.delete(f'/transfer/{transfer_id}')
+
+        self.assertEqual(self.published_since(last_id), [
+            (self.user.id, 'transfer.created'),
+            (self.user.id, 'transfer.settled'),
+            (self.user.id, 'expense.settled'),
+            (self.user.id, 'transfer.deleted'),
+        ])
+
+    def run_stream(self, scope, feed, user_id=1, live=None):
+        sent = []
+
+        async def receive():
+            if live:
+                threading.Thread(target=feed.publish, args=live).start()
+            await asyncio.sleep(0.05)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = dict({'type': 'http', 'method': 'GET', 'path': '/events/',
+                      'headers': [], 'query_string': b''}, **scope)
+        with mock.patch.object(
+                EventStreamApplication, 'authenticate', return_value=user_id):
+            asyncio.run(EventStreamApplication(feed)(scope, receive, send))
+        return sent
+
+    def test_stream_resumes_after_last_event_id(self):
+        feed = Broadcaster()
+        first = feed.publish(1, 'transfer.created', {'id': 1})
+        feed.publish(1, 'transfer.settled', {'id': 1})
+        feed.publish(2, 'transfer.created', {'id': 2})
+
+        sent = self.run_stream(
+            {'headers': [(b'last-event-id', str(first).encode())]},
+            feed,
+            live=(1, 'expense.settled', {'id': 1})
+        )
+        self.assertEqual(sent[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in sent)
+        self.assertEqual(
+            body,
+            b'id: 2\nevent: transfer.settled\ndata: {"id": 1}\n\n'
+            b'id: 4\nevent: expense.settled\ndata: {"id": 1}\n\n'
+        )
+
+    def test_stream_sends_reset_when_events_are_lost(self):
+        feed = Broadcaster(history_size=1)
+        feed.publish(1, 'transfer.created', {'id': 1})
+        feed.publish(1, 'transfer.created', {'id': 2})
+        feed.publish(1, 'transfer.created', {'id': 3})
+        sent = self.run_stream({'query_string': b'last_event_id=1'}, feed)
+        self.assertEqual(sent[1]['body'], b'event: reset\ndata: {}\n\n')
+
+    def test_stream_requires_authentication(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/events/',
+                 'headers': [], 'query_string': b''}
+        asyncio.run(EventStreamApplication()(scope, None, send))
+        self.assertEqual(sent[0]['status'], 401)
+
+
+class BatchViewTestCase(APITestCase):
+    """
+    Tests BatchView.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+        Currency.objects.create(currency_name='PLN')
+        self.expense = {
+            'method': 'POST',
+            'path': '/expenses/',
+            'body': {'currency': 'PLN', 'total_amount': '100',
+                     'vat': False, 'owner': self.user.id}
+        }
+
+    def test_references_earlier_response(self):
+        self.client.force_login(self.superuser)
+        response = self.client.post('/batch/', {'requests': [
+            self.expense,
+            {'method': 'GET', 'path': '/expense/{{0.id}}'},
+            {'method': 'GET', 'path': '/expenses/?currency={{0.currency}}'},
+        ]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        created, detail, listing = response.data['responses']
+        self.assertEqual(created['status'], status.HTTP_201_CREATED)
+        self.assertEqual(detail['body']['id'], created['body']['id'])
+        self.assertEqual(listing['body']['count'], 1)
+
+    def test_atomic_batch_is_rolled_back(self):
+        self.client.force_login(self.superuser)
+        response = self.client.post('/batch/', {'atomic': True, 'requests': [
+            self.expense,
+            {'method': 'GET', 'path': '/expense/{{0.missing}}'},
+        ]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data['responses']), 2)
+        self.assertEqual(Expense.objects.count(), 0)
+
+    def test_sub_requests_keep_permissions(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/batch/', {'requests': [
+            self.expense,
+            {'method': 'POST', 'path': '/batch/', 'body': {}},
+        ]})
+        self.assertEqual(
+            [item['status'] for item in response.data['responses']],
+            [status.HTTP_403_FORBIDDEN, status.HTTP_404_NOT_FOUND]
+        )
+
+
+class SparseFieldsetTestCase(APITestCase):
+    """
+    Tests ?fields= parameter of expense and transfer views.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        currency = Currency.objects.create(currency_name='PLN')
+        self.expense = Expense.objects.create(
+            currency=currency,
+            total_amount=Decimal('100'),
+            vat=False,
+            owner=self.superuser
+        )
+        self.transfer = Transfer.objects.create(
+            is_vat=False,
+            netto=Decimal('10'),
+            vat=Decimal('0'),
+            brutto=Decimal('10'),
+            currency=currency,
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense=self.expense,
+            owner=self.superuser
+        )
+        self.client.force_login(self.superuser)
+
+    def test_list_loads_only_requested_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/transfers/', {'fields': 'id,brutto,is_settled'}
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(response.data['results'][0]),
+            {'id', 'brutto', 'is_settled'}
+        )
+        select = queries[-1]['sql']
+        self.assertIn('"Brutto"', select)
+        self.assertNotIn('"Data przelewu"', select)
+        self.assertNotIn('"Netto"', select)
+
+    def test_totals_are_computed_only_when_requested(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                f'/expense/{self.expense.id}', {'fields': 'id,to_settle'}
+            )
+        self.assertEqual(response.data,
+                         {'id': self.expense.id, 'to_settle': '100.00'})
+        self.assertNotIn('COUNT', queries[-1]['sql'])
+
+        response = self.client.get(
+            '/expenses/', {'fields': 'id,pending_brutto'}
+        )
+        self.assertEqual(response.data['results'][0]['pending_brutto'],
+                         '10.00')
+
+    def test_counter_mode_rows_are_loaded_in_one_query(self):
+        Expense.objects.filter(id=self.expense.id).use_counters(2)
+        Transfer.objects.filter(id=self.transfer.id).settle()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                f'/expense/{self.expense.id}', {'fields': 'id,to_settle'}
+            )
+        self.assertEqual(response.data,
+                         {'id': self.expense.id, 'to_settle': '90.00'})
+        self.assertEqual(len([query for query in queries
+                              if 'FROM "Wydatek"' in query['sql']]), 1)
+
+    def test_fields_are_ignored_when_writing(self):
+        response = self.client.post('/expenses/?fields=id', {
+            'currency': 'PLN', 'total_amount': '50', 'vat': False,
+            'owner': self.superuser.id
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn('to_settle', response.data)
+
+
+class RendererTestCase(APITestCase):
+    """
+    Tests response renderers, MessagePack parser and gzip middleware.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.client.force_login(self.superuser)
+
+    def test_fast_json_matches_default_renderer(self):
+        data = {'id': 1, 'brutto': Decimal('10.50'), 'name': 'zażółć',
+                'sent_date': datetime(2020, 10, 1, tzinfo=pytz.UTC)}
+        self.assertEqual(FastJSONRenderer().render(data),
+                         JSONRenderer().render(data))
+
+    def test_message_pack_request_and_response(self):
+        body = msgpack.packb({'currency': 'PLN', 'total_amount': '100',
+                              'vat': False, 'owner': self.superuser.id})
+        response = self.client.post(
+            '/expenses/', body, content_type='application/msgpack',
+            HTTP_ACCEPT='application/msgpack'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['to_settle'],
+                         '100.00')
+
+    def test_only_large_responses_are_compressed(self):
+        response = self.client.get('/currencies/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        Currency.objects.bulk_create(
+            Currency(currency_name=f'C{number:02}') for number in range(99)
+        )
+        with self.settings(GZIP_MIN_LENGTH=100):
+            response = self.client.get('/currencies/',
+                                       HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'C00', gzip.decompress(response.content))
+
+
+class ProfilingTestCase(APITestCase):
+    """
+    Tests ProfilingMiddleware and profile_summary command.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create_user(
+            password='12345',
+            username='adam',
+            email='adam@user.test'
+        )
+
+    def test_admin_profiles_request_with_header(self):
+        self.client.force_authenticate(self.superuser)
+        with self.settings(PROFILE_DIR=self.directory):
+            response = self.client.get('/currencies/', HTTP_X_PROFILE='1')
+        name = response['X-Profile-Id']
+        self.assertTrue(name.startswith('api.views.CurrencyListView-'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, name)))
+
+        output = StringIO()
+        call_command('profile_summary', dir=self.directory, stdout=output)
+        self.assertIn('1  api.views.CurrencyListView', output.getvalue())
+        self.assertIn('function calls', output.getvalue())
+
+    def test_header_of_other_users_is_ignored(self):
+        self.client.force_authenticate(self.user)
+        with self.settings(PROFILE_DIR=self.directory), \
+                mock.patch('cProfile.Profile') as profile:
+            response = self.client.get('/currencies/', HTTP_X_PROFILE='1')
+        profile.assert_not_called()
+        self.assertFalse(response.has_header('X-Profile-Id'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_sampled_requests_are_profiled(self):
+        with self.settings(PROFILE_DIR=self.directory,
+                           PROFILE_SAMPLE_RATE=1):
+            self.client.get('/currencies/')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+class SlowQueryLogTestCase(APITestCase):
+    """
+    Tests slow query log and slow_queries command.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.client.force_authenticate(self.superuser)
+
+    def test_slow_queries_are_logged_with_plan(self):
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=0), \
+                self.assertLogs('api.slow_queries') as logs:
+            self.client.get('/transfers/', {'currency': 'PLN'})
+        entries = [json.loads(record.getMessage()) for record in logs.records]
+        select = entries[-1]
+        self.assertEqual(select['view'], 'api.views.TransfersListView')
+        self.assertIn('"Przelew"', select['sql'])
+        self.assertEqual(select['params'], ['<str>'])
+        self.assertIsNone(select['caller'])
+        self.assertIn('SEARCH Przelew', select['explain'][0])
+
+    def test_caller_in_api_code_is_logged(self):
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=0), \
+                self.assertLogs('api.slow_queries') as logs:
+            self.client.get('/statystyki/')
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertRegex(entry['caller'], r'^api/views.py:\d+ in get$')
+
+    def test_queries_are_grouped_by_shape(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'slow.log')
+        with open(path, 'w', encoding='utf-8') as log:
+            for sql, duration in (
+                    ('SELECT * FROM "Przelew" WHERE "id" IN (%s, %s)', 300),
+                    ('SELECT * FROM "Przelew" WHERE "id" IN (%s)', 250),
+                    ('SELECT * FROM "Wydatek" WHERE "id" = 5', 210)):
+                log.write(json.dumps({
+                    'sql': sql, 'duration_ms': duration,
+                    'view': 'api.views.TransfersListView', 'caller': None,
+                    'explain': ['SCAN Przelew'],
+                }) + '\n')
+        output = StringIO()
+        call_command('slow_queries', file=path, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "2 queries, total 550.0 ms, max 300.0 ms")
+        self.assertEqual(lines[1],
+                         '  SELECT * FROM "Przelew" WHERE "id" IN (...)')
+        self.assertIn('  SELECT * FROM "Wydatek" WHERE "id" = ?', lines)
+
+
+class TransferAdminTestCase(TestCase):
+    """
+    Tests admin of transfers and set-based settling of transfers.
+    """
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        currency = Currency.objects.create(currency_name='PLN')
+        self.expenses = [
+            Expense.objects.create(
+                currency=currency,
+                total_amount=Decimal('30'),
+                vat=False,
+                owner=self.superuser
+            ) for _ in range(2)
+        ]
+        self.transfers = Transfer.objects.bulk_create(
+            Transfer(
+                is_vat=False,
+                netto=Decimal('10'),
+                vat=Decimal('0'),
+                brutto=Decimal('10'),
+                currency=currency,
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense,
+                owner=self.superuser
+            ) for expense in self.expenses for _ in range(3)
+        )
+        self.client.force_login(self.superuser)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/api/transfer/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'użytkownika', count=0)
+        self.assertFalse(any('COUNT(*)' in query['sql'] and 'WHERE' not in
+                             query['sql'] and '"Przelew"' in query['sql']
+                             for query in queries))
+        count = len(queries)
+
+        Transfer.objects.bulk_create(Transfer(
+            is_vat=False, netto=1, vat=0, brutto=1, currency_id='PLN',
+            sent_date=datetime(2020, 10, 2, tzinfo=pytz.UTC),
+            expense=self.expenses[0], owner=self.superuser
+        ) for _ in range(20))
+        with self.assertNumQueries(count):
+            self.client.get('/admin/api/transfer/?is_settled__exact=0')
+
+    def test_change_forms_do_not_edit_balances(self):
+        transfer = Transfer.objects.first()
+        url = f'/admin/api/transfer/{transfer.id}/change/'
+        response = self.client.get(url)
+        fields = response.context['adminform'].form.fields
+        self.assertFalse({'brutto', 'is_settled'} & set(fields))
+        self.client.post(url, {
+            'is_vat': '', 'netto': '12', 'vat': '1', 'brutto': '100',
+            'currency': 'PLN', 'sent_date_0': '2020-10-01',
+            'sent_date_1': '00:00:00', 'is_settled': 'on',
+            'owner': self.superuser.id, 'expense': transfer.expense_id
+        })
+        transfer.refresh_from_db()
+        self.assertEqual((transfer.brutto, transfer.is_settled),
+                         (Decimal('13.00'), False))
+
+        Transfer.objects.filter(id=transfer.id).settle()
+        response = self.client.get(url)
+        self.assertNotIn('netto', response.context['adminform'].form.fields)
+        response = self.client.get(
+            f'/admin/api/expense/{transfer.expense_id}/change/'
+        )
+        self.assertFalse(
+            {'settled', 'to_settle', 'is_settled', 'counter_slots'}
+            & set(response.context['adminform'].form.fields)
+        )
+
+    def test_settle_action_updates_balances(self):
+        selected = [transfer.id for transfer in Transfer.objects.all()
+                    if transfer.expense_id == self.expenses[0].id][:2]
+        selected.append(
+            Transfer.objects.filter(expense=self.expenses[1]).first().id
+        )
+        with self.assertNumQueries(10):
+            self.client.post('/admin/api/transfer/', {
+                'action': 'settle', '_selected_action': selected
+            })
+        first, second = (Expense.objects.get(id=expense.id)
+                         for expense in self.expenses)
+        self.assertEqual((first.settled, first.to_settle, first.is_settled),
+                         (Decimal('20.00'), Decimal('10.00'), False))
+        self.assertEqual(second.settled, Decimal('10.00'))
+        self.assertEqual(
+            SettlementEvent.objects.filter(kind=SettlementEvent.SETTLE)
+            .aggregate(Sum('amount'))['amount__sum'],
+            Decimal('30.00')
+        )
+
+        self.assertEqual(Transfer.objects.filter(
+            expense=self.expenses[0]).settle(), 1)
+        self.assertTrue(Expense.objects.get(id=first.id).is_settled)
+        self.assertEqual(Transfer.objects.all().unsettle(), 4)
+        first.refresh_from_db()
+        self.assertEqual((first.settled, first.to_settle, first.is_settled),
+                         (Decimal('0.00'), Decimal('30.00'), False))
+
+
+@skipUnless({'shard_0', 'shard_1'} <= set(settings.DATABASES),
+            "SHARD_DATABASES=shard_0,shard_1 is not set.")
+@override_settings(SHARDS=['shard_0', 'shard_1'])
+class ShardingTestCase(TransactionTestCase):
+    """
+    Tests owner-based sharding of expenses and transfers.
+    """
+    databases = '__all__'
+    reset_sequences = True
+    client_class = APIClient
+
+    def setUp(self):
+        for alias in sharding.shard_aliases():
+            sharding.prepare_shard(alias)
+        self.superuser = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.users = [
+            User.objects.create_user(username=f'user{number}',
+                                     password='12345')
+            for number in range(2)
+        ]
+        Currency.objects.create(currency_name='PLN')
+        self.client.force_authenticate(self.superuser)
+        self.expenses = [
+            self.client.post('/expenses/', {
+                'currency': 'PLN', 'total_amount': '100', 'vat': False,
+                'owner': user.id
+            }).data['id'] for user in self.users
+        ]
+
+    def test_rows_are_kept_in_shard_of_owner(self):
+        for user, expense_id in zip(self.users, self.expenses):
+            alias = sharding.shard_for_owner(user.id)
+            self.assertEqual(sharding.shard_for_id(expense_id), alias)
+            self.assertTrue(
+                Expense.objects.using(alias).filter(id=expense_id).exists()
+            )
+            self.assertTrue(User.objects.using(alias).filter(
+                username=user.username).exists())
+        self.assertEqual(Expense.objects.using('default').count(), 0)
+
+        user = self.users[1]
+        self.client.force_authenticate(user)
+        response = self.client.post('/transfers/', {
+            'netto': '39', 'vat': '1', 'currency': 'PLN',
+            'expense': self.expenses[1], 'is_vat': False
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get('/expenses/')
+        self.assertEqual([row['id'] for row in response.data['results']],
+                         [self.expenses[1]])
+
+        self.client.force_authenticate(self.superuser)
+        response = self.client.put(
+            f"/transfer/{Transfer.objects.using('shard_1').get().id}",
+            {'is_settled': True}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Expense.objects.get(id=self.expenses[1]).settled,
+                         Decimal('40.00'))
+        self.assertEqual(
+            SettlementEvent.objects.using('shard_1').get().amount,
+            Decimal('40.00')
+        )
+
+    def test_admin_lists_rows_of_shards(self):
+        self.client.force_login(self.superuser)
+        for alias, expense_id in zip(('shard_0', 'shard_1'), self.expenses):
+            response = self.client.get('/admin/api/expense/',
+                                       {'shard': alias})
+            self.assertEqual([expense.id for expense
+                              in response.context['cl'].result_list],
+                             [expense_id])
+            response = self.client.get(
+                f'/admin/api/expense/{expense_id}/change/'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        transfer = Transfer.objects.create(
+            is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+            brutto=Decimal('10'), currency_id='PLN',
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense_id=self.expenses[1], owner=self.users[1]
+        )
+        self.client.post('/admin/api/transfer/?shard=shard_1', {
+            'action': 'settle', '_selected_action': [transfer.id]
+        }, format='multipart')
+        self.assertEqual(Expense.objects.get(id=self.expenses[1]).settled,
+                         Decimal('10.00'))
+
+    def test_admin_count_ignores_shard_index_of_ids(self):
+        alias = sharding.shard_for_id(self.expenses[1])
+        self.assertEqual(alias, 'shard_1')
+        queryset = Expense.objects.using(alias).all()
+        self.assertEqual(EstimatedCountPaginator(queryset, 50).count, 1)
+
+    def test_events_wait_for_shard_commit(self):
+        transfer = Transfer.objects.create(
+            is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+            brutto=Decimal('10'), currency_id='PLN',
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense_id=self.expenses[1], owner=self.users[1]
+        )
+        alias = sharding.shard_for_owner(self.users[1].id)
+        last_id = broadcaster.publish(0, 'test', {})
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic(using=alias):
+                Transfer.objects.using(alias).filter(id=transfer.id).delete()
+                raise DatabaseError
+        self.assertEqual(
+            [message for message in broadcaster.history
+             if message[0] > last_id], []
+        )
+        Transfer.objects.using(alias).filter(id=transfer.id).delete()
+        self.assertEqual(broadcaster.history[-1][2], 'transfer.deleted')
+
+    def test_atomic_batch_is_rolled_back_on_shards(self):
+        self.client.force_authenticate(self.users[1])
+        response = self.client.post('/batch/', {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/transfers/', 'body': {
+                'netto': '10', 'vat': '1', 'currency': 'PLN',
+                'expense': self.expenses[1], 'is_vat': False
+            }},
+            {'method': 'GET', 'path': '/transfer/{{0.missing}}'},
+        ]})
+        self.assertEqual(response.data['responses'][0]['status'],
+                         status.HTTP_201_CREATED)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Transfer.objects.across_shards().exists())
+
+    def test_superuser_queries_fan_out(self):
+        response = self.client.get('/expenses/', {'page_size': 1})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            [row['id'] for row in response.data['results']],
+            sorted(self.expenses)
+        )
+        response = self.client.get(f'/expense/{self.expenses[1]}')
+        self.assertEqual(response.data['owner'], self.users[1].id)
+
+        for expense_id in self.expenses:
+            expense = Expense.objects.get(id=expense_id)
+            expense.settled = Decimal('100')
+            expense.save()
+        response = self.client.get('/statystyki/')
+        self.assertEqual(
+            response.data[0]['Suma wszystkich wydatków rozliczonych'],
+            Decimal('200.00')
+        )
+
+    def test_aging_report_merges_shards(self):
+        response = self.client.get('/aging/')
+        self.assertEqual(
+            [(row['currency'], row['expenses'], row['days_0_30'])
+             for row in response.data['results']],
+            [('PLN', 2, '200.00')]
+        )
+        response = self.client.get('/aging/?by=owner&top=1')
+        self.assertEqual(response.data['results'][0]['owner'],
+                         self.users[0].id)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['owner'],
+                         self.users[1].id)
+
+
+class ReconcileTestCase(TestCase):
+    """
+    Tests reconcile command.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        currency = Currency.objects.create(currency_name='PLN')
+        self.expenses = [
+            Expense.objects.create(
+                currency=currency,
+                total_amount=Decimal('50'),
+                vat=False,
+                owner=self.user
+            ) for _ in range(3)
+        ]
+        Transfer.objects.bulk_create(
+            Transfer(
+                is_vat=False,
+                netto=Decimal('25'),
+                vat=Decimal('0'),
+                brutto=Decimal('25'),
+                currency=currency,
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense,
+                owner=self.user
+            ) for expense in self.expenses for _ in range(2)
+        )
+        Transfer.objects.all().settle()
+
+    def reconcile(self, *args):
+        output = StringIO()
+        call_command('reconcile', '--chunk-size', '2', '--workers', '1',
+                     *args, stdout=output)
+        return output.getvalue()
+
+    def test_balanced_expenses(self):
+        output = self.reconcile()
+        self.assertIn('Checked 3 expenses in 2 chunks', output)
+        self.assertIn('Found 0 mismatched expenses.', output)
+
+    def test_drift_is_found_and_repaired(self):
+        drifted = self.expenses[1]
+        Expense.objects.filter(id=drifted.id).update(
+            settled=Decimal('20'), to_settle=Decimal('30'), is_settled=False
+        )
+        output = self.reconcile()
+        self.assertIn('Found 1 mismatched expenses.', output)
+        self.assertIn(f'expense {drifted.id}: settled 20.00, expected 50.00',
+                      output)
+
+        self.assertIn('repaired', self.reconcile('--repair'))
+        drifted.refresh_from_db()
+        self.assertEqual(
+            (drifted.settled, drifted.to_settle, drifted.is_settled),
+            (Decimal('50.00'), Decimal('0.00'), True)
+        )
+        self.assertEqual(
+            SettlementEvent.objects.get(kind=SettlementEvent.REPAIR).amount,
+            Decimal('30.00')
+        )
+        self.assertIn('Found 0 mismatched expenses.', self.reconcile())
+
+    def test_repair_writes_every_column(self):
+        drifted = self.expenses[0]
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA ignore_check_constraints = ON')
+            Expense.objects.filter(id=drifted.id).update(
+                to_settle=Decimal('10'), is_settled=False
+            )
+            cursor.execute('PRAGMA ignore_check_constraints = OFF')
+        self.assertIn('Found 1 mismatched expenses, repaired.',
+                      self.reconcile('--repair'))
+        drifted.refresh_from_db()
+        self.assertEqual((drifted.to_settle, drifted.is_settled),
+                         (Decimal('0.00'), True))
+        self.assertFalse(SettlementEvent.objects.filter(
+            kind=SettlementEvent.REPAIR).exists())
+
+    def test_repair_reads_balance_again(self):
+        drifted = self.expenses[1]
+        Expense.objects.filter(id=drifted.id).update(
+            settled=Decimal('20'), to_settle=Decimal('30'), is_settled=False
+        )
+        _, mismatches = reconcile.check_chunk('default', drifted.id,
+                                              drifted.id + 1, False)
+        self.assertEqual(len(mismatches), 1)
+        Expense.objects.filter(id=drifted.id).update(
+            settled=Decimal('50'), to_settle=Decimal('0'), is_settled=True
+        )
+        self.assertEqual(reconcile.repair_chunk('default', [drifted.id]), 0)
+        drifted.refresh_from_db()
+        self.assertEqual(drifted.settled, Decimal('50.00'))
+
+
+class TransferBulkDeleteTestCase(APITestCase):
+    """
+    Tests deleting many transfers at once.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        self.other = User.objects.create_user(username='ewa',
+                                              password='12345')
+        currency = Currency.objects.create(currency_name='PLN')
+        self.expense, self.others_expense = (
+            Expense.objects.create(
+                currency=currency,
+                total_amount=Decimal('30'),
+                vat=False,
+                owner=owner
+            ) for owner in (self.user, self.other)
+        )
+        Transfer.objects.bulk_create(
+            Transfer(
+                is_vat=False,
+                netto=Decimal('10'),
+                vat=Decimal('0'),
+                brutto=Decimal('10'),
+                currency=currency,
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense,
+                owner=expense.owner
+            ) for expense in (self.expense, self.others_expense)
+            for _ in range(3)
+        )
+        Transfer.objects.all().settle()
+        self.client.force_login(self.user)
+
+    def test_delete_by_ids_updates_balance(self):
+        ids = list(Transfer.objects.filter(expense=self.expense)
+                   .values_list('id', flat=True)[:2])
+        response = self.client.delete('/transfers/', {'ids': ids},
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'deleted': 2})
+        self.expense.refresh_from_db()
+        self.assertEqual(
+            (self.expense.settled, self.expense.to_settle,
+             self.expense.is_settled),
+            (Decimal('10.00'), Decimal('20.00'), False)
+        )
+        self.assertEqual(SettlementEvent.objects.filter(
+            expense=self.expense, kind=SettlementEvent.UNSETTLE
+        ).count(), 2)
+
+    def test_delete_by_filters_keeps_other_users_transfers(self):
+        others = list(Transfer.objects.filter(expense=self.others_expense)
+                      .values_list('id', flat=True))
+        response = self.client.delete(f'/transfers/?expense={self.expense.id}',
+                                      {'ids': others[:1]}, format='json')
+        self.assertEqual(response.data, {'deleted': 0})
+        response = self.client.delete('/transfers/?is_settled=true')
+        self.assertEqual(response.data, {'deleted': 3})
+        self.assertEqual(Transfer.objects.count(), 3)
+        self.others_expense.refresh_from_db()
+        self.assertTrue(self.others_expense.is_settled)
+
+    def test_delete_without_ids_or_filters(self):
+        response = self.client.delete('/transfers/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.delete('/transfers/', {'ids': []},
+                                      format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        for query in ('page=2', 'fields=id', 'expense=', 'brutto_min=',
+                      'sent_date_after=&is_settled='):
+            response = self.client.delete(f'/transfers/?{query}')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST, query)
+        self.assertEqual(Transfer.objects.count(), 6)
+
+    def test_queryset_delete_updates_balance(self):
+        deleted, rows = Transfer.objects.filter(
+            expense=self.others_expense
+        ).delete()
+        self.assertEqual((deleted, rows), (3, {'api.Transfer': 3}))
+        self.others_expense.refresh_from_db()
+        self.assertEqual(
+            (self.others_expense.settled, self.others_expense.to_settle),
+            (Decimal('0.00'), Decimal('30.00'))
+        )
+
+
+class BillingRunTestCase(APITestCase):
+    """
+    Tests billing run endpoint and command.
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.members = Group.objects.create(name='members')
+        self.users = [
+            User.objects.create_user(username=f'user{number}',
+                                     password='12345')
+            for number in range(5)
+        ]
+        self.members.user_set.add(*self.users[:3])
+        self.users[4].is_active = False
+        self.users[4].save()
+        Currency.objects.create(currency_name='PLN')
+        self.client.force_login(self.admin)
+
+    def test_bill_group(self):
+        with self.assertNumQueries(8):
+            response = self.client.post('/billing/', {
+                'group': 'members',
+                'currency': 'PLN',
+                'total_amount': '50.00',
+                'vat': False
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual(response.data['billed_amount'], '150.00')
+        expenses = Expense.objects.order_by('owner_id')
+        self.assertEqual(
+            [expense.owner_id for expense in expenses],
+            [user.id for user in self.users[:3]]
+        )
+        self.assertTrue(all(
+            (expense.to_settle, expense.settled, expense.is_settled)
+            == (Decimal('50.00'), Decimal('0.00'), False)
+            for expense in expenses
+        ))
+
+    def test_bill_users_skips_inactive(self):
+        ids = [self.users[3].id, self.users[4].id, 999]
+        response = self.client.post('/billing/', {
+            'users': ids,
+            'currency': 'PLN',
+            'total_amount': '10',
+            'vat': True
+        }, format='json')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['skipped'], ids[1:])
+
+    def test_invalid_runs(self):
+        body = {'currency': 'PLN', 'total_amount': '10', 'vat': False}
+        response = self.client.post('/billing/', body, format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/billing/', dict(
+            body, group='members', all_users=True
+        ), format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_login(self.users[0])
+        response = self.client.post('/billing/', dict(
+            body, all_users=True
+        ), format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Expense.objects.exists())
+
+    def test_command(self):
+        output = StringIO()
+        call_command('billing_run', '--all', '--currency', 'PLN',
+                     '--amount', '12.50', '--batch-size', '2',
+                     stdout=output)
+        self.assertIn('Created 5 expenses of 12.50 PLN, billed 62.50 PLN',
+                      output.getvalue())
+        self.assertEqual(Expense.objects.count(), 5)
+        with self.assertRaises(CommandError):
+            call_command('billing_run', '--group', 'nobody', '--currency',
+                         'PLN', '--amount', '1', stdout=StringIO())
+
+
+class RecurringExpenseTestCase(TestCase):
+    """
+    Tests recurring expense schedules and generate_recurring command.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        self.currency = Currency.objects.create(currency_name='PLN')
+
+    def schedule(self, cadence, start_date):
+        return RecurringExpense.objects.create(
+            owner=self.user,
+            currency=self.currency,
+            total_amount=Decimal('1200'),
+            vat=False,
+            cadence=cadence,
+            start_date=start_date
+        )
+
+    def generate(self, day):
+        output = StringIO()
+        call_command('generate_recurring', '--date', day,
+                     '--batch-size', '2', stdout=output)
+        return output.getvalue()
+
+    def test_run_after(self):
+        rent = self.schedule(RecurringExpense.MONTHLY, date(2020, 1, 31))
+        self.assertEqual(rent.run_after(date(2020, 1, 31)), date(2020, 2, 29))
+        self.assertEqual(rent.run_after(date(2020, 2, 29)), date(2020, 3, 31))
+        self.assertEqual(rent.run_after(date(2020, 12, 31)),
+                         date(2021, 1, 31))
+        fee = self.schedule(RecurringExpense.YEARLY, date(2020, 2, 29))
+        self.assertEqual(fee.run_after(date(2020, 2, 29)), date(2021, 2, 28))
+        weekly = self.schedule(RecurringExpense.WEEKLY, date(2020, 12, 28))
+        self.assertEqual(weekly.run_after(date(2020, 12, 28)),
+                         date(2021, 1, 4))
+
+    def test_generate_is_idempotent(self):
+        rent = self.schedule(RecurringExpense.MONTHLY, date(2020, 9, 30))
+        for _ in range(2):
+            self.schedule(RecurringExpense.WEEKLY, date(2020, 10, 20))
+        self.schedule(RecurringExpense.YEARLY, date(2021, 1, 1))
+
+        self.assertIn('Created 6 expenses from 3 schedules.',
+                      self.generate('2020-10-30'))
+        rent.refresh_from_db()
+        self.assertEqual(rent.next_run, date(2020, 11, 30))
+        self.assertEqual(Expense.objects.filter(
+            to_settle=Decimal('1200'), is_settled=False
+        ).count(), 6)
+
+        self.assertIn('Created 0 expenses from 0 schedules.',
+                      self.generate('2020-10-30'))
+        self.assertEqual(Expense.objects.count(), 6)
+
+    def test_due_query_uses_index(self):
+        plan = (RecurringExpense.objects.due(date(2020, 1, 1))[:10]
+                .explain())
+        self.assertIn('recurring_next_run_idx', plan)
+
+
+class LoadTestCommandTestCase(TestCase):
+    """
+    Tests load_test command against the WSGI application.
+    """
+
+    def test_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'results.json')
+        output = StringIO()
+        call_command('load_test', '--seed', '--users', '2', '--expenses', '1',
+                     '--transfers', '3', '--threads', '1', '--requests', '30',
+                     '--output', path, stdout=output)
+        with open(path) as results:
+            report = json.load(results)
+
+        self.assertEqual(report['run']['threads'], 1)
+        self.assertEqual(report['total']['requests'], 30)
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertEqual(set(report['operations']), {
+            'list_expenses', 'list_transfers', 'transfer_detail',
+            'create_transfer', 'settle', 'statistics'
+        })
+        for values in report['operations'].values():
+            self.assertLessEqual(values['p50_ms'], values['p99_ms'])
+        self.assertIn('total', output.getvalue())
+        self.assertEqual(
+            Transfer.objects.filter(is_settled=True).count(),
+            report['operations']['settle']['requests']
+        )
+
+    def test_without_seeded_users(self):
+        with self.assertRaises(CommandError):
+            call_command('load_test', '--requests', '1', stdout=StringIO())
+
+
+class TransferAllocationTestCase(APITestCase):
+    """
+    Tests allocation of one payment across unsettled expenses.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        pln = Currency.objects.create(currency_name='PLN')
+        Currency.objects.create(currency_name='USD')
+        self.expenses = [
+            Expense.objects.create(
+                currency=pln,
+                total_amount=Decimal(total_amount),
+                vat=vat,
+                owner=self.user
+            ) for total_amount, vat in (('50', False), ('30', True),
+                                        ('100', True))
+        ]
+        Expense.objects.create(currency_id='USD', total_amount=Decimal('10'),
+                               vat=False, owner=self.user)
+        Transfer.objects.create(
+            is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+            brutto=Decimal('10'), currency=pln,
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense=self.expenses[0], owner=self.user
+        )
+        self.client.force_login(self.user)
+
+    def allocate(self, **body):
+        return self.client.post('/transfers/allocate/',
+                                dict({'currency': 'PLN'}, **body),
+                                format='json')
+
+    def allocated(self, response):
+        return [(transfer['expense'], transfer['brutto'])
+                for transfer in response.data['transfers']]
+
+    def test_oldest_first(self):
+        with self.assertNumQueries(8):
+            response = self.allocate(amount='60')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.allocated(response), [
+            (self.expenses[0].id, '40.00'), (self.expenses[1].id, '20.00')
+        ])
+        self.assertEqual(
+            (response.data['allocated'], response.data['unallocated']),
+            ('60.00', '0.00')
+        )
+        self.assertEqual(Transfer.objects.filter(
+            owner=self.user, is_settled=False).count(), 3)
+
+    def test_strategy_and_rest(self):
+        response = self.allocate(amount='150', strategy='largest')
+        self.assertEqual(self.allocated(response), [
+            (self.expenses[2].id, '100.00'), (self.expenses[0].id, '40.00'),
+            (self.expenses[1].id, '10.00')
+        ])
+        response = self.allocate(amount='30')
+        self.assertEqual(self.allocated(response),
+                         [(self.expenses[1].id, '20.00')])
+        self.assertEqual(response.data['unallocated'], '10.00')
+
+    def test_vat_payment(self):
+        response = self.allocate(amount='123', is_vat=True,
+                                 strategy='smallest')
+        self.assertEqual(self.allocated(response), [
+            (self.expenses[1].id, '30.00'), (self.expenses[2].id, '93.00')
+        ])
+        transfer = Transfer.objects.get(expense=self.expenses[1])
+        self.assertEqual((transfer.netto, transfer.vat, transfer.is_vat),
+                         (Decimal('24.39'), Decimal('5.61'), True))
+
+    def test_nothing_to_allocate(self):
+        response = self.allocate(amount='10', currency='USD', is_vat=True)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.allocate(amount='0')
+        self.assertEqual(response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class AgingReportTestCase(APITestCase):
+    """
+    Tests expense timestamps and aging report.
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.users = [User.objects.create_user(username=f'user{number}',
+                                               password='12345')
+                      for number in range(3)]
+        for name in ('PLN', 'USD'):
+            Currency.objects.create(currency_name=name)
+        now = timezone.now()
+        for owner, currency, amount, days in (
+                (0, 'PLN', '100', 5), (0, 'PLN', '50', 45),
+                (0, 'USD', '10', 200), (1, 'PLN', '300', 75),
+                (2, 'PLN', '100', 95), (2, 'PLN', '40', 31)):
+            Expense.objects.create(
+                currency_id=currency,
+                total_amount=Decimal(amount),
+                vat=False,
+                owner=self.users[owner],
+                created=now - timedelta(days=days, hours=1)
+            )
+        Expense.objects.create(currency_id='PLN', total_amount=Decimal('5'),
+                               settled=Decimal('5'), vat=False,
+                               owner=self.users[1])
+        self.client.force_login(self.admin)
+
+    def test_updated_is_bumped(self):
+        expense = Expense.objects.get(total_amount=Decimal('300'))
+        before = expense.updated
+        Expense.objects.filter(id=expense.id).update(
+            updated=before - timedelta(days=1)
+        )
+        Expense.objects.all().add_to_settled({expense.id: Decimal('20')})
+        expense.refresh_from_db()
+        self.assertGreaterEqual(expense.updated,
+                                before.replace(microsecond=0))
+        self.assertEqual(expense.to_settle, Decimal('280.00'))
+
+    def test_report_per_currency(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/aging/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        pln, usd = response.data['results']
+        self.assertEqual(
+            (pln['currency'], pln['expenses'], pln['total'], pln['days_0_30'],
+             pln['days_31_60'], pln['days_61_90'], pln['days_over_90']),
+            ('PLN', 5, '590.00', '100.00', '90.00', '300.00', '100.00')
+        )
+        self.assertEqual((usd['total'], usd['days_over_90']),
+                         ('10.00', '10.00'))
+        self.assertIsNone(response.data['next'])
+
+    def test_top_debtors_with_cursor(self):
+        response = self.client.get('/aging/?by=owner&top=2')
+        self.assertEqual(
+            [(row['owner'], row['currency'], row['total'])
+             for row in response.data['results']],
+            [(self.users[1].id, 'PLN', '300.00'),
+             (self.users[0].id, 'PLN', '150.00')]
+        )
+        response = self.client.get(response.data['next'])
+        self.assertEqual(
+            [(row['owner'], row['currency'], row['total'])
+             for row in response.data['results']],
+            [(self.users[2].id, 'PLN', '140.00'),
+             (self.users[0].id, 'USD', '10.00')]
+        )
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_parameters(self):
+        for query in ('by=day', 'top=0', 'by=owner&cursor=abc'):
+            response = self.client.get(f'/aging/?{query}')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.client.force_login(self.users[0])
+        self.assertEqual(self.client.get('/aging/').status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+
+class IntegrityConstraintsTestCase(APITestCase):
+    """
+    Tests rules of expenses and transfers kept by the database.
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        for name in ('PLN', 'USD'):
+            Currency.objects.create(currency_name=name)
+        self.expense = Expense.objects.create(
+            currency_id='PLN', total_amount=Decimal('50'), vat=False,
+            owner=self.user
+        )
+
+    def transfer(self, **values):
+        return Transfer.objects.create(**dict({
+            'is_vat': False, 'netto': Decimal('30'), 'vat': Decimal('0'),
+            'brutto': Decimal('30'), 'currency_id': 'PLN',
+            'sent_date': datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            'expense': self.expense, 'owner': self.user
+        }, **values))
+
+    def test_constraints(self):
+        for values in ({'currency_id': 'USD'}, {'brutto': Decimal('31')}):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                self.transfer(**values)
+        self.transfer()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Expense.objects.filter(id=self.expense.id).update(
+                currency_id='USD'
+            )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Expense.objects.filter(id=self.expense.id).update(
+                to_settle=Decimal('10')
+            )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Expense.objects.all().add_to_settled(
+                {self.expense.id: Decimal('60')}
+            )
+
+    def test_create_transfer_reads_expense_once(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/transfers/', {
+                'netto': '20', 'vat': '1', 'currency': 'PLN',
+                'expense': self.expense.id, 'is_vat': False
+            })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len([query for query in queries
+                              if 'FROM "Wydatek"' in query['sql']]), 1)
+        response = self.client.post('/transfers/', {
+            'netto': '20', 'vat': '1', 'currency': 'USD',
+            'expense': self.expense.id, 'is_vat': False
+        })
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_settle_within_to_settle(self):
+        first, second = self.transfer(), self.transfer()
+        self.client.force_login(self.admin)
+        for transfer in (first, first):
+            response = self.client.put(f'/transfer/{transfer.id}',
+                                       {'is_settled': True})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(f'/transfer/{second.id}',
+                                   {'is_settled': True})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.expense.refresh_from_db()
+        self.assertEqual((self.expense.settled, self.expense.to_settle),
+                         (Decimal('30.00'), Decimal('20.00')))
+        self.assertEqual(SettlementEvent.objects.count(), 1)
+        self.assertFalse(Transfer.objects.get(id=second.id).is_settled)
+
+
+class ExpandTestCase(APITestCase):
+    """
+    Tests ?expand= parameter of expense and transfer views.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             email='adam@user.test',
+                                             password='12345')
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.client.force_login(self.user)
+
+    def create_transfers(self, count):
+        for _ in range(count):
+            expense = Expense.objects.create(
+                currency=self.currency, total_amount=Decimal('100'),
+                vat=False, owner=self.user
+            )
+            Transfer.objects.create(
+                is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+                brutto=Decimal('10'), currency=self.currency,
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense, owner=self.user
+            )
+
+    def list_transfers(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/transfers/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'], len(queries)
+
+    def test_expanded_page_costs_constant_queries(self):
+        self.create_transfers(1)
+        params = {'expand': 'expense,owner,currency'}
+        results, plain = self.list_transfers({})
+        self.assertEqual(results[0]['expense'], Expense.objects.get().id)
+        results, expanded = self.list_transfers(params)
+        self.create_transfers(5)
+        results, more = self.list_transfers(params)
+        self.assertEqual(plain, expanded)
+        self.assertEqual(expanded, more)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[0]['expense']['total_amount'], '100.00')
+        self.assertEqual(results[0]['owner'], {
+            'id': self.user.id, 'username': 'adam',
+            'email': 'adam@user.test'
+        })
+        self.assertEqual(results[0]['currency'], {'currency_name': 'PLN'})
+
+    def test_expand_with_fields_and_detail(self):
+        self.create_transfers(1)
+        results, _ = self.list_transfers(
+            {'fields': 'id,expense', 'expand': 'expense,owner,unknown'}
+        )
+        self.assertEqual(set(results[0]), {'id', 'expense'})
+        self.assertEqual(results[0]['expense']['currency'], 'PLN')
+        transfer = Transfer.objects.get()
+        response = self.client.get(f'/transfer/{transfer.id}',
+                                   {'expand': 'expense'})
+        self.assertEqual(response.data['expense']['id'],
+                         transfer.expense_id)
+
+    def test_expand_expenses_and_archived_transfers(self):
+        self.create_transfers(2)
+        Expense.objects.all().add_to_settled(
+            dict.fromkeys(Expense.objects.values_list('id', flat=True),
+                          Decimal('100'))
+        )
+        Transfer.objects.update(is_settled=True)
+        call_command('archive_settled', before='2021-01-01',
+                     stdout=StringIO())
+        self.create_transfers(1)
+        results, _ = self.list_transfers(
+            {'include_archived': 'true', 'expand': 'expense'}
+        )
+        self.assertEqual([row['expense']['is_settled'] for row in results],
+                         [True, True, False])
+        response = self.client.get('/expenses/', {'expand': 'currency,owner'})
+        self.assertEqual(response.data['results'][0]['owner']['username'],
+                         'adam')
+        self.assertEqual(response.data['results'][0]['currency'],
+                         {'currency_name': 'PLN'})
+
+
+class SyncTestCase(APITestCase):
+    """
+    Tests tombstones and /sync/ endpoint.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        other = User.objects.create_user(username='ewa', password='12345')
+        self.currency = Currency.objects.create(currency_name='PLN')
+        self.expenses = [self.create_expense(self.user) for _ in range(2)]
+        self.create_expense(other)
+        self.transfer = Transfer.objects.create(
+            is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+            brutto=Decimal('10'), currency=self.currency,
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense=self.expenses[0], owner=self.user
+        )
+        day_ago = timezone.now() - timedelta(days=1)
+        Expense.objects.update(updated=day_ago)
+        Transfer.objects.update(updated=day_ago)
+        self.client.force_login(self.user)
+
+    def create_expense(self, owner):
+        return Expense.objects.create(
+            currency=self.currency, total_amount=Decimal('100'), vat=False,
+            owner=owner
+        )
+
+    def sync(self, **params):
+        response = self.client.get('/sync/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_sync_returns_changes_since_token(self):
+        data = self.sync()
+        self.assertEqual([row['id'] for row in data['expenses']],
+                         [expense.id for expense in self.expenses])
+        self.assertEqual([row['id'] for row in data['transfers']],
+                         [self.transfer.id])
+        self.assertFalse(data['more'])
+        token = data['token']
+        data = self.sync(token=token)
+        self.assertEqual((data['expenses'], data['transfers'],
+                          data['deleted']), ([], [], []))
+
+        self.expenses[1].total_amount = Decimal('200')
+        self.expenses[1].save()
+        self.client.delete(f'/transfer/{self.transfer.id}')
+        with CaptureQueriesContext(connection) as queries:
+            data = self.sync(token=token)
+        self.assertEqual([row['total_amount'] for row in data['expenses']],
+                         ['200.00'])
+        self.assertEqual(data['transfers'], [])
+        self.assertEqual(data['deleted'],
+                         [{'kind': 'transfer', 'id': self.transfer.id}])
+        self.assertEqual(len([query for query in queries
+                              if 'ORDER BY' in query['sql']]), 4)
+        repeated = self.sync(token=data['token'])
+        self.assertEqual(repeated['deleted'], data['deleted'])
+
+    def test_sync_pages_and_invalid_token(self):
+        data = self.sync(limit=1)
+        self.assertTrue(data['more'])
+        self.assertEqual(len(data['expenses']), 1)
+        data = self.sync(limit=1, token=data['token'])
+        self.assertEqual([row['id'] for row in data['expenses']],
+                         [self.expenses[1].id])
+        self.assertEqual(data['transfers'], [])
+        for params in ({'token': 'xyz'}, {'limit': 0}):
+            response = self.client.get('/sync/', params)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+    def test_sync_returns_settlements_on_counters(self):
+        expense = self.expenses[0]
+        Expense.objects.filter(id=expense.id).use_counters(4)
+        day_ago = timezone.now() - timedelta(days=1)
+        Expense.objects.update(updated=day_ago)
+        SettlementCounter.objects.update(updated=day_ago)
+        token = self.sync()['token']
+        self.assertEqual(self.sync(token=token)['expenses'], [])
+
+        self.assertEqual(
+            Expense.objects.add_to_settled({expense.id: Decimal('10')}), 1
+        )
+        self.assertEqual(Expense.objects.get(id=expense.id).updated,
+                         day_ago)
+        data = self.sync(token=token)
+        self.assertEqual(
+            [(row['id'], row['settled']) for row in data['expenses']],
+            [(expense.id, '10.00')]
+        )
+
+    def test_tombstones_of_deleted_expenses(self):
+        expense_id = self.expenses[0].id
+        self.expenses[0].delete()
+        self.assertEqual(
+            set(Tombstone.objects.values_list('kind', 'object_id')),
+            {('expense', expense_id),
+             ('transfer', self.transfer.id)}
+        )
+        Expense.objects.filter(id=self.expenses[1].id).delete()
+        self.assertEqual(Tombstone.objects.filter(kind='expense').count(), 2)
+
+
+class SettlementCounterTestCase(APITestCase):
+    """
+    Tests counter mode of expenses and fold_counters command.
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            password='12345',
+            username='admin',
+            email='admin@user.test'
+        )
+        Currency.objects.create(currency_name='PLN')
+        self.expense = Expense.objects.create(
+            currency_id='PLN', total_amount=Decimal('100'), vat=False,
+            owner=self.admin
+        )
+        self.transfers = [self.create_transfer(brutto)
+                          for brutto in ('10', '20', '30', '50', '40')]
+        call_command('fold_counters', enable=[self.expense.id], slots=4,
+                     stdout=StringIO())
+        self.client.force_login(self.admin)
+
+    def create_transfer(self, brutto):
+        return Transfer.objects.create(
+            is_vat=False, netto=Decimal(brutto), vat=Decimal('0'),
+            brutto=Decimal(brutto), currency_id='PLN',
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense=self.expense, owner=self.admin
+        )
+
+    def settle(self, transfer):
+        return self.client.put(f'/transfer/{transfer.id}',
+                               {'is_settled': True})
+
+    def balance(self):
+        data = self.client.get(f'/expense/{self.expense.id}').data
+        return data['settled'], data['to_settle'], data['is_settled']
+
+    def test_settle_on_counter(self):
+        self.assertEqual(
+            list(SettlementCounter.objects.values_list('budget', flat=True)),
+            [Decimal('25.00')] * 4
+        )
+        updated = Expense.objects.get().updated
+        with CaptureQueriesContext(connection) as queries:
+            response = self.settle(self.transfers[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue([
+            query for query in queries
+            if query['sql'].startswith('UPDATE "Licznik rozliczenia"')
+        ])
+        self.expense.refresh_from_db()
+        self.assertEqual((self.expense.settled, self.expense.updated),
+                         (Decimal('0.00'), updated))
+        self.assertEqual(self.balance(), ('10.00', '90.00', False))
+        out = StringIO()
+        call_command('reconcile', workers=1, stdout=out)
+        self.assertIn('Found 0 mismatched', out.getvalue())
+
+        call_command('fold_counters', stdout=StringIO())
+        self.expense.refresh_from_db()
+        self.assertEqual((self.expense.settled, self.expense.to_settle),
+                         (Decimal('10.00'), Decimal('90.00')))
+        self.assertEqual(
+            SettlementCounter.objects.aggregate(
+                settled=Sum('settled'), budget=Sum('budget')
+            ),
+            {'settled': Decimal('0.00'), 'budget': Decimal('90.00')}
+        )
+
+    def test_reads_count_in_counters(self):
+        Currency.objects.create(currency_name='USD')
+        expense = Expense.objects.create(
+            currency_id='USD', total_amount=Decimal('100'), vat=False,
+            owner=self.admin
+        )
+        transfer = Transfer.objects.create(
+            is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+            brutto=Decimal('10'), currency_id='USD',
+            sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+            expense=expense, owner=self.admin
+        )
+        call_command('fold_counters', enable=[expense.id], slots=1,
+                     stdout=StringIO())
+        self.assertEqual(self.settle(transfer).status_code,
+                         status.HTTP_200_OK)
+
+        def count(**params):
+            return self.client.get('/expenses/', {
+                'currency': 'USD', **params
+            }).data['count']
+
+        self.assertEqual(count(to_settle_max=95), 1)
+        self.assertEqual(count(to_settle_min=95), 0)
+        self.assertEqual(count(is_settled=False), 1)
+        statistics = self.client.get('/statystyki/').data
+        self.assertEqual(list(statistics[1].values()), [Decimal('90.00')])
+        aging = self.client.get('/aging/', {'currency': 'USD'}).data
+        self.assertEqual(aging['results'][0]['total'], '90.00')
+
+        for brutto in ('40', '50'):
+            transfer = Transfer.objects.create(
+                is_vat=False, netto=Decimal(brutto), vat=Decimal('0'),
+                brutto=Decimal(brutto), currency_id='USD',
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense, owner=self.admin
+            )
+            self.settle(transfer)
+        self.assertEqual(count(is_settled=True), 1)
+        self.assertEqual(count(is_settled=False), 0)
+        statistics = self.client.get('/statystyki/').data
+        self.assertEqual(list(statistics[0].values()), [Decimal('100.00')])
+        self.assertEqual(list(statistics[1].values()), [None])
+        self.assertEqual(
+            self.client.get('/aging/', {'currency': 'USD'}).data['results'],
+            []
+        )
+        expense.refresh_from_db()
+        self.assertEqual((expense.settled, expense.is_settled),
+                         (Decimal('0.00'), False))
+
+    def test_settlement_after_counter_mode_is_left(self):
+        Expense.objects.filter(id=self.expense.id).use_counters(0)
+        self.assertEqual(
+            Expense.objects.add_to_counter(self.expense.id, 4, Decimal('10')),
+            1
+        )
+        self.expense.refresh_from_db()
+        self.assertEqual(self.expense.settled, Decimal('10.00'))
+
+    def test_settlement_fails_when_expense_is_not_updated(self):
+        with mock.patch.object(ExpenseQuerySet, 'add_to_settled',
+                               return_value=0):
+            with self.assertRaises(DatabaseError):
+                Transfer.objects.filter(id=self.transfers[0].id).settle()
+            self.transfers[1].is_settled = True
+            self.transfers[1].save()
+            with self.assertRaises(DatabaseError):
+                self.transfers[1].delete()
+        self.assertFalse(Transfer.objects.get(
+            id=self.transfers[0].id).is_settled)
+        self.assertFalse(SettlementEvent.objects.exists())
+        self.assertTrue(Transfer.objects.filter(
+            id=self.transfers[1].id).exists())
+
+    def test_counters_do_not_overpay(self):
+        for transfer in self.transfers[:3]:
+            self.assertEqual(self.settle(transfer).status_code,
+                             status.HTTP_200_OK)
+        self.assertEqual(self.balance(), ('60.00', '40.00', False))
+        self.assertEqual(self.settle(self.transfers[3]).status_code,
+                         status.HTTP_409_CONFLICT)
+        self.assertEqual(self.settle(self.transfers[4]).status_code,
+                         status.HTTP_200_OK)
+        self.assertEqual(self.balance(), ('100.00', '0.00', True))
+
+        Transfer.objects.get(id=self.transfers[0].id).delete()
+        self.assertEqual(self.balance(), ('90.00', '10.00', False))
+        call_command('fold_counters', disable=[self.expense.id],
+                     stdout=StringIO())
+        self.expense.refresh_from_db()
+        self.assertEqual((self.expense.settled, self.expense.counter_slots),
+                         (Decimal('90.00'), 0))
+        self.assertFalse(SettlementCounter.objects.exists())
+
+
+@override_settings(DASHBOARD_WORKERS=1)
+class DashboardTestCase(APITestCase):
+    """
+    Tests /dashboard/ endpoint.
+    """
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='adam',
+                                             password='12345')
+        Currency.objects.create(currency_name='PLN')
+        expense = Expense.objects.create(
+            currency_id='PLN', total_amount=Decimal('100'), vat=False,
+            owner=self.user
+        )
+        for is_settled in (False, True):
+            Transfer.objects.create(
+                is_vat=False, netto=Decimal('10'), vat=Decimal('0'),
+                brutto=Decimal('10'), currency_id='PLN', owner=self.user,
+                sent_date=datetime(2020, 10, 1, tzinfo=pytz.UTC),
+                expense=expense, is_settled=is_settled
+            )
+        self.client.force_login(self.user)
+
+    def test_sections(self):
+        response = self.client.get('/dashboard/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data), ['currencies', 'expenses',
+                                               'pending_transfers',
+                                               'statistics'])
+        self.assertEqual(response.data['currencies'],
+                         [{'currency_name': 'PLN'}])
+        self.assertEqual(len(response.data['expenses']), 1)
+        self.assertEqual([row['is_settled'] for row
+                          in response.data['pending_transfers']], [False])
+        self.assertEqual(response.data['statistics'],
+                         self.client.get('/statystyki/').data)
+
+        response = self.client.get('/dashboard/',
+                                   {'sections': 'expenses,statistics'})
+        self.assertEqual(list(response.data), ['expenses', 'statistics'])
+        response = self.client.get('/dashboard/', {'sections': 'users'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(DASHBOARD_CACHE_TIMEOUTS={'currencies': 60,
+                                                 'expenses': 0})
+    def test_sections_are_cached(self):
+        self.client.get('/dashboard/', {'sections': 'currencies,expenses'})
+        Currency.objects.create(currency_name='USD')
+        Expense.objects.create(currency_id='USD', total_amount=Decimal('5'),
+                               vat=False, owner=self.user)
+        response = self.client.get('/dashboard/',
+                                   {'sections': 'currencies,expenses'})
+        self.assertEqual(response.data['currencies'],
+                         [{'currency_name': 'PLN'}])
+        self.assertEqual(len(response.data['expenses']), 2)
+
+    @override_settings(DASHBOARD_WORKERS=4)
+    def test_sections_run_concurrently(self):
+        def slow(view, request):
+            time.sleep(0.2)
+            return threading.get_ident()
+
+        sections = {name: slow for name in DashboardView.sections}
+        with mock.patch.multiple(DashboardView, **sections):
+            started = time.perf_counter()
+            response = self.client.get('/dashboard/')
+            elapsed = time.perf_counter() - started
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(len(set(response.data.values())), 4)
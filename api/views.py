@@ -1,5 +1,22 @@
+from django.conf import settings
 from django.contrib.auth.models import User, Group
-from django.db.models import Avg, Sum
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import DEFAULT_DB_ALIAS, transaction
+import base64
+import heapq
+import json
+import re
+from contextlib import ExitStack
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from io import BytesIO
+from itertools import islice
+from django.db.models import Count, Q, Sum
+from django.shortcuts import get_object_or_404
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status, generics
 from rest_framework.permissions import (
@@ -7,12 +24,21 @@ from rest_framework.permissions import (
 )
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import Transfer, Expense, Currency
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+from .filters import ExpenseFilter, TransferFilter
+from .models import (
+    Transfer, Expense, Currency, ArchivedExpense, ArchivedTransfer,
+    ArchiveTotal, ExpenseQuerySet, SettlementCounter, Tombstone
+)
 from .serializers import (
     UserSerializer, GroupSerializer, TransferSerializer,
     ExpenseSerializer, CurrencySerializer, RegisterSerializer,
-    SettleTransferSerializer
+    SettleTransferSerializer, BatchSerializer, TransferDeleteSerializer,
+    BillingRunSerializer, AllocationSerializer, AgingSerializer,
+    requested_fields
 )
+from .sharding import fan_out, run_parallel, shard_aliases
 from .permissions import (
     CurrencyDetailAllowedMethods, CurrencyListAllowedMethods,
     ExpensesListAllowedMethods, TransferDetailViewAllowedMethods
@@ -41,6 +67,124 @@ class RegisterViewSet(viewsets.ModelViewSet):
             res = {"user": UserSerializer(user, context=self.get_serializer_context()).data}
             return Response(res)
 
+class ShardedViewMixin:
+    """
+    Mixin for views of sharded models. Querysets of superuser, after
+    filters are applied, run on every shard. Querysets of other users
+    are read only from their shard by get_queryset. Has to be the first
+    base class of view.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.user.is_superuser:
+            return fan_out(queryset)
+        return queryset
+
+
+class ArchiveListMixin:
+    """
+    Mixin for list views of models that have archive tables.
+    Lists read only hot tables, unless request has
+    ?include_archived=true parameter. Then filters are applied to hot
+    and archived rows separately and both are combined with UNION.
+    """
+    archive_model = None
+
+    def include_archived(self):
+        return (self.request.query_params.get('include_archived', '')
+                .lower() in ('1', 'true', 'yes'))
+
+    def get_archived_queryset(self):
+        if self.request.user.is_superuser:
+            return self.archive_model.objects.all()
+        return self.archive_model.objects.for_owner(self.request.user)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method == 'GET' and self.include_archived():
+            archived = super().filter_queryset(self.get_archived_queryset())
+            queryset = queryset.union(archived, all=True).order_by('id')
+        return queryset
+
+
+class SparseFieldsetViewMixin:
+    """
+    Mixin for views using SparseFieldsetMixin serializers.
+    When request has ?fields= parameter, only columns of requested
+    fields, and of fields listed for them in dependent_fields, are
+    loaded from database. Has to be placed after ArchiveListMixin, so
+    hot and archived rows get the same columns.
+    """
+    dependent_fields = {}
+
+    def wants(self, *names):
+        """
+        Checks if any of given fields will be returned.
+        """
+        requested = requested_fields(self.request)
+        return requested is None or not requested.isdisjoint(names)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        requested = requested_fields(self.request)
+        if requested is None:
+            return queryset
+        requested = requested.union(*[
+            self.dependent_fields.get(name, ()) for name in requested
+        ])
+        meta = queryset.model._meta
+        return queryset.only(meta.pk.name, *[
+            field.name for field in meta.concrete_fields
+            if field.name in requested
+        ])
+
+
+class ExpandViewMixin:
+    """
+    Mixin for views using ExpandableMixin serializers. Related objects
+    expanded with ?expand= parameter are loaded with joins, so a page
+    costs the same number of queries with and without expansion. Has to
+    be placed after ArchiveListMixin, so hot and archived rows get the
+    same columns.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        expanded = self.get_serializer_class().expanded_fields(self.request)
+        if expanded:
+            return queryset.select_related(*sorted(expanded))
+        return queryset
+
+
+class ExpenseQuerysetMixin(ExpandViewMixin, SparseFieldsetViewMixin):
+    """
+    Mixin for expense views, lists expenses owned by user, for
+    superuser everything. Transfer totals and amounts settled on
+    counters are annotated only when they will be returned, together
+    with columns the balance of expenses in counter mode is counted
+    from.
+    """
+    dependent_fields = {
+        name: ('settled', 'total_amount')
+        for name in ('settled', 'to_settle', 'is_settled')
+    }
+
+    def get_queryset(self):
+        if self.request.user.is_superuser:
+            return self.with_totals(Expense.objects.all())
+        return self.with_totals(
+            Expense.objects.for_owner(self.request.user)
+        )
+
+    def with_totals(self, queryset):
+        if self.wants('settled', 'to_settle', 'is_settled'):
+            queryset = queryset.with_counters()
+        if self.wants(*ExpenseQuerySet.TRANSFER_TOTALS):
+            return queryset.with_transfer_totals()
+        return queryset
+
+
 class CurrencyListView(generics.ListCreateAPIView):
     """
     Lists and creates currency objects.
@@ -85,14 +229,22 @@ class CurrencyDetailView(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'currency_name'
     permission_classes = [CurrencyDetailAllowedMethods,IsAuthenticated]
 
-class ExpensesListView(generics.ListCreateAPIView):
+class ExpensesListView(ShardedViewMixin, ArchiveListMixin,
+                       ExpenseQuerysetMixin, generics.ListCreateAPIView):
     """
     Lists and creates expense objects
     Http methods:
 
     GET - Lists all Expenses objects owned by user. For superuser shows
-        everything.
+        everything. Archived expenses are listed only with
+        include_archived parameter. Every expense has totals of its
+        transfers: transfer_count, pending_brutto, settled_brutto and
+        last_payment_date.
     GET /expenses/
+    GET /expenses/?include_archived=true
+    GET /expenses/?currency=PLN&is_settled=false&to_settle_min=100
+    GET /expenses/?fields=id,to_settle,pending_brutto
+    GET /expenses/?expand=currency,owner
 
     POST - Creates new expense. Permitted only for admin user.
     POST /expenses/
@@ -109,21 +261,26 @@ class ExpensesListView(generics.ListCreateAPIView):
     serializer_class = ExpenseSerializer
     lookup_field = 'id'
     permission_classes = [ExpensesListAllowedMethods, IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = ExpenseFilter
+    archive_model = ArchivedExpense
 
-    def get_queryset(self):
-        if self.request.user.is_superuser:
-            return Expense.objects.all()
-        return Expense.objects.filter(owner=self.request.user)
+    def get_archived_queryset(self):
+        return self.with_totals(super().get_archived_queryset())
 
 
-class ExpenseDetailView(generics.RetrieveDestroyAPIView):
+class ExpenseDetailView(ShardedViewMixin, ExpenseQuerysetMixin,
+                        generics.RetrieveDestroyAPIView):
     """
     Detail view of expense objects.
     All methods permitted only for  admin user.
 
     Http methods:
-    GET- Retrieves existing Expenses object given in url.
+    GET- Retrieves existing Expenses object given in url, with totals
+        of its transfers.
     GET /expense/1
+    GET /expense/1?fields=id,to_settle
+    GET /expense/1?expand=owner
 
     DELETE- Deletes expense object given in url.
     DELETE /expense/1
@@ -134,21 +291,89 @@ class ExpenseDetailView(generics.RetrieveDestroyAPIView):
     lookup_field = 'id'
     permission_classes = [IsAdminUser]
 
-    def get_queryset(self):
-        if self.request.user.is_superuser:
-            return Expense.objects.all()
-        return Expense.objects.filter(owner=self.request.user)
 
+class ExpenseBalanceView(APIView):
+    """
+    Balance of expense rebuilt from the settlement ledger.
+    Permitted only for admin user.
 
-class TransfersListView(generics.ListCreateAPIView):
+    GET /expense/1/balance
+    GET /expense/1/balance?at=2020-10-01T12:00:00Z
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, id, format=None):
+        expense = get_object_or_404(Expense, id=id)
+        at = request.query_params.get('at')
+        if at is not None:
+            try:
+                at = parse_datetime(at)
+            except ValueError:
+                at = None
+            if at is None:
+                return Response(
+                    {'at': 'Invalid date-time.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        data = {
+            'expense': expense.id,
+            'at': at,
+            'settled': expense.settled_at(at)
+        }
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
+class BillingRunView(APIView):
+    """
+    Charges many users with the same expense at once, expenses are
+    created with bulk inserts in one transaction.
+    Permitted only for admin user.
+
+    POST /billing/
+    Request body:
+    {
+        "group": "members",
+        "currency": "PLN",
+        "total_amount": "50.00",
+        "vat": false
+    }
+    Users can be given also as "users": [1, 2, 3] or "all_users": true.
+    Response body:
+    {
+        "created": 1200,
+        "currency": "PLN",
+        "total_amount": "50.00",
+        "vat": false,
+        "billed_amount": "60000.00"
+    }
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, format=None):
+        serializer = BillingRunSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        summary = serializer.save()
+        for name in ('total_amount', 'billed_amount'):
+            summary[name] = str(summary[name])
+        return Response(summary, status=status.HTTP_201_CREATED)
+
+
+class TransfersListView(ShardedViewMixin, ArchiveListMixin, ExpandViewMixin,
+                        SparseFieldsetViewMixin, generics.ListCreateAPIView):
     """
     Lists and creates transfer objects.
 
     Http methods:
 
     GET - Lists all Transfer objects owned by user. For superuser shows
-        everything.
+        everything. Transfers of archived expenses are listed only with
+        include_archived parameter.
     GET /transfers/
+    GET /transfers/?include_archived=true
+    GET /transfers/?expense=1&is_settled=true
+    GET /transfers/?currency=PLN&sent_date_after=2020-10-01
+    GET /transfers/?fields=id,brutto,is_settled
+    GET /transfers/?expand=expense,owner
 
     POST - Creates new transfer. Permitted only for autheticated users.
     POST /transfers/
@@ -161,24 +386,107 @@ class TransfersListView(generics.ListCreateAPIView):
         'expense':'1',
         'owner':'2'
     }
+
+    DELETE - Deletes many transfers of user at once, given by ids in
+        request body, by filters or both. Settled amounts of deleted
+        transfers are subtracted from their expenses.
+    DELETE /transfers/?expense=1&is_settled=false
+    DELETE /transfers/
+    Request body:
+    {
+        "ids": [1, 2, 3]
+    }
+    Response:
+    {
+        "deleted": 3
+    }
     """
     queryset = Transfer.objects.all()
     serializer_class = TransferSerializer
     lookup_field = 'id'
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ['is_settled']
+    filterset_class = TransferFilter
+    archive_model = ArchivedTransfer
 
     def get_queryset(self):
         if self.request.user.is_superuser:
             return Transfer.objects.all()
-        return Transfer.objects.filter(owner=self.request.user)
+        return Transfer.objects.for_owner(self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    def delete(self, request, *args, **kwargs):
+        serializer = TransferDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data.get('ids')
+        queryset = self.filter_queryset(self.get_queryset())
+        if ids is None and not self.has_filters(queryset):
+            return Response(
+                {'detail': "Give ids or filters of transfers to delete."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        deleted, _ = queryset.delete()
+        return Response({'deleted': deleted}, status=status.HTTP_200_OK)
+
+    def has_filters(self, queryset):
+        """
+        Checks if any filter of the filter set got a value, parameters
+        like page or fields and filters with empty values do not count.
+        """
+        filterset = DjangoFilterBackend().get_filterset(self.request,
+                                                        queryset, self)
+        return filterset.is_valid() and any(
+            value not in (None, '', []) and value != slice(None, None)
+            for value in filterset.form.cleaned_data.values()
+        )
+
+
+class TransferAllocationView(APIView):
+    """
+    Splits one payment of user into transfers to their unsettled
+    expenses in the same currency. Expenses are paid off oldest first,
+    or smallest or largest first with "strategy", up to amount still to
+    settle after their pending transfers. Transfers are created in one
+    transaction. Permitted for authenticated users.
+
+    POST /transfers/allocate/
+    Request body:
+    {
+        "amount": "1500.00",
+        "currency": "PLN",
+        "is_vat": true,
+        "vat_rate": "0.23",
+        "strategy": "oldest"
+    }
+    Response body:
+    {
+        "allocated": "1500.00",
+        "unallocated": "0.00",
+        "transfers": [{...}, {...}]
+    }
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None):
+        serializer = AllocationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        transfers, rest = serializer.save(owner=request.user)
+        return Response({
+            'allocated': str(serializer.validated_data['amount'] - rest),
+            'unallocated': str(rest),
+            'transfers': TransferSerializer(
+                transfers, many=True, context={'request': request}
+            ).data
+        }, status=status.HTTP_201_CREATED)
+
 
-class TransferDetailView(generics.RetrieveUpdateDestroyAPIView):
+class TransferDetailView(ShardedViewMixin, ExpandViewMixin,
+                         SparseFieldsetViewMixin,
+                         generics.RetrieveUpdateDestroyAPIView):
     """
     Returns detail view for transfer object.
 
@@ -186,6 +494,8 @@ class TransferDetailView(generics.RetrieveUpdateDestroyAPIView):
 
     GET- Retrieves existing Transfer object. Permitted for authenticated user.
     GET /transfer/<transfer id>
+    GET /transfer/<transfer id>?fields=id,brutto,is_settled
+    GET /transfer/<transfer id>?expand=expense
 
     PUT- Updates Transfer object given in url. Permitted for admin users.
     PUT /transfer/<transfer id>
@@ -212,12 +522,16 @@ class TransferDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         if self.request.user.is_superuser:
             return Transfer.objects.all()
-        return Transfer.objects.filter(owner=self.request.user)
+        return Transfer.objects.for_owner(self.request.user)
 
 
 class StatisticsListView(APIView):
     """
     List of generated statistics values.
+    Sums of expenses count in amounts settled on counters, see
+    ExpenseQuerySet.counted.
+    Values of archived rows are taken from pre-summed ArchiveTotal.
+    Values for superuser are aggregated on every shard in parallel.
 
     GET /statistics/
     """
@@ -228,33 +542,552 @@ class StatisticsListView(APIView):
                               'w walucie “USD”')
         avg_vat_name = 'Średnia wartość przelewu VAT w miesiącu Wrzesień 2020'
 
+        unsettled = Sum(Expense.objects.counted('to_settle'))
+        settled = Sum(Expense.objects.counted('settled'))
         if request.user.is_superuser:
-            sum_unsettled_usd = Expense.objects.filter(is_settled=False
+            sum_unsettled_usd = Expense.objects.across_shards(
+                                             ).filter_counted(is_settled=False
                                              ).filter(currency='USD'
-                                             ).aggregate(Sum('to_settle'))
-            avg_vat = Transfer.objects.filter(is_vat=True
-                                     ).filter(sent_date__year=2020
-                                     ).filter(sent_date__month=10
-                                     ).aggregate(Avg('brutto'))
-            sum_settled = Expense.objects.filter(is_settled=True
-                                       ).aggregate(Sum('settled'))
+                                             ).aggregate(to_settle__sum=unsettled)
+            vat = Transfer.objects.across_shards().filter(is_vat=True
+                                 ).filter(sent_date__year=2020
+                                 ).filter(sent_date__month=10
+                                 ).aggregate(Sum('brutto'), Count('id'))
+            sum_settled = Expense.objects.across_shards(
+                                       ).filter_counted(is_settled=True
+                                       ).aggregate(settled__sum=settled)
+            archive = ArchiveTotal.objects.across_shards()
         else:
-            sum_unsettled_usd = Expense.objects.filter(owner=self.request.user
-                                             ).filter(is_settled=False
+            sum_unsettled_usd = Expense.objects.for_owner(self.request.user
+                                             ).filter_counted(is_settled=False
                                              ).filter(currency='USD'
-                                             ).aggregate(Sum('to_settle'))
-            avg_vat = Transfer.objects.filter(owner=self.request.user
-                                     ).filter(is_vat=True
-                                     ).filter(sent_date__year=2020
-                                     ).filter(sent_date__month=10
-                                     ).aggregate(Avg('brutto'))
-            sum_settled = Expense.objects.filter(owner=self.request.user
-                                       ).filter(is_settled=True
-                                       ).aggregate(Sum('settled'))
+                                             ).aggregate(to_settle__sum=unsettled)
+            vat = Transfer.objects.for_owner(self.request.user
+                                 ).filter(is_vat=True
+                                 ).filter(sent_date__year=2020
+                                 ).filter(sent_date__month=10
+                                 ).aggregate(Sum('brutto'), Count('id'))
+            sum_settled = Expense.objects.for_owner(self.request.user
+                                       ).filter_counted(is_settled=True
+                                       ).aggregate(settled__sum=settled)
+            archive = ArchiveTotal.objects.for_owner(self.request.user)
+
+        archived_settled = archive.aggregate(Sum('settled'))
+        archived_vat = archive.filter(month=date(2020, 10, 1)
+                             ).aggregate(Sum('vat_brutto'),
+                                         Sum('vat_transfers'))
 
         data = (
-            {sum_settled_name:sum_settled['settled__sum']},
+            {sum_settled_name:self.add(sum_settled['settled__sum'],
+                                       archived_settled['settled__sum'])},
             {sum_unsettled_name:sum_unsettled_usd['to_settle__sum']},
-            {avg_vat_name:avg_vat['brutto__avg']}
+            {avg_vat_name:self.average(
+                self.add(vat['brutto__sum'], archived_vat['vat_brutto__sum']),
+                (vat['id__count']
+                 + (archived_vat['vat_transfers__sum'] or 0))
+            )}
         )
         return Response(data=data, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def add(hot_sum, archived_sum):
+        """
+        Adds sums of hot and archived rows, None means no rows.
+        """
+        if archived_sum is None:
+            return hot_sum
+        return (hot_sum or 0) + archived_sum
+
+    @staticmethod
+    def average(total, count):
+        if not count:
+            return None
+        return (total / count).quantize(Decimal('0.01'),
+                                        rounding=ROUND_HALF_UP)
+
+
+class AgingReportView(APIView):
+    """
+    Aging report of receivables, outstanding 'to_settle' of unsettled
+    expenses split by their age into 0-30, 31-60, 61-90 and over 90 days
+    buckets, per currency or, with by=owner, per owner and currency.
+    Owner rows are ordered by outstanding total, largest debtors first,
+    "top" gives number of rows of a page and next pages are read with
+    "cursor" given in "next" link.
+    Permitted only for admin user.
+
+    GET /aging/
+    GET /aging/?by=owner&top=10
+    GET /aging/?by=owner&currency=PLN&cursor=WyIxMDAuMDAiLCAyLCAiUExOIl0
+    """
+    permission_classes = [IsAdminUser]
+    default_top = 50
+    max_top = 1000
+
+    def get(self, request, format=None):
+        by = request.query_params.get('by', 'currency')
+        currency = request.query_params.get('currency')
+        try:
+            top = int(request.query_params.get('top', self.default_top))
+            cursor = self.decode_cursor(request.query_params.get('cursor'))
+        except ValueError:
+            return Response(
+                {'detail': 'Invalid top or cursor.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if by not in ('currency', 'owner') or not 0 < top <= self.max_top:
+            return Response(
+                {'detail': f"Give by=currency or by=owner and top from 1 "
+                           f"to {self.max_top}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        now = timezone.now()
+        by_owner = by == 'owner'
+
+        def shard_rows(alias):
+            rows = Expense.objects.using(alias).aging(by_owner, now)
+            if currency is not None:
+                rows = rows.filter(currency=currency)
+            if not by_owner:
+                return list(rows)
+            if cursor is not None:
+                total, owner, currency_name = cursor
+                rows = rows.filter(
+                    Q(total__lt=total)
+                    | Q(total=total, owner__gt=owner)
+                    | Q(total=total, owner=owner, currency__gt=currency_name)
+                )
+            return list(rows.order_by('-total', 'owner', 'currency')
+                        [:top + 1])
+
+        shards = run_parallel(shard_rows, shard_aliases())
+        if by_owner:
+            rows = list(islice(heapq.merge(*shards, key=self.owner_key),
+                               top + 1))
+        else:
+            rows = self.merge_currencies(shards)
+
+        next_url = None
+        if by_owner and len(rows) > top:
+            rows = rows[:top]
+            last = rows[-1]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor',
+                self.encode_cursor(last)
+            )
+        return Response({
+            'as_of': now,
+            'by': by,
+            'next': next_url,
+            'results': AgingSerializer(rows, many=True).data,
+        })
+
+    @staticmethod
+    def owner_key(row):
+        return (-row['total'], row['owner'], row['currency'])
+
+    @staticmethod
+    def merge_currencies(shards):
+        """
+        Sums rows of the same currency read from different shards.
+        """
+
+        merged = {}
+        for row in (row for rows in shards for row in rows):
+            if row['currency'] not in merged:
+                merged[row['currency']] = dict(row)
+                continue
+            current = merged[row['currency']]
+            for name, value in row.items():
+                if name == 'oldest':
+                    current[name] = min(current[name], value)
+                elif name != 'currency':
+                    current[name] += value
+        return sorted(merged.values(),
+                      key=lambda row: (-row['total'], row['currency']))
+
+    @staticmethod
+    def encode_cursor(row):
+        position = json.dumps([str(row['total']), row['owner'],
+                               row['currency']])
+        return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if not cursor:
+            return None
+        try:
+            total, owner, currency = json.loads(base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4)
+            ))
+            return Decimal(total), int(owner), str(currency)
+        except (TypeError, ArithmeticError):
+            raise ValueError(cursor)
+
+
+class SyncView(APIView):
+    """
+    Incremental sync of expenses and transfers of user for offline
+    clients. Returns rows created or changed and tombstones of rows
+    deleted since given "token", every kind ordered by date-time of the
+    change and id, as kept by (owner, updated, id) indexes. "limit"
+    gives number of rows of every kind, while "more" is true the client
+    should sync again right away with the returned token. Without token
+    every row is returned.
+    Changes of the last minute are returned again by the next sync, so
+    rows of transactions committed late are not missed, clients apply
+    rows by their ids. Expenses in counter mode are returned also when
+    their counters change, see SettlementCounter. Archived rows are not
+    returned.
+    Permitted for authenticated users.
+
+    GET /sync/
+    GET /sync/?token=eyJleHBlbnNlcyI6IFsi&limit=500
+    Response body:
+    {
+        "expenses": [{...}],
+        "transfers": [{...}],
+        "deleted": [{"kind": "transfer", "id": 5}],
+        "token": "eyJleHBlbnNlcyI6IFsi",
+        "more": false
+    }
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 500
+    max_limit = 1000
+    overlap = timedelta(minutes=1)
+
+    def get(self, request, format=None):
+        try:
+            limit = int(request.query_params.get('limit',
+                                                 self.default_limit))
+            token = self.decode_token(request.query_params.get('token'))
+        except ValueError:
+            return Response(
+                {'detail': 'Invalid limit or token.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not 0 < limit <= self.max_limit:
+            return Response(
+                {'detail': f"Give limit from 1 to {self.max_limit}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        horizon = (timezone.now() - self.overlap, 0)
+        user = request.user
+        expenses = Expense.objects.for_owner(user).with_counters()
+        streams = {
+            'expenses': (expenses, 'updated'),
+            'counters': (SettlementCounter.objects.using(expenses.db)
+                         .filter(expense__owner=user), 'updated'),
+            'transfers': (Transfer.objects.for_owner(user), 'updated'),
+            'deleted': (Tombstone.objects.for_owner(user), 'deleted'),
+        }
+        pages, positions, more = {}, {}, False
+        for name, (queryset, field) in streams.items():
+            position = token.get(name)
+            if position is not None:
+                changed, id = position
+                queryset = queryset.filter(
+                    Q(**{f'{field}__gt': changed})
+                    | Q(**{field: changed, 'id__gt': id})
+                )
+            page = list(queryset.order_by(field, 'id')[:limit + 1])
+            last = position
+            if page:
+                last = (getattr(page[-1], field), page[-1].id)
+            if len(page) > limit:
+                page = page[:limit]
+                last = (getattr(page[-1], field), page[-1].id)
+                more = True
+            elif last is None or last > horizon:
+                last = horizon
+            pages[name], positions[name] = page, last
+
+        synced = {expense.id for expense in pages['expenses']}
+        counted = {counter.expense_id for counter in pages.pop('counters')}
+        pages['expenses'] += expenses.filter(id__in=counted - synced)
+        return Response({
+            'expenses': ExpenseSerializer(pages['expenses'], many=True).data,
+            'transfers': TransferSerializer(pages['transfers'],
+                                            many=True).data,
+            'deleted': [{'kind': tombstone.kind, 'id': tombstone.object_id}
+                        for tombstone in pages['deleted']],
+            'token': self.encode_token(positions),
+            'more': more,
+        })
+
+    @staticmethod
+    def encode_token(positions):
+        token = json.dumps({
+            name: [changed.isoformat(), id]
+            for name, (changed, id) in positions.items()
+        })
+        return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_token(token):
+        if not token:
+            return {}
+        try:
+            positions = json.loads(base64.urlsafe_b64decode(
+                token + '=' * (-len(token) % 4)
+            ))
+            decoded = {}
+            for name, (changed, id) in positions.items():
+                changed = parse_datetime(changed)
+                if changed is None:
+                    raise ValueError(token)
+                decoded[name] = (changed, int(id))
+            return decoded
+        except (TypeError, AttributeError):
+            raise ValueError(token)
+
+
+class DashboardView(APIView):
+    """
+    Sections of home screen of client in one response: currencies,
+    first page of expenses, first page of not settled transfers and
+    statistics. Sections do not depend on each other and are evaluated
+    in parallel by DASHBOARD_WORKERS threads, so the response takes
+    about as long as the slowest section. Every section is cached for
+    its time given in DASHBOARD_CACHE_TIMEOUTS setting, per user except
+    for currencies. "sections" picks some of the sections.
+    Permitted for authenticated users.
+
+    GET /dashboard/
+    GET /dashboard/?sections=expenses,statistics
+    Response body:
+    {
+        "currencies": [{...}],
+        "expenses": [{...}],
+        "pending_transfers": [{...}],
+        "statistics": [{...}, {...}, {...}]
+    }
+    """
+    permission_classes = [IsAuthenticated]
+    sections = ('currencies', 'expenses', 'pending_transfers', 'statistics')
+    shared_sections = ('currencies',)
+
+    def get(self, request, format=None):
+        names = self.sections
+        if request.query_params.get('sections'):
+            names = [name.strip() for name in
+                     request.query_params['sections'].split(',')]
+            unknown = set(names) - set(self.sections)
+            if unknown:
+                return Response(
+                    {'detail': f"Unknown sections: "
+                               f"{', '.join(sorted(unknown))}."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        results = run_parallel(
+            lambda name: self.cached_section(request, name), names,
+            max_workers=getattr(settings, 'DASHBOARD_WORKERS', 4)
+        )
+        return Response(dict(zip(names, results)))
+
+    def cached_section(self, request, name):
+        """
+        Returns section from cache or evaluates and caches it.
+        """
+        timeout = getattr(settings, 'DASHBOARD_CACHE_TIMEOUTS', {}).get(name)
+        if not timeout:
+            return getattr(self, name)(request)
+        key = f'dashboard:{name}'
+        if name not in self.shared_sections:
+            key = f'{key}:{request.user.pk}'
+        data = cache.get(key)
+        if data is None:
+            data = getattr(self, name)(request)
+            cache.set(key, data, timeout)
+        return data
+
+    @staticmethod
+    def page_size():
+        return api_settings.PAGE_SIZE or 10
+
+    def owned(self, request, queryset):
+        if request.user.is_superuser:
+            return fan_out(queryset)
+        return queryset.for_owner(request.user)
+
+    def currencies(self, request):
+        return CurrencySerializer(Currency.objects.all(), many=True).data
+
+    def expenses(self, request):
+        expenses = self.owned(request, Expense.objects.with_counters())
+        return ExpenseSerializer(
+            expenses.order_by('id')[:self.page_size()], many=True
+        ).data
+
+    def pending_transfers(self, request):
+        transfers = self.owned(request, Transfer.objects.filter(
+            is_settled__in=[False]
+        ))
+        return TransferSerializer(
+            transfers.order_by('id')[:self.page_size()], many=True
+        ).data
+
+    def statistics(self, request):
+        view = StatisticsListView()
+        view.request = request
+        return view.get(request).data
+
+
+class BatchView(APIView):
+    """
+    Executes many API requests in one round trip.
+    User is authenticated once and sub-requests are run in given order
+    against existing views. Strings of form {{<index>.<field>}} in path
+    or body of sub-request are replaced with values from response of
+    earlier sub-request, e.g. {{0.id}} is id of object created by first
+    sub-request. With "atomic" all sub-requests run in one transaction
+    on every database, 'default' and shards, which is rolled back when
+    any of them fails.
+    Only API views can be called, nested batch requests are not allowed.
+
+    POST /batch/
+    Request body:
+    {
+        "atomic": true,
+        "requests": [
+            {"method": "POST", "path": "/expenses/",
+             "body": {"currency": "PLN", "total_amount": "100",
+                      "vat": false, "owner": 2}},
+            {"method": "GET", "path": "/expense/{{0.id}}"}
+        ]
+    }
+    Response body:
+    {
+        "responses": [
+            {"status": 201, "body": {...}},
+            {"status": 200, "body": {...}}
+        ]
+    }
+    """
+    permission_classes = [IsAuthenticated]
+    reference = re.compile(r'\{\{(\d+)((?:\.[\w-]+)+)\}\}')
+
+    class Rollback(Exception):
+        pass
+
+    def post(self, request, format=None):
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        requests = serializer.validated_data['requests']
+        responses = []
+
+        if not serializer.validated_data['atomic']:
+            for sub_request in requests:
+                responses.append(self.execute(request, sub_request, responses))
+            return Response({'responses': responses})
+
+        try:
+            with ExitStack() as atomic:
+                for alias in dict.fromkeys([DEFAULT_DB_ALIAS,
+                                            *shard_aliases()]):
+                    atomic.enter_context(transaction.atomic(using=alias))
+                for sub_request in requests:
+                    responses.append(
+                        self.execute(request, sub_request, responses)
+                    )
+                    if responses[-1]['status'] >= 400:
+                        raise self.Rollback()
+        except self.Rollback:
+            return Response(
+                {'responses': responses},
+                status=responses[-1]['status']
+            )
+        return Response({'responses': responses})
+
+    def execute(self, request, sub_request, responses):
+        """
+        Runs single sub-request as the batch user.
+        Returns its status and response data.
+        """
+
+        try:
+            path = self.substitute(sub_request['path'], responses)
+            body = self.substitute(sub_request['body'], responses)
+        except LookupError as error:
+            return {
+                'status': status.HTTP_400_BAD_REQUEST,
+                'body': {'detail': f'Invalid reference {error}.'}
+            }
+
+        path, _, query = path.partition('?')
+        try:
+            match = resolve(path)
+        except Resolver404:
+            match = None
+        view_class = getattr(match, 'func', None) and getattr(
+            match.func, 'cls', None
+        )
+        if view_class is None or view_class is self.__class__:
+            return {
+                'status': status.HTTP_404_NOT_FOUND,
+                'body': {'detail': 'Not found.'}
+            }
+
+        response = match.func(
+            self.build_request(request, sub_request['method'], path,
+                               query, body),
+            *match.args, **match.kwargs
+        )
+        return {
+            'status': response.status_code,
+            'body': getattr(response, 'data', None)
+        }
+
+    @staticmethod
+    def build_request(request, method, path, query, body):
+        payload = json.dumps(body).encode() if body is not None else b''
+        environ = {
+            key: value for key, value in request.META.items()
+            if isinstance(value, str)
+        }
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(payload)),
+            'wsgi.input': BytesIO(payload),
+        })
+        sub_request = WSGIRequest(environ)
+        sub_request._force_auth_user = request.user
+        return sub_request
+
+    def substitute(self, value, responses):
+        """
+        Replaces references to earlier responses in strings found
+        in given value.
+        """
+
+        if isinstance(value, dict):
+            return {key: self.substitute(item, responses)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.substitute(item, responses) for item in value]
+        if not isinstance(value, str):
+            return value
+
+        whole = self.reference.fullmatch(value)
+        if whole:
+            return self.lookup(whole, responses)
+        return self.reference.sub(
+            lambda match: str(self.lookup(match, responses)), value
+        )
+
+    @staticmethod
+    def lookup(match, responses):
+        try:
+            value = responses[int(match.group(1))]['body']
+            for key in match.group(2).split('.')[1:]:
+                value = value[int(key) if isinstance(value, list) else key]
+        except (LookupError, TypeError, ValueError):
+            raise LookupError(match.group(0))
+        return value
@@ -13,4 +13,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'zadanie.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from api.events import EventStreamApplication
+
+events_application = EventStreamApplication()
+
+
+async def application(scope, receive, send):
+    """
+    Streams server-sent events at /events/, everything else is handled
+    by Django.
+    """
+    if scope['type'] == 'http' and scope['path'] == '/events/':
+        await events_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
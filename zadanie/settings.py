@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.ThresholdGZipMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,6 +52,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.ProfilingMiddleware',
+    'api.querylog.SlowQueryLogMiddleware',
 ]
 
 ROOT_URLCONF = 'zadanie.urls'
@@ -80,9 +84,29 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
 }
 
+# Owner-based sharding, see api/sharding.py. Aliases of databases keeping
+# expenses and transfers, given as SHARDS=shard_0,shard_1 environment
+# variable; every one of them has to be migrated with
+# manage.py migrate --database <alias>.
+# Empty list keeps everything in 'default'.
+SHARDS = [alias for alias in os.environ.get('SHARDS', '').split(',') if alias]
+
+# SQLite databases of shards, defined only when they are used. Aliases
+# given as SHARD_DATABASES environment variable are defined without
+# turning sharding on, which is what sharding tests need:
+# SHARD_DATABASES=shard_0,shard_1 python manage.py test
+for alias in SHARDS + os.environ.get('SHARD_DATABASES', '').split(','):
+    if alias:
+        DATABASES[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'{alias}.sqlite3',
+        }
+
+DATABASE_ROUTERS = ['api.sharding.ShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -133,5 +157,66 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'api.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
 }
+
+# Sections of /dashboard/ are evaluated by this many threads, each with
+# its own database connection; 1 evaluates them one by one in the
+# request thread. Sections are cached for given number of seconds, 0
+# turns caching of a section off.
+DASHBOARD_WORKERS = 4
+DASHBOARD_CACHE_TIMEOUTS = {
+    'currencies': 300,
+    'expenses': 0,
+    'pending_transfers': 0,
+    'statistics': 60,
+}
+
+# Responses smaller than this many bytes are not compressed.
+GZIP_MIN_LENGTH = 1024
+
+# Fraction of requests profiled by api.middleware.ProfilingMiddleware.
+# Admin users can profile single request with X-Profile: 1 header.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = BASE_DIR / 'profiles'
+
+# Queries running at least this many milliseconds are logged with their
+# EXPLAIN output to SLOW_QUERY_LOG. None disables the log.
+SLOW_QUERY_THRESHOLD_MS = 200
+SLOW_QUERY_LOG = BASE_DIR / 'slow_queries.log'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'api.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
@@ -35,7 +35,14 @@ urlpatterns = [
     path('currency/<str:currency_name>/', views.CurrencyDetailView.as_view()),
     path('expenses/', views.ExpensesListView.as_view()),
     path('expense/<int:id>', views.ExpenseDetailView.as_view()),
+    path('expense/<int:id>/balance', views.ExpenseBalanceView.as_view()),
     path('transfers/', views.TransfersListView.as_view()),
+    path('transfers/allocate/', views.TransferAllocationView.as_view()),
     path('transfer/<int:id>', views.TransferDetailView.as_view()),
-    path('statystyki/', views.StatisticsListView.as_view())
+    path('statystyki/', views.StatisticsListView.as_view()),
+    path('aging/', views.AgingReportView.as_view()),
+    path('sync/', views.SyncView.as_view()),
+    path('dashboard/', views.DashboardView.as_view()),
+    path('batch/', views.BatchView.as_view()),
+    path('billing/', views.BillingRunView.as_view())
 ]